@@ -0,0 +1,168 @@
+import argparse
+import os
+import sqlite3
+import time
+from storage import DBNAME, NAME_COLUMNS, ReadModels, create_tables
+
+# junction tables first: their rows go before the students they refer to
+STUDENT_TABLES = ['Students-Subjects', 'Students-CCAs', 'Students-Activities', 'Students']
+# (table, id column, junction table) of the rows archived students refer to,
+# copied (not moved) so archived pages still show names
+REFERENCED = [('Classes', 'class_id', 'Students'),
+              ('Subjects', 'subj_id', 'Students-Subjects'),
+              ('CCAs', 'cca_id', 'Students-CCAs'),
+              ('Activities', 'activity_id', 'Students-Activities')]
+
+
+def archive_name(dbname=DBNAME):
+    """Returns the archive database of dbname: school.db -> school-archive.db"""
+    stem, ext = os.path.splitext(dbname)
+    return f'{stem}-archive{ext or ".db"}'
+
+
+def prepare(archive):
+    """Creates the archive database. Names do not have to be unique in it:
+    a name can come back in the live tables once its owner is archived
+    """
+    create_tables(archive)
+    conn = sqlite3.connect(archive)
+    with conn:
+        for tblname, name_key, unique_with in NAME_COLUMNS:
+            index = f'{tblname}_{name_key}_norm'
+            columns = ', '.join([f"'{name_key}_norm' COLLATE NOCASE", *unique_with])
+            conn.execute(f"DROP INDEX IF EXISTS '{index}';")
+            conn.execute(f"CREATE INDEX '{index}' ON '{tblname}' ({columns});")
+    conn.close()
+
+
+def _columns(conn, schema, tblname):
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info('{tblname}');")]
+
+
+def _copy(conn, ids):
+    """Copies the rows of the students in ids, and the rows they refer to,
+    into the attached archive. Returns {table: rows copied}
+    """
+    marks = ', '.join('?' * len(ids))
+    copied = {}
+    for tblname, id_key, junction in REFERENCED:
+        columns = ', '.join(f'"{column}"' for column in _columns(conn, 'main', tblname))
+        conn.execute(f"""
+                INSERT OR REPLACE INTO archive.'{tblname}' ({columns})
+                SELECT {columns} FROM main.'{tblname}'
+                WHERE {id_key} IN (
+                    SELECT {id_key} FROM main.'{junction}' WHERE student_id IN ({marks})
+                );""", ids)
+    for tblname in STUDENT_TABLES:
+        columns = ', '.join(f'"{column}"' for column in _columns(conn, 'main', tblname))
+        copied[tblname] = conn.execute(f"""
+                INSERT OR REPLACE INTO archive.'{tblname}' ({columns})
+                SELECT {columns} FROM main.'{tblname}' WHERE student_id IN ({marks});
+                """, ids).rowcount
+    return copied
+
+
+def archive_graduates(dbname=DBNAME, archive=None, before=None, chunk=200, sleep=0.05):
+    """Moves the students whose grad_year is before `before` (default: this
+    year), with their subject, CCA and activity rows, from dbname into the
+    archive database (default: archive_name(dbname)).
+
+    Students are moved chunk at a time, each chunk in its own short
+    transaction with a sleep in between, so the app only ever waits for one
+    chunk. Every chunk is first copied and committed to the archive, then
+    copied again and deleted in one transaction, so a crash can leave
+    students in both databases (the next run finishes moving them) but
+    never in neither. Works on the database file, so not for a database
+    served by the memory backend while the app is running.
+
+    Returns {'students', 'rows': {table: rows moved}, 'chunks', 'seconds',
+             'longest_chunk_seconds'}
+    """
+    archive = archive or archive_name(dbname)
+    before = before or time.localtime().tm_year
+    prepare(archive)
+    stats = {'students': 0, 'rows': {tblname: 0 for tblname in STUDENT_TABLES},
+             'chunks': 0, 'longest_chunk_seconds': 0}
+    start = time.perf_counter()
+
+    conn = sqlite3.connect(dbname, timeout=30, isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS archive;", (archive,))
+        last_id = 0
+        while True:
+            ids = [student_id for student_id, in conn.execute("""
+                    SELECT student_id FROM main.'Students'
+                    WHERE grad_year < ? AND student_id > ?
+                    ORDER BY student_id
+                    LIMIT ?;""", (before, last_id, chunk))]
+            if not ids:
+                break
+            last_id = ids[-1]
+            chunk_start = time.perf_counter()
+            conn.execute("BEGIN;")
+            _copy(conn, ids)
+            conn.execute("COMMIT;")
+
+            # the live rows may have changed since: copy again, then delete
+            conn.execute("BEGIN IMMEDIATE;")
+            try:
+                copied = _copy(conn, ids)
+                marks = ', '.join('?' * len(ids))
+                for tblname in STUDENT_TABLES:
+                    conn.execute(f"DELETE FROM main.'{tblname}' WHERE student_id IN ({marks});", ids)
+                conn.execute("COMMIT;")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK;")
+                raise
+            for tblname, count in copied.items():
+                stats['rows'][tblname] += count
+            stats['students'] += copied['Students']
+            stats['chunks'] += 1
+            stats['longest_chunk_seconds'] = max(stats['longest_chunk_seconds'],
+                                                 time.perf_counter() - chunk_start)
+            time.sleep(sleep)
+        conn.execute("DETACH DATABASE archive;")
+    finally:
+        conn.close()
+    # the /view documents are not refreshed when they are looked up
+    for path in (dbname, archive):
+        ReadModels(path).refresh()
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def counts(dbname):
+    """Returns {table: rows} of the tables archival moves rows out of"""
+    conn = sqlite3.connect(f'file:{dbname}?mode=ro', uri=True)
+    try:
+        return {tblname: conn.execute(f"SELECT COUNT(*) FROM '{tblname}';").fetchone()[0]
+                for tblname in STUDENT_TABLES}
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move graduated students into the archive database')
+    parser.add_argument('--db', default=DBNAME)
+    parser.add_argument('--archive', help='archive database (default: <db>-archive.db)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('run', help='archive the students who have graduated')
+    command.add_argument('--before', type=int, help='archive grad_year before this (default: this year)')
+    command.add_argument('--chunk', type=int, default=200, help='students per transaction')
+    command.add_argument('--sleep', type=float, default=0.05, help='seconds between chunks')
+    commands.add_parser('stats', help='rows in the live and archive databases')
+    args = parser.parse_args()
+    archive = args.archive or archive_name(args.db)
+
+    if args.command == 'run':
+        stats = archive_graduates(args.db, archive, args.before, args.chunk, args.sleep)
+        print(f"Archived {stats['students']} students in {stats['chunks']} chunks "
+              f"({stats['seconds']:.2f}s, longest chunk {stats['longest_chunk_seconds'] * 1000:.0f}ms)")
+        for tblname, count in stats['rows'].items():
+            print(f'{tblname:24} {count:8}')
+    elif args.command == 'stats':
+        live = counts(args.db)
+        stored = counts(archive) if os.path.exists(archive) else {}
+        print(f"{'':24} {'live':>8} {'archive':>8}")
+        for tblname, count in live.items():
+            print(f'{tblname:24} {count:8} {stored.get(tblname, 0):8}')
@@ -0,0 +1,172 @@
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+from flask import abort, request, send_file, url_for
+
+try:
+    import brotli
+except ImportError: # optional: without it only gzip variants are built
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST = 'manifest.json'
+# file types worth compressing; images are already compressed
+COMPRESSIBLE = {'.css', '.js', '.svg', '.html', '.json', '.txt', '.ico'}
+MAX_AGE = 365 * 24 * 3600
+
+
+def fingerprint(path):
+    """Returns the first 12 hex digits of the SHA-256 of a file's contents"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def build(static_dir=STATIC_DIR, dist_dir=DIST_DIR):
+    """Copies every file in static_dir to dist_dir under a content-hashed
+    name (css/styles.css -> css/styles.<hash>.css) and writes .gz and, if
+    brotli is installed, .br variants of compressible files when they are
+    smaller. Writes the {original name: hashed name} manifest and returns it
+    """
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        if os.path.abspath(root).startswith(os.path.abspath(dist_dir)):
+            continue
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            stem, ext = os.path.splitext(name)
+            hashed = f'{stem}.{fingerprint(path)}{ext}'
+            target = os.path.join(dist_dir, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(path, target)
+            if ext.lower() in COMPRESSIBLE:
+                with open(path, 'rb') as f:
+                    content = f.read()
+                variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+                if brotli is not None:
+                    variants['.br'] = brotli.compress(content, quality=11)
+                for suffix, compressed in variants.items():
+                    if len(compressed) < len(content):
+                        with open(target + suffix, 'wb') as f:
+                            f.write(compressed)
+            manifest[name] = hashed
+    with open(os.path.join(dist_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(dist_dir=DIST_DIR):
+    """Returns the manifest written by build(), or {} if it has not been run"""
+    try:
+        with open(os.path.join(dist_dir, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def init_app(app, dist_dir=DIST_DIR):
+    """Adds the asset_url() template helper and the /assets route to app.
+
+    asset_url('css/styles.css') returns the URL of the fingerprinted copy,
+    which is served with a one-year immutable Cache-Control, so browsers
+    never ask for it again; a changed file gets a new name. If the assets
+    have not been built it falls back to the plain /static URL.
+    """
+    state = app.extensions['assets'] = {'dist_dir': dist_dir,
+                                        'manifest': load_manifest(dist_dir)}
+
+    def asset_url(filename):
+        manifest = state['manifest']
+        if filename in manifest:
+            return url_for('asset', filename=manifest[filename])
+        return url_for('static', filename=filename)
+
+    def asset(filename):
+        if filename not in state['manifest'].values():
+            abort(404)
+        path = os.path.join(state['dist_dir'], filename)
+        # only the precompressed files that exist, best_match honours q=0
+        suffixes = {'br': '.br', 'gzip': '.gz'}
+        encoding = request.accept_encodings.best_match(
+            [name for name, suffix in suffixes.items() if os.path.exists(path + suffix)])
+        if encoding is not None:
+            path += suffixes[encoding]
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_file(path, mimetype=mimetype, max_age=MAX_AGE)
+        response.headers['Cache-Control'] = f'public, max-age={MAX_AGE}, immutable'
+        response.headers['Vary'] = 'Accept-Encoding'
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    app.add_url_rule('/assets/<path:filename>', 'asset', asset)
+    app.add_template_global(asset_url)
+
+
+def benchmark(pages=('/', '/view', '/add', '/edit', '/help'), views=5):
+    """Replays views rounds over pages against the app, with and without the
+    built assets, as a browser with a cache would: unversioned /static files
+    are revalidated on every page view (a 304 if unchanged), immutable
+    /assets files are fetched once. Prints the asset requests and bytes of
+    the first visit and of the repeat visits.
+    """
+    import front
+    state = front.app.extensions['assets']
+    client = front.app.test_client()
+    built = load_manifest(state['dist_dir'])
+    if not built:
+        print('Run `python assets.py build` first')
+        return
+
+    for label, manifest in [('unversioned /static', {}), ('fingerprinted /assets', built)]:
+        state['manifest'] = manifest
+        cache = {} # url -> validators of the cached copy
+        stats = {'first': [0, 0], 'repeat': [0, 0]}
+        for view in range(views):
+            visit = 'first' if view == 0 else 'repeat'
+            for page in pages:
+                html = client.get(page).get_data(as_text=True)
+                for url in re.findall(r'''(?:href|src)=["']?(/(?:static|assets)/[^"'\s>]+)''', html):
+                    if url in cache and url.startswith('/assets/'):
+                        continue # immutable: served from the browser cache
+                    headers = {'Accept-Encoding': 'gzip, br', **cache.get(url, {})}
+                    response = client.get(url, headers=headers)
+                    stats[visit][0] += 1
+                    stats[visit][1] += len(response.get_data())
+                    validators = {}
+                    if response.headers.get('ETag'):
+                        validators['If-None-Match'] = response.headers['ETag']
+                    if response.headers.get('Last-Modified'):
+                        validators['If-Modified-Since'] = response.headers['Last-Modified']
+                    cache.setdefault(url, validators)
+        print(f"{label:22}  first visit: {stats['first'][0]:3} requests {stats['first'][1]:7} bytes"
+              f"  {views - 1} repeat visits: {stats['repeat'][0]:3} requests {stats['repeat'][1]:7} bytes")
+    state['manifest'] = built
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build fingerprinted, precompressed static assets')
+    parser.add_argument('command', choices=['build', 'benchmark'])
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        manifest = build()
+        for name, hashed in manifest.items():
+            path = os.path.join(DIST_DIR, hashed)
+            sizes = [f'{os.path.getsize(path)}B']
+            for suffix in ['.gz', '.br']:
+                if os.path.exists(path + suffix):
+                    sizes.append(f'{suffix[1:]} {os.path.getsize(path + suffix)}B')
+            print(f"{name} -> {hashed} ({', '.join(sizes)})")
+        if brotli is None:
+            print('brotli is not installed, only gzip variants were built')
+    elif args.command == 'benchmark':
+        benchmark()
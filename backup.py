@@ -0,0 +1,155 @@
+import argparse
+import glob
+import os
+import sqlite3
+import time
+from storage import DBNAME
+
+
+def backup(dest, dbname=DBNAME, pages=64, sleep=0.005):
+    """Copies dbname to dest with the SQLite online backup API while the
+    app keeps running. pages are copied per step with a sleep in between,
+    so readers and writers only wait for one step at a time instead of the
+    whole copy. If another connection writes to the database mid-backup,
+    SQLite restarts the copy, so the result is always a consistent snapshot.
+
+    The copy is written next to dest and renamed into place when complete.
+    Returns {'path', 'pages', 'seconds', 'pages_per_second'}
+    """
+    partial = dest + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    stats = {'path': dest, 'pages': 0}
+
+    def progress(status, remaining, total):
+        stats['pages'] = total
+
+    source = sqlite3.connect(dbname)
+    target = sqlite3.connect(partial)
+    start = time.perf_counter()
+    try:
+        source.backup(target, pages=pages, progress=progress, sleep=sleep)
+    finally:
+        target.close()
+        source.close()
+    stats['seconds'] = time.perf_counter() - start
+    stats['pages_per_second'] = stats['pages'] / stats['seconds'] if stats['seconds'] else 0
+    os.replace(partial, dest)
+    return stats
+
+
+def _snapshots(directory, dbname):
+    """Returns the snapshots of dbname in directory, oldest first"""
+    stem = os.path.splitext(os.path.basename(dbname))[0]
+    return sorted(glob.glob(os.path.join(directory, f'{stem}-*.db')))
+
+
+def snapshot(directory, dbname=DBNAME, keep=7, pages=64, sleep=0.005):
+    """Takes a timestamped backup of dbname into directory and deletes all
+    but the newest keep snapshots. Returns the backup stats
+    """
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(dbname))[0]
+    dest = os.path.join(directory, f"{stem}-{time.strftime('%Y%m%d-%H%M%S')}.db")
+    stats = backup(dest, dbname, pages, sleep)
+    snapshots = _snapshots(directory, dbname)
+    for path in snapshots[:max(len(snapshots) - keep, 0)]:
+        os.remove(path)
+    return stats
+
+
+def schedule(directory, interval, dbname=DBNAME, keep=7, pages=64, sleep=0.005, runs=None):
+    """Takes a snapshot every interval seconds (runs times, or forever)"""
+    done = 0
+    while runs is None or done < runs:
+        start = time.monotonic()
+        try:
+            stats = snapshot(directory, dbname, keep, pages, sleep)
+            _print_stats(stats)
+        except sqlite3.Error as e:
+            # a failed snapshot should not stop the next one
+            print(f'Backup failed: {e}')
+        done += 1
+        if runs is None or done < runs:
+            time.sleep(max(interval - (time.monotonic() - start), 0))
+
+
+def verify(path):
+    """Runs an integrity check on a database file.
+    Returns (list of problems, {table: row count}); no problems means it is sound
+    """
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        problems = [row[0] for row in conn.execute('PRAGMA integrity_check;')]
+        if problems == ['ok']:
+            problems = []
+        tables = [name for name, in conn.execute("""
+                    SELECT name FROM sqlite_master
+                    WHERE type = 'table' AND name NOT LIKE 'sqlite_%'
+                    ORDER BY name;""")]
+        counts = {tblname: conn.execute(f"SELECT COUNT(*) FROM '{tblname}';").fetchone()[0]
+                  for tblname in tables}
+    finally:
+        conn.close()
+    return problems, counts
+
+
+def restore(path, dbname=DBNAME, pages=64, sleep=0.005):
+    """Verifies the snapshot at path, copies it over dbname with the online
+    backup API (so open connections see either the old or the restored
+    database, never a mix) and checks that the restored row counts match.
+    Raises ValueError if the snapshot or the restored database is unsound.
+    Returns the row counts
+    """
+    problems, counts = verify(path)
+    if problems:
+        raise ValueError(f'{path} failed the integrity check: {problems[:5]}')
+    source = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    target = sqlite3.connect(dbname)
+    try:
+        source.backup(target, pages=pages, sleep=sleep)
+    finally:
+        target.close()
+        source.close()
+    problems, restored = verify(dbname)
+    if problems or restored != counts:
+        raise ValueError(f'{dbname} does not match {path} after the restore')
+    return counts
+
+
+def _print_stats(stats):
+    print(f"Backed up {stats['pages']} pages to {stats['path']} in "
+          f"{stats['seconds']:.2f}s ({stats['pages_per_second']:.0f} pages/s)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Online backups of the database')
+    parser.add_argument('--db', default=DBNAME)
+    parser.add_argument('--pages', type=int, default=64, help='pages copied per step')
+    parser.add_argument('--sleep', type=float, default=0.005, help='seconds between steps')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('snapshot', help='take one snapshot')
+    command.add_argument('--dir', default='backups')
+    command.add_argument('--keep', type=int, default=7, help='snapshots to keep')
+    command = commands.add_parser('schedule', help='take a snapshot every --interval seconds')
+    command.add_argument('--dir', default='backups')
+    command.add_argument('--keep', type=int, default=7, help='snapshots to keep')
+    command.add_argument('--interval', type=float, default=3600)
+    command = commands.add_parser('verify', help='check a snapshot')
+    command.add_argument('path')
+    command = commands.add_parser('restore', help='verify a snapshot and restore it over --db')
+    command.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'snapshot':
+        _print_stats(snapshot(args.dir, args.db, args.keep, args.pages, args.sleep))
+    elif args.command == 'schedule':
+        schedule(args.dir, args.interval, args.db, args.keep, args.pages, args.sleep)
+    elif args.command == 'verify':
+        problems, counts = verify(args.path)
+        for tblname, count in counts.items():
+            print(f'{tblname:24} {count:8}')
+        print('\n'.join(problems) if problems else 'Integrity check passed')
+    elif args.command == 'restore':
+        counts = restore(args.path, args.db, args.pages, args.sleep)
+        print(f'Restored {sum(counts.values())} rows in {len(counts)} tables from {args.path}')
@@ -0,0 +1,426 @@
+import argparse
+import csv
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+from import_data import incremental_import
+from seed import populate
+from storage import (TABLES, Router, Students, Classes, Subjects, CCAs, Activities,
+                     close_pool, open_backend)
+
+
+def _per_call(func, args_list):
+    """Returns the mean time per call of func over args_list, in microseconds"""
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    return (time.perf_counter() - start) / len(args_list) * 1e6
+
+
+def _report(rows):
+    width = max(len(name) for name, *_ in rows)
+    print(f"{'':{width}}  {'by name':>10}  {'by id':>10}  {'saved':>6}")
+    for name, by_name, by_id in rows:
+        saved = (1 - by_id / by_name) * 100
+        print(f"{name:{width}}  {by_name:8.1f}us  {by_id:8.1f}us  {saved:5.0f}%")
+
+
+def bench_ids(dbname, calls):
+    """Name-based Collection methods against their *_by_id variants"""
+    students = Students(dbname)
+    ccas = CCAs(dbname)
+    activities = Activities(dbname)
+
+    members = students._return("""
+        SELECT student_name, 'Students'.'student_id', cca_name, 'CCAs'.'cca_id', role
+        FROM 'Students-CCAs'
+        INNER JOIN 'Students' ON 'Students'.'student_id' = 'Students-CCAs'.'student_id'
+        INNER JOIN 'CCAs' ON 'CCAs'.'cca_id' = 'Students-CCAs'.'cca_id'
+        LIMIT ?;""", (calls,), multi=True)
+    participants = students._return("""
+        SELECT student_name, 'Students'.'student_id', activity_name,
+               'Activities'.'activity_id', role, award, hours
+        FROM 'Students-Activities'
+        INNER JOIN 'Students' ON 'Students'.'student_id' = 'Students-Activities'.'student_id'
+        INNER JOIN 'Activities' ON 'Activities'.'activity_id' = 'Students-Activities'.'activity_id'
+        LIMIT ?;""", (calls,), multi=True)
+    rows = []
+
+    rows.append(('Students.get', _per_call(students.get, [(m['student_name'],) for m in members]),
+                 _per_call(students.get_by_id, [(m['student_id'],) for m in members])))
+
+    rows.append(('CCAs.update_student',
+                 _per_call(ccas.update_student, [({'student_name': m['student_name'],
+                                                  'cca_name': m['cca_name'],
+                                                  'role': m['role']},) for m in members]),
+                 _per_call(ccas.update_student_by_id, [({'student_id': m['student_id'],
+                                                        'cca_id': m['cca_id'],
+                                                        'role': m['role']},) for m in members])))
+
+    # delete then add back, so that the by-id run sees the same rows
+    by_name = _per_call(ccas.delete_student, [(m['student_name'], m['cca_name']) for m in members])
+    _per_call(ccas.add_student_by_id, [(dict(m),) for m in members])
+    by_id = _per_call(ccas.delete_student_by_id, [(m['student_id'], m['cca_id']) for m in members])
+    rows.append(('CCAs.delete_student', by_name, by_id))
+    by_name = _per_call(ccas.add_student, [(dict(m),) for m in members])
+    _per_call(ccas.delete_student_by_id, [(m['student_id'], m['cca_id']) for m in members])
+    by_id = _per_call(ccas.add_student_by_id, [(dict(m),) for m in members])
+    rows.append(('CCAs.add_student', by_name, by_id))
+
+    _per_call(activities.delete_student_by_id,
+              [(p['student_id'], p['activity_id']) for p in participants])
+    by_name = _per_call(activities.add_student, [(dict(p),) for p in participants])
+    _per_call(activities.delete_student_by_id,
+              [(p['student_id'], p['activity_id']) for p in participants])
+    by_id = _per_call(activities.add_student_by_id, [(dict(p),) for p in participants])
+    rows.append(('Activities.add_student', by_name, by_id))
+
+    names = [m['student_name'] for m in members]
+    start = time.perf_counter()
+    for name in names:
+        students._retrieve_id('Students', name, 'student_name', 'student_id')
+    by_name = (time.perf_counter() - start) / len(names) * 1e6
+    start = time.perf_counter()
+    students.resolve_ids(names)
+    rows.append(('_retrieve_id vs resolve_ids', by_name,
+                 (time.perf_counter() - start) / len(names) * 1e6))
+
+    _report(rows)
+
+
+def bench_import(dbname, rows):
+    """First and no-change incremental re-import of a rows-student export"""
+    directory = os.path.dirname(dbname)
+    students_path = os.path.join(directory, 'student.csv')
+    ccas_path = os.path.join(directory, 'cca.csv')
+    with open(students_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['student_id', 'student_name', 'tshirt_size', 'class_id',
+                         'year_enrolled', 'graduated'])
+        for i in range(1, rows + 1):
+            writer.writerow([i, f'IMPORTED STUDENT {i:06d}', 'M', 2200 + i % 40, 2022, 'FALSE'])
+    with open(ccas_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'type', 'name'])
+        for i in range(1, 61):
+            writer.writerow([i, 'Sports', f'IMPORTED CCA {i:03d}'])
+
+    for run in ['first import', 'no-change re-import']:
+        start = time.perf_counter()
+        summaries = incremental_import(students_path, ccas_path, dbname)
+        elapsed = time.perf_counter() - start
+        print(f"{run:20} {elapsed:7.3f}s  {summaries['Students']}")
+
+
+def _peak(func):
+    """Returns (peak traced memory in KiB, seconds) of func()"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024, elapsed
+
+
+def bench_memory(dbname):
+    """Peak memory of materialized against streamed multi-row getters"""
+    classes = Classes(dbname)
+    class_name = classes._return("SELECT class_name FROM 'Classes' LIMIT 1;")['class_name']
+    query = """
+            SELECT student_name, activity_name, role, award, hours
+            FROM 'Students-Activities'
+            INNER JOIN 'Students' ON 'Students'.'student_id' = 'Students-Activities'.'student_id'
+            INNER JOIN 'Activities' ON 'Activities'.'activity_id' = 'Students-Activities'.'activity_id';
+            """
+    cases = [('Classes.get (full roster)',
+              lambda stream: classes.get(class_name, stream=stream)),
+             ('whole-table join',
+              lambda stream: classes._return(query, multi=True, stream=stream))]
+    print(f"{'':26}  {'fetchall':>10}  {'stream':>10}  {'time':>15}")
+    for name, call in cases:
+        # consume every row, as a page or export would
+        (list_peak, list_time), (stream_peak, stream_time) = [
+            _peak(lambda: sum(1 for _ in call(stream))) for stream in (False, True)]
+        print(f"{name:26}  {list_peak:8.0f}KiB  {stream_peak:8.0f}KiB"
+              f"  {list_time:6.3f}s/{stream_time:6.3f}s")
+
+
+def bench_stream(dbname, calls):
+    """Time to first byte, total time and bytes sent for the largest class
+    page, rendered whole against streamed, per Accept-Encoding
+    """
+    import front
+    directory, filename = os.path.split(dbname)
+    class_name = Classes(dbname)._return("""
+            SELECT class_name FROM 'Classes'
+            INNER JOIN 'Students' ON 'Students'.'class_id' = 'Classes'.'class_id'
+            GROUP BY 'Classes'.'class_id' ORDER BY COUNT(*) DESC LIMIT 1;""")['class_name']
+    client = front.app.test_client()
+    print(f"{'':24}  {'first byte':>10}  {'total':>9}  {'bytes':>9}")
+    # the app's collections follow the shard selected for the context
+    with Router(directory).use(os.path.splitext(filename)[0]):
+        for stream in (False, True):
+            front.app.config['STREAM_TEMPLATES'] = stream
+            for encoding in ('identity', 'gzip', 'br'):
+                first = total = size = 0
+                for _ in range(calls):
+                    start = time.perf_counter()
+                    response = client.post('/view?searched', data={'Class': class_name},
+                                           headers={'Accept-Encoding': encoding}, buffered=False)
+                    chunks = iter(response.response)
+                    size += len(next(chunks))
+                    first += time.perf_counter() - start
+                    size += sum(len(chunk) for chunk in chunks)
+                    response.close()
+                    total += time.perf_counter() - start
+                label = f"{'streamed' if stream else 'rendered'}, {encoding}"
+                print(f"{label:24}  {first / calls * 1000:8.2f}ms  {total / calls * 1000:7.2f}ms"
+                      f"  {size // calls:9}")
+    front.app.config['STREAM_TEMPLATES'] = True
+
+
+def _exercise(dbname):
+    """Runs the same script of calls on the five Collections of dbname and
+    returns [(call, result), ...], so that backends can be compared
+    """
+    students, classes, subjects = Students(dbname), Classes(dbname), Subjects(dbname)
+    ccas, activities = CCAs(dbname), Activities(dbname)
+    subject = subjects._return("SELECT subj_name, level FROM 'Subjects' LIMIT 1;")
+    subject = {'subj_name': subject['subj_name'], 'level': subject['level']}
+    student = {'student_name': 'BACKEND STUDENT', 'age': 17, 'year_enrolled': 2024,
+               'grad_year': 2025, 'class_name': 'BACKEND CLASS'}
+    member = {'student_name': 'BACKEND STUDENT', 'cca_name': 'BACKEND CCA', 'role': 'Member'}
+    participant = {'student_name': 'BACKEND STUDENT', 'activity_name': 'BACKEND ACTIVITY',
+                   'role': 'Participant', 'award': None, 'hours': 4}
+    script = [
+        ('Classes.add', classes.add, {'class_name': 'BACKEND CLASS', 'level': 'JC1'}),
+        ('Classes.add again', classes.add, {'class_name': 'backend class', 'level': 'JC1'}),
+        ('Classes.get_info', classes.get_info, 'Backend Class'),
+        ('Students.add', students.add, dict(student)),
+        ('Students.add again', students.add, dict(student)),
+        ('Students.get', students.get, 'backend student'),
+        ('Classes.get', classes.get, 'BACKEND CLASS'),
+        ('Subjects.add_student', subjects.add_student,
+         {'student_name': 'BACKEND STUDENT', 'subj_list': [subject]}),
+        ('Subjects.get_student', subjects.get_student, 'BACKEND STUDENT'),
+        ('CCAs.add', ccas.add, {'cca_name': 'BACKEND CCA', 'type': 'Club'}),
+        ('CCAs.add_student', ccas.add_student, dict(member)),
+        ('CCAs.add_student again', ccas.add_student, dict(member)),
+        ('CCAs.update_student', ccas.update_student, {**member, 'role': 'Chairperson'}),
+        ('CCAs.get_student', ccas.get_student, 'BACKEND STUDENT'),
+        ('CCAs.update', ccas.update, 'BACKEND CCA', {'new_cca_name': 'BACKEND CCA 2',
+                                                     'new_type': 'Sports'}),
+        ('CCAs.get', ccas.get, 'backend cca 2'),
+        ('Activities.add', activities.add, {'activity_name': 'BACKEND ACTIVITY',
+                                            'start_date': '2024-03-01', 'end_date': '2024-03-02',
+                                            'description': 'Backend test'}),
+        ('Activities.add_many', activities.add_many,
+         [{'activity_name': name, 'start_date': '2024-04-01', 'end_date': None,
+           'description': 'Backend test'} for name in ['BACKEND ACTIVITY', 'BACKEND TRIP']]),
+        ('Activities.add_student', activities.add_student, dict(participant)),
+        ('Activities.update_student', activities.update_student, {**participant, 'award': 'Gold'}),
+        ('Activities.get_student', activities.get_student, 'BACKEND STUDENT'),
+        ('Activities.get', activities.get, 'BACKEND TRIP'),
+        ('Students.update', students.update, 'BACKEND STUDENT',
+         {'new_student_name': 'BACKEND STUDENT 2', 'new_age': 18, 'new_year_enrolled': 2024,
+          'new_grad_year': 2025, 'new_class_name': 'BACKEND CLASS'}),
+        ('Subjects.delete_student', subjects.delete_student,
+         {'student_name': 'BACKEND STUDENT 2', **subject}),
+        ('CCAs.delete_student', ccas.delete_student, 'BACKEND STUDENT 2', 'BACKEND CCA 2'),
+        ('Activities.delete_student', activities.delete_student, 'BACKEND STUDENT 2',
+         'BACKEND ACTIVITY'),
+        ('Activities.delete', activities.delete, 'BACKEND TRIP'),
+        ('CCAs.delete', ccas.delete, 'BACKEND CCA 2'),
+        ('Students.delete', students.delete, 'BACKEND STUDENT 2'),
+        ('Students.get missing', students.get, 'BACKEND STUDENT 2'),
+    ]
+    results = []
+    for name, method, *args in script:
+        result = method(*args)
+        if result is not None and not isinstance(result, (bool, dict, list)):
+            result = list(result) # a stream
+        results.append((name, result))
+    return results
+
+
+def _dump(dbname):
+    """Returns every row of TABLES (and of the change log, without its times)"""
+    conn = sqlite3.connect(dbname)
+    dump = {tblname: conn.execute(f"SELECT * FROM '{tblname}' ORDER BY rowid;").fetchall()
+            for tblname in TABLES}
+    dump['Changes'] = conn.execute("""
+            SELECT version, table_name, operation, row_key, old, new
+            FROM 'Changes' ORDER BY version;""").fetchall()
+    conn.close()
+    return dump
+
+
+def bench_backends(dbname, calls):
+    """Checks that every Collection behaves the same on the sqlite and
+    memory backends, that the memory backend's snapshot and journal bring
+    back the same database, then times reads and writes on both
+    """
+    directory = os.path.dirname(dbname)
+    copies = {}
+    for backend in ['sqlite', 'memory']:
+        copies[backend] = os.path.join(directory, f'{backend}.db')
+        shutil.copyfile(dbname, copies[backend])
+        open_backend(copies[backend], backend, **({'snapshot_interval': None}
+                                                   if backend == 'memory' else {}))
+
+    results = {backend: _exercise(path) for backend, path in copies.items()}
+    differences = [(name, a, b) for (name, a), (_, b) in zip(results['sqlite'], results['memory'])
+                   if a != b]
+    for name, a, b in differences:
+        print(f'{name}: sqlite returned {a!r}, memory returned {b!r}')
+    print(f"{len(results['sqlite']) - len(differences)}/{len(results['sqlite'])} calls "
+          f"returned the same on both backends")
+
+    # a crash before the snapshot: the journal alone has to bring the writes back
+    crashed = os.path.join(directory, 'crashed.db')
+    shutil.copyfile(copies['memory'], crashed)
+    shutil.copyfile(copies['memory'] + '.journal', crashed + '.journal')
+    close_pool(copies['memory']) # takes the snapshot
+    recovered = open_backend(crashed, 'memory', snapshot_interval=None)
+    close_pool(crashed)
+    sqlite_dump = _dump(copies['sqlite'])
+    snapshot_ok = _dump(copies['memory']) == sqlite_dump
+    replay_ok = _dump(crashed) == sqlite_dump
+    print(f"snapshot matches sqlite: {snapshot_ok}, "
+          f"journal replay ({recovered.stats['replayed']} transactions) matches sqlite: {replay_ok}")
+    if differences or not snapshot_ok or not replay_ok:
+        raise SystemExit('The backends differ, see above (and test_backends.py)')
+
+    print(f"{'':26}  {'sqlite':>10}  {'memory':>10}")
+    timings = {}
+    for backend, path in copies.items():
+        open_backend(path, backend, **({'snapshot_interval': None} if backend == 'memory' else {}))
+        students, ccas = Students(path), CCAs(path)
+        members = students._return("""
+            SELECT student_name, cca_name, role FROM 'Students-CCAs'
+            INNER JOIN 'Students' ON 'Students'.'student_id' = 'Students-CCAs'.'student_id'
+            INNER JOIN 'CCAs' ON 'CCAs'.'cca_id' = 'Students-CCAs'.'cca_id'
+            LIMIT ?;""", (calls,), multi=True)
+        timings[backend] = [
+            _per_call(students.get, [(m['student_name'],) for m in members]),
+            _per_call(ccas.get_student, [(m['student_name'],) for m in members]),
+            _per_call(ccas.update_student, [({'student_name': m['student_name'],
+                                              'cca_name': m['cca_name'],
+                                              'role': m['role'] + '!'},) for m in members])]
+        close_pool(path)
+    for i, name in enumerate(['Students.get', 'CCAs.get_student', 'CCAs.update_student']):
+        print(f"{name:26}  {timings['sqlite'][i]:8.1f}us  {timings['memory'][i]:8.1f}us")
+
+
+def bench_adds(dbname, calls, threads=4):
+    """Times adds of new and of existing names, then has threads add the
+    same names at once and counts the rows each name ended up with
+    """
+    classes, ccas, activities = Classes(dbname), CCAs(dbname), Activities(dbname)
+    students = Students(dbname)
+    class_name = classes._return("SELECT class_name FROM 'Classes' LIMIT 1;")['class_name']
+    adds = [
+        ('Classes.add', classes.add, lambda i: {'class_name': f'ADD CLASS {i}', 'level': 'JC1'}),
+        ('Students.add', students.add,
+         lambda i: {'student_name': f'ADD STUDENT {i}', 'age': 17, 'year_enrolled': 2024,
+                    'grad_year': 2025, 'class_name': class_name}),
+        ('CCAs.add', ccas.add, lambda i: {'cca_name': f'ADD CCA {i}', 'type': 'Club'}),
+        ('CCAs.add_student', ccas.add_student,
+         lambda i: {'student_name': f'ADD STUDENT {i}', 'cca_name': f'ADD CCA {i}',
+                    'role': 'Member'}),
+        ('Activities.add', activities.add,
+         lambda i: {'activity_name': f'ADD ACTIVITY {i}', 'start_date': '2024-03-01',
+                    'end_date': None, 'description': 'Benchmark'}),
+        ('Activities.add_student', activities.add_student,
+         lambda i: {'student_name': f'ADD STUDENT {i}', 'activity_name': f'ADD ACTIVITY {i}',
+                    'role': 'Participant', 'award': None, 'hours': 2}),
+    ]
+    print(f"{'':24}  {'new':>10}  {'existing':>10}")
+    for name, method, record in adds:
+        added = _per_call(method, [(record(i),) for i in range(calls)])
+        existing = _per_call(method, [(record(i),) for i in range(calls)])
+        print(f"{name:24}  {added:8.1f}us  {existing:8.1f}us")
+
+    # every thread adds the same names; each must end up added exactly once
+    names = [f'RACE CCA {i}' for i in range(calls)]
+    results, errors = [], []
+    def add_all():
+        for cca_name in names:
+            try:
+                results.append(ccas.add({'cca_name': cca_name, 'type': 'Club'}))
+            except sqlite3.Error as e:
+                errors.append(e)
+    workers = [threading.Thread(target=add_all) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    rows = ccas._return("SELECT COUNT(*) AS n FROM 'CCAs' WHERE cca_name LIKE 'RACE CCA %';")['n']
+    print(f"{threads} threads adding {calls} CCAs: {results.count(None)} added, "
+          f"{results.count(False)} refused, {len(errors)} errors, {rows} rows")
+
+
+def bench_dates(directory, participations):
+    """Times the Activities date-range queries over a school with
+    participations activity records, with and without the date indexes
+    """
+    dbname = os.path.join(directory, 'dates.db')
+    populate(dbname, n_students=participations // 5, n_activities=max(400, participations // 250))
+    unindexed = os.path.join(directory, 'dates-unindexed.db')
+    shutil.copyfile(dbname, unindexed)
+    copies = {'indexed': Activities(dbname), 'unindexed': Activities(unindexed)}
+    # Activities() migrated the copy; drop the indexes it created
+    conn = sqlite3.connect(unindexed)
+    conn.execute("""DROP INDEX "Activities_days";""")
+    conn.execute("""DROP INDEX "Students-Activities_activity_id";""")
+    conn.close()
+    close_pool(unindexed)
+
+    ranges = [('a day', '2022-03-01', None), ('a week', '2022-03-01', '2022-03-07'),
+              ('a term', '2022-03-01', '2022-05-31')]
+    print(f"{participations} participations")
+    print(f"{'':28}  {'rows':>6}  {'indexed':>10}  {'unindexed':>10}")
+    for method in ['get_between', 'get_overlaps', 'get_hours']:
+        for label, start_date, end_date in ranges:
+            timings = {}
+            for name, activities in copies.items():
+                start = time.perf_counter()
+                rows = getattr(activities, method)(start_date, end_date)
+                timings[name] = (time.perf_counter() - start) * 1000
+            print(f"{method + ', ' + label:28}  {len(rows or []):6}"
+                  f"  {timings['indexed']:8.1f}ms  {timings['unindexed']:8.1f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Storage benchmarks on a seeded database')
+    parser.add_argument('benchmark', choices=['ids', 'import', 'memory', 'stream', 'backends', 'adds', 'dates'])
+    parser.add_argument('--students', type=int, default=5000)
+    parser.add_argument('--calls', type=int, default=500)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--classes', type=int, default=80)
+    parser.add_argument('--participations', type=int, default=1000000,
+                        help='activity records of the dates benchmark')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        dbname = os.path.join(directory, 'benchmark.db')
+        populate(dbname, n_students=args.students, n_classes=args.classes)
+        if args.benchmark == 'ids':
+            bench_ids(dbname, args.calls)
+        elif args.benchmark == 'import':
+            bench_import(dbname, args.rows)
+        elif args.benchmark == 'memory':
+            bench_memory(dbname)
+        elif args.benchmark == 'dates':
+            bench_dates(directory, args.participations)
+        elif args.benchmark == 'adds':
+            bench_adds(dbname, args.calls)
+        elif args.benchmark == 'backends':
+            bench_backends(dbname, args.calls)
+        elif args.benchmark == 'stream':
+            bench_stream(dbname, min(args.calls, 50)) # each call sends a whole roster
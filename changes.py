@@ -0,0 +1,28 @@
+import argparse
+import json
+from storage import DBNAME, Changes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read or compact the change log')
+    parser.add_argument('--db', default=DBNAME)
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('since', help='print the changes after a version as JSON lines')
+    command.add_argument('version', type=int)
+    command.add_argument('--limit', type=int, default=500)
+    command = commands.add_parser('compact', help='delete old changes')
+    command.add_argument('--days', type=int, help='delete changes older than this')
+    command.add_argument('--before', type=int, help='delete changes up to this version')
+    args = parser.parse_args()
+    changes = Changes(args.db)
+
+    if args.command == 'since':
+        page = changes.since(args.version, args.limit)
+        if page['resync']:
+            print(f'Changes after {args.version} have been compacted, re-read the tables')
+        for change in page['changes']:
+            print(json.dumps(change))
+    elif args.command == 'compact':
+        if args.days is None and args.before is None:
+            parser.error('compact needs --days and/or --before')
+        deleted = changes.compact(args.before, args.days)
+        print(f'Deleted {deleted} changes, latest version is {changes.version()}')
@@ -0,0 +1,77 @@
+import gzip
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError: # optional: without it responses are only gzipped
+    brotli = None
+
+# types worth compressing; images and downloads are compressed already
+COMPRESSIBLE = {'text/html', 'text/css', 'text/plain', 'text/csv',
+                'application/json', 'application/javascript'}
+MIN_SIZE = 500 # bytes; smaller bodies would hardly shrink
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5 # 11 is for prebuilt files, too slow for every response
+
+
+def _compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def _compress_stream(chunks, encoding):
+    """Yields chunks compressed as one stream. Every chunk is flushed, so
+    what the page has rendered so far reaches the browser without waiting
+    for the rest
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) # 31: gzip header
+        process = compressor.compress
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = process(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def init_app(app):
+    """Compresses text responses with brotli or gzip, whichever the browser
+    prefers of those it accepts. Streamed responses are compressed chunk by
+    chunk as they are generated
+    """
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+    @app.after_request
+    def compress(response):
+        if (response.status_code != 200
+                or response.mimetype not in COMPRESSIBLE
+                or 'Content-Encoding' in response.headers
+                or response.direct_passthrough): # files sent by send_file
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(encodings)
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = _compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < MIN_SIZE:
+                return response
+            response.set_data(_compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,174 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from storage import DBNAME, Changes, ReadModels
+
+STATE = '.export.json' # version and fingerprint of the last run, in the site directory
+# kind -> directory of its pages: view/student/12.html
+PAGE_DIRS = {'Student': 'student', 'Class': 'class', 'CCA': 'cca', 'Activity': 'activity'}
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+
+def page_path(kind, entity_id):
+    """Returns the path of a /view result page in the site: view/student/12.html"""
+    return f'view/{PAGE_DIRS[kind]}/{entity_id}.html'
+
+
+def _write(directory, path, html):
+    """Writes a page unless it is unchanged, through a temporary file so the
+    web server never serves half a page. Returns whether it was written
+    """
+    target = os.path.join(directory, path)
+    content = html.encode()
+    try:
+        with open(target, 'rb') as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target + '.tmp', 'wb') as f:
+        f.write(content)
+    os.replace(target + '.tmp', target)
+    return True
+
+
+def _remove(directory, path):
+    try:
+        os.remove(os.path.join(directory, path))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _load_state(directory):
+    try:
+        with open(os.path.join(directory, STATE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def fingerprint(app):
+    """Returns a hash of what every page looks like apart from its document:
+    the templates, the asset names and the result page headers. A change
+    makes the next export re-render every page
+    """
+    import front
+    digest = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(TEMPLATE_DIR)):
+        for filename in sorted(files):
+            with open(os.path.join(root, filename), 'rb') as f:
+                digest.update(filename.encode() + f.read())
+    digest.update(json.dumps(app.extensions['assets']['manifest'], sort_keys=True).encode())
+    digest.update(json.dumps(front.TABLE_HEADERS, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+def copy_static(app, directory):
+    """Copies the static files, and the fingerprinted assets if they have
+    been built (see assets.py), to where the pages link to them
+    """
+    dist_dir = app.extensions['assets']['dist_dir']
+    shutil.copytree(app.static_folder, os.path.join(directory, 'static'), dirs_exist_ok=True,
+                    ignore=shutil.ignore_patterns(os.path.basename(dist_dir)))
+    if os.path.isdir(dist_dir):
+        shutil.copytree(dist_dir, os.path.join(directory, 'assets'), dirs_exist_ok=True)
+
+
+def export(directory, dbname=DBNAME, full=False):
+    """Pre-renders every /view result page (view/<kind>/<id>.html), an index
+    of each kind, the home page of the mirror and help.html into directory,
+    which a web server can serve as a read-only copy of the site without
+    the app: the search and edit forms in the shared header still need the
+    app behind them.
+
+    Pages are rendered from the ReadModels documents with the app's
+    templates. After the first run only the pages of the entities changed
+    since the last one (read from the Changes feed) are re-rendered, unless
+    full is set, the templates have changed or the changes have been
+    compacted away. Pages whose entity is gone are removed.
+
+    Returns {'full', 'pages', 'written', 'removed', 'seconds', 'pages_per_second'}
+    """
+    import front
+    from flask import render_template
+    app = front.app
+    read_models = ReadModels(dbname)
+    state = _load_state(directory)
+    stamp = fingerprint(app)
+    start = time.perf_counter()
+
+    pages = None
+    if not full and state.get('fingerprint') == stamp and 'version' in state:
+        pages, version = read_models.changed_pages(state['version'])
+    if pages is None:
+        version = Changes(dbname).version()
+    # the documents are then at least as new as version
+    read_models.refresh()
+
+    stats = {'full': pages is None, 'pages': 0, 'written': 0, 'removed': 0}
+    os.makedirs(directory, exist_ok=True)
+    with app.test_request_context('/view'):
+        rendered = set()
+        for kind, entity_id, name, doc in read_models.documents(pages):
+            html = render_template('view.html', choices=[], page_type='result',
+                                   form_meta={}, form_data={}, data=doc['data'],
+                                   title=f'{kind}: {name}', choice='', key=kind, error='',
+                                   suggestions=[], table_header=front.TABLE_HEADERS[kind],
+                                   list_of_dicts=front.result_lists(kind, doc),
+                                   list_header=front.CLASS_LIST_HEADER if kind == 'Class' else ())
+            path = page_path(kind, entity_id)
+            rendered.add(path)
+            stats['pages'] += 1
+            stats['written'] += _write(directory, path, html)
+
+        if pages is None:
+            kinds = set(PAGE_DIRS)
+            for kind, page_dir in PAGE_DIRS.items():
+                kind_dir = os.path.join(directory, 'view', page_dir)
+                if os.path.isdir(kind_dir):
+                    for filename in os.listdir(kind_dir):
+                        path = f'view/{page_dir}/{filename}'
+                        if filename != 'index.html' and path not in rendered:
+                            stats['removed'] += _remove(directory, path)
+        else:
+            kinds = {kind for kind, _ in pages}
+            for kind, entity_id in pages:
+                if page_path(kind, entity_id) not in rendered:
+                    stats['removed'] += _remove(directory, page_path(kind, entity_id))
+
+        # the indexes list every name, so a changed page can change its index
+        for kind in kinds:
+            links = [(f'/{page_path(kind, entity_id)}', name)
+                     for entity_id, name in read_models.names(kind)]
+            html = render_template('site_index.html', title=f'{kind} pages', links=links)
+            stats['written'] += _write(directory, f'view/{PAGE_DIRS[kind]}/index.html', html)
+        links = [(f'/view/{page_dir}/index.html', kind) for kind, page_dir in PAGE_DIRS.items()]
+        links.append(('/help.html', 'Help'))
+        stats['written'] += _write(directory, 'index.html',
+                                   render_template('site_index.html', title='View', links=links))
+        stats['written'] += _write(directory, 'help.html', front.help())
+    copy_static(app, directory)
+
+    with open(os.path.join(directory, STATE + '.tmp'), 'w') as f:
+        json.dump({'version': version, 'fingerprint': stamp}, f)
+    os.replace(os.path.join(directory, STATE + '.tmp'), os.path.join(directory, STATE))
+    stats['seconds'] = time.perf_counter() - start
+    stats['pages_per_second'] = stats['pages'] / stats['seconds'] if stats['seconds'] else 0
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-render the /view pages into a static site')
+    parser.add_argument('--db', default=DBNAME)
+    parser.add_argument('--out', default='site', help='directory the web server serves')
+    parser.add_argument('--full', action='store_true', help='re-render every page')
+    args = parser.parse_args()
+
+    stats = export(args.out, args.db, args.full)
+    print(f"{'Full' if stats['full'] else 'Incremental'} export: rendered {stats['pages']} pages "
+          f"in {stats['seconds']:.2f}s ({stats['pages_per_second']:.0f} pages/s), "
+          f"{stats['written']} files written, {stats['removed']} removed")
@@ -1,70 +1,127 @@
-from flask import Flask, render_template, request
-from datetime import datetime
-from storage import Students, Classes, Subjects, CCAs, Activities
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+import warnings
+import pandas as pd
+import archive
+import assets
+import compression
+import maintenance
+import memprofile
+import profiling
+import readmodels
+from flask import Flask, abort, g, jsonify, render_template, request, stream_template
+from fuzzy import FuzzySearch
+from storage import DBNAME, Router, Students, Classes, Subjects, CCAs, Activities, Changes, ReadModels, iso_date
+from validation import has_error, activity_error, validate_activities, validate_date
 
 classes = Classes()
 subjects = Subjects()
 ccas = CCAs()
 activities = Activities()
 students = Students()
+changes = Changes()
+read_models = ReadModels()
+archived_models = {} # archive database -> its ReadModels
+search = FuzzySearch()
 
 app = Flask(__name__)
+# SECRET_KEY signs the /edit confirmation tokens (see sign). Every worker
+# process must be given the same one: without it each process makes up its
+# own, and a token issued by another process, or before a restart, is refused
+app.secret_key = os.environ.get('SECRET_KEY')
+if not app.secret_key:
+    warnings.warn('SECRET_KEY is not set: /edit tokens will only be accepted by the process '
+                  'that issued them, until it restarts. Set it when running several workers')
+    app.secret_key = os.urandom(32)
+# CCA_TOKEN_MAX_AGE is how many seconds an /edit confirmation token stays valid
+app.config['TOKEN_MAX_AGE'] = int(os.environ.get('CCA_TOKEN_MAX_AGE') or 3600)
+app.config['STREAM_TEMPLATES'] = True
+# CCA_SEARCH_ARCHIVE=1 looks students who are not found up in the archive (see archive.py)
+app.config['SEARCH_ARCHIVE'] = os.environ.get('CCA_SEARCH_ARCHIVE') == '1'
+# CCA_MEMORY_PROFILE=0.1 measures the memory of one request in ten (see memprofile.py)
+app.config['MEMORY_PROFILE'] = float(os.environ.get('CCA_MEMORY_PROFILE') or 0)
+# CCA_REQUEST_PROFILE=0.01 profiles one request in a hundred; requests sent with
+# X-Profile and the admin token are always profiled (see profiling.py)
+app.config['REQUEST_PROFILE'] = float(os.environ.get('CCA_REQUEST_PROFILE') or 0)
+# CCA_READ_MODELS_POLL=2 refreshes the /view documents when the app starts and
+# then every 2 seconds, picking up writes made outside the app. Without it they
+# follow the app's own writes only, until readmodels.start(app) is called (see
+# main.py) or `python readmodels.py follow` runs next to the app
+app.config['READ_MODELS_POLL'] = float(os.environ.get('CCA_READ_MODELS_POLL') or 0)
+# CCA_MAINTENANCE=1 runs the database maintenance tasks in the background
+# while no request is served, logging to CCA_MAINTENANCE_LOG (see maintenance.py)
+app.config['MAINTENANCE'] = os.environ.get('CCA_MAINTENANCE') == '1'
+app.config['MAINTENANCE_LOG'] = os.environ.get('CCA_MAINTENANCE_LOG')
+# CCA_TRUSTED_PROXY=1 takes the school from the X-School header, which only a
+# proxy that sets it on every request (and drops the client's) may be trusted with
+app.config['TRUSTED_PROXY'] = os.environ.get('CCA_TRUSTED_PROXY') == '1'
+# CCA_ADMIN_TOKEN is the X-Admin-Token of the /admin pages; without it they are not served
+app.config['ADMIN_TOKEN'] = os.environ.get('CCA_ADMIN_TOKEN')
+assets.init_app(app)
+compression.init_app(app)
+memprofile.init_app(app)
+profiling.init_app(app)
+
+# CCA_SHARD_DIR holds one database per school (see storage.Router);
+# without it every request uses the single default database
+router = Router(os.environ['CCA_SHARD_DIR']) if os.environ.get('CCA_SHARD_DIR') else None
+
+
+def databases():
+    """Returns the database files the app serves: every shard, or the default one"""
+    if router is None:
+        return [DBNAME]
+    return [router.dbname(school) for school in router.schools()]
+
+
+def read_model_databases():
+    """Returns the databases whose /view documents the app looks up: its
+    own, and their archives if archived students are searched
+    """
+    dbnames = databases()
+    if app.config['SEARCH_ARCHIVE']:
+        dbnames += [path for path in map(archive.archive_name, dbnames) if os.path.exists(path)]
+    return dbnames
 
 
-def validate_date(start_date: str, end_date=''):
-    """
-    Validate a given dates based on ISO 8601 YYYY-MM-DD format
-    Start date must be before end_date
+maintenance.init_app(app, databases)
+readmodels.init_app(app, read_model_databases)
+
+
+def school_of(request):
+    """Returns the school a request is for: the first label of the host name
+    (nyjc.example.com -> nyjc), or the X-School header if it was set by a
+    trusted proxy (app.config['TRUSTED_PROXY'])
     """
-    #strip the dates
-    start_date = start_date.strip()
-    end_date = end_date.strip()
-    
-    #check for start date
-    format = "%Y-%m-%d"
-    try:
-        res1 = datetime.strptime(start_date, format)
-    except ValueError:
-        res1 = False
-    
-    #check for end date if it is not empty
-    if end_date != '':
-        try:
-            res2 = datetime.strptime(end_date, format)
-        except ValueError:
-            res2 = False
-    else:
-        res2 = True
-
-    if res1 and res2:
-        #check if start_date is later than end_date
-        if end_date != '' and (res1 > res2):
-            return False
-        
-        #check for end date if it is not empty
-        if end_date != '':
-            year, month, day = end_date.split('-')
-            if len(year) != 4 or len(month) != 2 or len(day) != 2:
-                return False
-        
-        #check length for start date
-        year, month, day = start_date.split('-')
-        if len(year) == 4 and len(month) == 2 and len(day) == 2:
-            return True
-        
-    return False
-
-
-def has_error(data: dict):
+    school = request.headers.get('X-School') if app.config['TRUSTED_PROXY'] else None
+    return school or request.host.split(':')[0].split('.')[0]
+
+
+@app.before_request
+def select_shard():
     '''
-    Returns an error message for the last value that is empty, otherwise returns an empty string
-    Exception for end date, award and hours which are optional
+    routes the request's queries to its school's database
     '''
-    for key, value in data.items():
-        #end date, award and hours can be empty
-        if value == '' and key not in ['End Date', 'Award', 'Hours']:
-            return f'Please do not leave the {key} empty.'
-    return ''
+    g.school = None
+    if router is None:
+        return
+    school = school_of(request).lower()
+    try:
+        g.shard_token = router.select(school)
+    except KeyError:
+        abort(404)
+    g.school = school
+
+
+@app.teardown_request
+def reset_shard(error):
+    token = g.pop('shard_token', None)
+    if token is not None:
+        router.reset(token)
 
 
 def strip(data: dict):
@@ -73,6 +130,127 @@ def strip(data: dict):
         data[key] = value.strip()
     return data
 
+
+def require_admin():
+    """Aborts with a 404 unless the request has the admin token"""
+    token = app.config['ADMIN_TOKEN']
+    # as bytes: headers are decoded as latin-1, and compare_digest only takes ASCII str
+    if not token or not hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode(),
+                                            token.encode()):
+        abort(404)
+
+
+def _signature(payload: str):
+    """Returns the HMAC-SHA256 of payload keyed with the app secret key"""
+    key = app.secret_key
+    if isinstance(key, str):
+        key = key.encode()
+    return hmac.new(key, payload.encode(), hashlib.sha256).hexdigest()
+
+
+def sign(data: dict):
+    """Returns data as a token signed with the app secret key, stamped with
+    the time it was issued at
+    """
+    data = {**data, 'issued': int(time.time())}
+    payload = base64.urlsafe_b64encode(json.dumps(data, sort_keys=True).encode()).decode()
+    return f'{payload}.{_signature(payload)}'
+
+
+def unsign(token: str):
+    """Returns the data in a token made by sign(), or None if it was tampered
+    with or is older than app.config['TOKEN_MAX_AGE'] seconds
+    """
+    payload, _, signature = token.partition('.')
+    expected = _signature(payload)
+    # as bytes: compare_digest only takes ASCII str, and the token comes from the client
+    if not hmac.compare_digest(signature.encode(), expected.encode()):
+        return None
+    data = json.loads(base64.urlsafe_b64decode(payload.encode()))
+    if time.time() - data.get('issued', 0) > app.config['TOKEN_MAX_AGE']:
+        return None
+    return data
+
+def did_you_mean(tblname, name):
+    """Returns the names in tblname closest to a name that was not found"""
+    if name.strip() == '':
+        return []
+    return [match for match, _ in search.search(tblname, name)]
+
+def archived_student(name):
+    """Returns the page document of an archived student, or False"""
+    path = archive.archive_name(read_models._dbname)
+    if not os.path.exists(path):
+        return False
+    if path not in archived_models:
+        archived_models[path] = ReadModels(path)
+    return archived_models[path].get('Student', name)
+
+# the fields of each kind of /view result page
+TABLE_HEADERS = {'Student': {'student_name': 'Student Name',
+                             'age': 'Age',
+                             'year_enrolled': 'Year Enrolled',
+                             'grad_year': 'Graduation Year',
+                             'class_name': 'Class',
+                             'student_id': 'Student ID'},
+                 'Class': {'class_name': 'Class',
+                           'level': 'Level',
+                           'class_id': 'Class ID'},
+                 'CCA': {'cca_name': 'CCA Name',
+                         'type': 'Type',
+                         'cca_id': 'CCA ID'},
+                 'Activity': {'activity_name': 'Activity Name',
+                              'start_date': 'Start Date',
+                              'end_date': 'End Date',
+                              'description': 'Description',
+                              'activity_id': 'Activity ID'}}
+CLASS_LIST_HEADER = ('Student ID', 'Student Name')
+
+def result_lists(kind, doc):
+    """Returns the tables of the /view result page of a ReadModels document,
+    as [[title, rows or False, headers], ...]
+    """
+    # info = [{'subj_name':'gp', 'subj_lvl': 'h1'}, {}]
+    if kind == 'Student':
+        return [['Subjects', doc['lists']['Subjects'], ('Subject', 'Level')],
+                ['CCAs', doc['lists']['CCAs'], ('CCA', 'Role')],
+                ['Activities', doc['lists']['Activities'], ('Activity', 'Role', 'Award', 'Hours')]]
+    if kind == 'Class':
+        return [['Class List', doc['lists']['Class List'], CLASS_LIST_HEADER]]
+    return []
+
+def stream_page(file, chunk_size=8192, **context):
+    """Renders a template while it is being sent: rows from streamed
+    getters are read as the page reaches them, and the page goes out in
+    chunks of about chunk_size characters. Falls back to render_template
+    if app.config['STREAM_TEMPLATES'] is False.
+
+    The /view result pages, the class roster included, come from one
+    ReadModels document that is read and parsed whole, so only their HTML
+    is streamed: a roster is held in memory while it renders, in exchange
+    for one indexed lookup instead of a join per page
+    """
+    if not app.config['STREAM_TEMPLATES']:
+        return render_template(file, **context)
+    # keeps the request context until the page is sent
+    pieces = stream_template(file, **context)
+    def chunks():
+        # the template yields a piece per tag and value, too small to send one by one
+        buffer = []
+        size = 0
+        try:
+            for piece in pieces:
+                buffer.append(piece)
+                size += len(piece)
+                if size >= chunk_size:
+                    yield ''.join(buffer)
+                    buffer = []
+                    size = 0
+            yield ''.join(buffer)
+        finally:
+            pieces.close() # ends the request if the client goes away mid-page
+    return app.response_class(chunks(), mimetype='text/html')
+
 @app.route('/')
 def index():
     '''
@@ -118,14 +296,10 @@ def add():
         tdtype = 'text'
         button = 'Submit'
         form_data = strip(dict(request.form))
-        error = has_error(form_data) 
         if 'Description' in form_data.keys():  # validate date if activity
-            start_date = form_data['Start Date']
-            end_date = form_data['End Date']
-            if not validate_date(start_date, end_date):
-                error = 'Please ensure the date is in the correct format (YYYY-MM-DD).'
-                if end_date != '':
-                    error += ' Start Date should also be before End Date.'
+            error = activity_error(form_data)
+        else:
+            error = has_error(form_data)
 
         if error:  # if there is an error, return to new form page
             form_meta = {'action': '/add?confirm', 'method': 'post'}
@@ -170,11 +344,73 @@ def add():
                            error=error)
 
 
+def read_upload(file):
+    """Reads an uploaded CSV or Excel file into a DataFrame of strings"""
+    if file.filename.lower().endswith(('.xlsx', '.xls')):
+        df = pd.read_excel(file)
+        # dates typed into Excel come back as timestamps
+        for column in df.select_dtypes(include='datetime').columns:
+            df[column] = df[column].dt.strftime('%Y-%m-%d')
+        return df.fillna('').astype(str)
+    return pd.read_csv(file, dtype=str, keep_default_na=False)
+
+
+@app.route('/add/bulk', methods=['GET', 'POST'])
+def add_bulk():
+    page_type = 'new'
+    title = 'Upload a CSV or Excel file of Activities'
+    form_meta = {'action': '/add/bulk', 'method': 'post'}
+    columns = ['Name', 'Start Date', 'Description', 'End Date']
+    summary = {}
+    errors = []
+    error = ''
+
+    if request.method == 'POST':
+        file = request.files.get('file')
+        if not file or file.filename == '':
+            error = 'Please choose a file to upload.'
+        else:
+            try:
+                df = read_upload(file)
+            except ImportError:
+                error = 'Excel files cannot be read on this server, please upload a CSV file.'
+            except (ValueError, UnicodeDecodeError):
+                error = 'The file could not be read, please upload a CSV or Excel file.'
+
+        if not error:
+            df = validate_activities(df)
+            valid = df[df['Error'] == '']
+            res = activities.add_many([{'activity_name': row['Name'],
+                                        'start_date': row['Start Date'],
+                                        'description': row['Description'],
+                                        'end_date': row['End Date']}
+                                       for row in valid.to_dict('records')])
+            exists = valid.index[[r is False for r in res]]
+            df.loc[exists, 'Error'] = 'The Activity ' + df.loc[exists, 'Name'] + ' already exists'
+
+            failed = df[df['Error'] != '']
+            page_type = 'result'
+            title = 'Upload complete!'
+            summary = {'Rows': len(df), 'Added': len(df) - len(failed), 'Not Added': len(failed)}
+            # row numbers as shown in a spreadsheet (row 1 is the header)
+            errors = [{'Row': i + 2, 'Name': row['Name'], 'Error': row['Error']}
+                      for i, row in zip(failed.index, failed.to_dict('records'))]
+
+    return render_template('bulk.html',
+                           page_type=page_type,
+                           title=title,
+                           form_meta=form_meta,
+                           columns=columns,
+                           summary=summary,
+                           errors=errors,
+                           error=error)
+
+
 @app.route('/view', methods=['GET', 'POST'])
 def view():
     page_type = 'new'
     title = 'What would you like to view?'
-    choices = ['Student', 'Class', 'CCA', 'Activity']
+    choices = ['Student', 'Class', 'CCA', 'Activity', "What's On"]
     form_meta = {'action': '/view?view', 'method': 'get'}
     form_data = {'choice': ''}
     table_header = {}
@@ -184,6 +420,7 @@ def view():
     key = ''
     file = 'view.html'
     error = ''
+    suggestions = []
     list_of_dicts = [] # contain the additional tables 
                        #list of lists; one element inside is [header, data:dict]
 
@@ -191,87 +428,109 @@ def view():
         choice = request.args.get('choice')
         page_type = 'search'
         title = f'Which {choice} you would like to search for?'
+        if choice == "What's On":
+            title = 'Which dates would you like to see the activities of?'
         ## .get the appropriate data from idk where juan pls help
         form_meta = {'action': '/view?searched', 'method': 'post'}
 
-    if 'searched' in request.args:
+    if 'searched' in request.args and 'From' in request.form:
+        # activities running between two dates, see Activities.get_between
+        key = "What's On"
+        form_data = dict(request.form)
+        # 2024-3-1 -> 2024-03-01, as the dates are stored
+        start_date = iso_date(form_data['From'].strip())
+        end_date = iso_date(form_data.get('To', '').strip()) or start_date
+        running = False
+        if not validate_date(start_date, end_date):
+            error = 'Please ensure the date is in the correct format (YYYY-MM-DD). From should also be before To.'
+        else:
+            running = activities.get_between(start_date, end_date)
+            if not running:
+                error = f'There are no activities between {start_date} and {end_date}'
+        if running:
+            title = f"What's on from {start_date} to {end_date}"
+            page_type = 'result'
+            data = {'start_date': start_date, 'end_date': end_date}
+            table_header = {'start_date': 'From', 'end_date': 'To'}
+            list_of_dicts.append(['Activities',
+                                  [{'activity_name': row['activity_name'],
+                                    'start_date': row['start_date'],
+                                    'end_date': row['end_date'],
+                                    'participants': row['participants']} for row in running],
+                                  ('Activity', 'Start Date', 'End Date', 'Participants')])
+            overlaps = activities.get_overlaps(start_date, end_date)
+            if overlaps:
+                list_of_dicts.append(['Overlapping Activities',
+                                      [{'student_name': row['student_name'],
+                                        'activity_name': row['activity_name'],
+                                        'other_activity_name': row['other_activity_name'],
+                                        'overlap_start': row['overlap_start'],
+                                        'overlap_end': row['overlap_end']} for row in overlaps],
+                                      ('Student Name', 'Activity', 'Overlaps With', 'From', 'To')])
+            hours = activities.get_hours(start_date, end_date)
+            if hours:
+                list_of_dicts.append(['Hours Logged',
+                                      [{'student_name': row['student_name'],
+                                        'activities': row['activities'],
+                                        'hours': row['hours']} for row in hours],
+                                      ('Student Name', 'Activities', 'Hours')])
+        else:
+            page_type = 'search'
+            choice = key
+            title = 'Which dates would you like to see the activities of?'
+            form_meta = {'action': '/view?searched', 'method': 'post'}
+
+    elif 'searched' in request.args:
         # get data from databases, data u get will be a dictionary, use the search method
         key = list(request.form.keys())[0]
         form_data = dict(request.form)
         # key is Student Class CCA or Activity
-        if key == 'Student':
-            table_header = {'student_name': 'Student Name',
-                            'age': 'Age',
-                            'year_enrolled': 'Year Enrolled',
-                           'grad_year': 'Graduation Year',
-                           'class_name': 'Class',
-                           'student_id': 'Student ID'}
-            data = students.get(form_data[key])
-            name = form_data['Student'].strip()
-
-            #check if student has any ccas or activities at all
-            #then on webpage print 'There are no CCAs/Activities linked to this student'
-            list_of_dicts.append(['Subjects', 
-                                  subjects.get_student(name), 
-                                 ('Subject', 'Level')])
-            list_of_dicts.append(['CCAs', 
-                                  ccas.get_student(name),
-                                 ('CCA', 'Role')])
-            list_of_dicts.append(['Activities', 
-                                  activities.get_student(name),
-                                  ('Activity', 'Role', 'Award', 'Hours')])
-
-        # info = [{'subj_name':'gp', 'subj_lvl': 'h1'}, {}]
-            
-        elif key == 'Class':
-            name = form_data['Class'].strip()
-            table_header = {'class_name': 'Class',
-                            'level': 'Level',
-                           'class_id': 'Class ID'}
-            list_header = ('Student ID', 'Student Name')
-            data = classes.get_info(form_data[key])
-            list_of_dicts.append(['Class List', classes.get(name), list_header])
-            
-        elif key == 'CCA':
-            name = form_data[key].strip()
-            table_header = {'cca_name': 'CCA Name',
-                            'type': 'Type',
-                           'cca_id': 'CCA ID'}
-            data = ccas.get(name)
-            
-        else:
-            name = form_data[key].strip()
-            table_header = {'activity_name': 'Activity Name',
-                            'start_date': 'Start Date',
-                           'end_date': 'End Date',
-                           'description': 'Description',
-                           'activity_id': 'Activity ID'}
-            data = activities.get(name)
+        # each page is one precomputed document (see storage.ReadModels)
+        name = form_data[key].strip()
+        kind = key if key in ReadModels.KINDS else 'Activity'
+        doc = read_models.get(kind, name)
+        archived = False
+        if not doc and key == 'Student' and app.config['SEARCH_ARCHIVE']:
+            doc = archived_student(name)
+            archived = bool(doc)
+        data = doc['data'] if doc else False
+        table_header = TABLE_HEADERS[kind]
+        if key == 'Class':
+            list_header = CLASS_LIST_HEADER
+        #check if student has any ccas or activities at all
+        #then on webpage print 'There are no CCAs/Activities linked to this student'
+        if doc:
+            list_of_dicts.extend(result_lists(kind, doc))
 
         if data and name != '': # if in database
-            title = f'{key}: {form_data[key]}'
+            title = f'{key}: {form_data[key]}' + (' (graduated, archived)' if archived else '')
             page_type = 'result'
             # get from database
         else:  # if not in database, user will re-enter the form
             page_type = 'search'
             error = f'{key} does not exist'
+            tblname = {'Student': 'Students', 'Class': 'Classes',
+                       'CCA': 'CCAs', 'Activity': 'Activities'}[key]
+            suggestions = did_you_mean(tblname, form_data[key])
             choice = key
             title = f'Which {key} you would like to search for?'
             form_meta = {'action': '/view?searched', 'method': 'post'}
 
-    return render_template(file,
-                           choices=choices,
-                           page_type=page_type,
-                           form_meta=form_meta,
-                           form_data=form_data,
-                           data=data,
-                           title=title,
-                           choice=choice,
-                           key=key,
-                           error=error,
-                           table_header=table_header,
-                           list_of_dicts=list_of_dicts,
-                           list_header=list_header)
+    # sent in chunks as it renders, see stream_page
+    return stream_page(file,
+                       choices=choices,
+                       page_type=page_type,
+                       form_meta=form_meta,
+                       form_data=form_data,
+                       data=data,
+                       title=title,
+                       choice=choice,
+                       key=key,
+                       error=error,
+                       suggestions=suggestions,
+                       table_header=table_header,
+                       list_of_dicts=list_of_dicts,
+                       list_header=list_header)
 
 
 @app.route('/edit', methods=['GET', 'POST'])
@@ -291,6 +550,8 @@ def edit():
     type = ''
     action = 'remove'
     tdtype = 'text'
+    token = ''
+    suggestions = {}
 
     if request.args.get('choice') in choices:
         choice = request.args.get('choice')
@@ -320,60 +581,79 @@ def edit():
         error = has_error(form_data)
         type = 'Activity' if 'Activity' in form_data.keys() else 'CCA'
 
-        if error == '':
-            if type == 'Activity' and action == 'add':
-                # there is no student in specified activity
-                if activities.get_student(form_data['Student Name'], form_data['Activity']): 
-                    error = 'Student already exists'
-                elif not activities.get(form_data['Activity']):
-                    error = 'Activity does not exist'
-                elif not students.get(form_data['Student Name']):
-                    error = 'Student does not exist'
-            elif type == 'Activity' and action != 'add':
-                if not activities.get_student(form_data['Student Name'], form_data['Activity']):
-                    error = 'Student does not exist'
-            elif type == 'CCA' and action == 'add':
-                # there is no student in specified activity
-                if ccas.get_student(form_data['Student Name'], form_data['CCA']): 
+        # resolve the student and the CCA/Activity once; their ids are
+        # carried to the success step in a signed token
+        ids = {}
+        if error == '' and action == 'add':
+            student = students.get(form_data['Student Name'])
+            if type == 'Activity':
+                entity = activities.get(form_data['Activity'])
+            else:
+                entity = ccas.get(form_data['CCA'])
+            if not entity:
+                error = f'{type} does not exist'
+            elif not student:
+                error = 'Student does not exist'
+            else:
+                ids['student_id'] = student['student_id']
+                if type == 'Activity':
+                    ids['activity_id'] = entity['activity_id']
+                    record = activities.get_student_by_id(ids['student_id'], ids['activity_id'])
+                else:
+                    ids['cca_id'] = entity['cca_id']
+                    record = ccas.get_student_by_id(ids['student_id'], ids['cca_id'])
+                if record:
                     error = 'Student already exists'
-                elif not ccas.get(form_data['CCA']):
-                    error = 'CCA does not exist'
-                elif not students.get(form_data['Student Name']):
-                    error = 'Student does not exist'
-            elif type == 'CCA' and action != 'add':
-                if not ccas.get_student(form_data['Student Name'], form_data['CCA']):
-                    error = 'Student does not exist'
+        elif error == '':
+            if type == 'Activity':
+                record = activities.get_student(form_data['Student Name'], form_data['Activity'])
+            else:
+                record = ccas.get_student(form_data['Student Name'], form_data['CCA'])
+            if not record:
+                error = 'Student does not exist'
+            else:
+                record = record[0]
+                ids['student_id'] = record['student_id']
+                if type == 'Activity':
+                    ids['activity_id'] = record['activity_id']
+                else:
+                    ids['cca_id'] = record['cca_id']
                 
         if error:
             form_meta = {'action': '/edit?searched', 'method': 'post'}
             tdtype = 'text'
             page_type = 'search'
+            if error.endswith('does not exist'):
+                # suggest names for the fields that match nothing at all
+                for field, collection in [('Student Name', students),
+                                          (type, activities if type == 'Activity' else ccas)]:
+                    name = form_data[field]
+                    if collection.resolve_ids([name], like=True)[name] is False:
+                        suggestions[field] = did_you_mean(collection._tblname, name)
             title = f'Which student do you want to {action} from the {type}?' if action != 'add' else f'Which student do you want to {action} to the {type}?'
         else:
             if action != 'add':
-                name = request.form['Student Name']
-                
                 if type == 'Activity':
-                    record = activities.get_student(name, request.form[type])[0]
+                    form_data['Activity'] = record['activity_name']
                     form_data['Award'] = record['award']
                     form_data['Hours'] = record['hours']  
                 else:
-                    record = ccas.get_student(name, request.form[type])[0]
                     form_data['CCA'] = record['cca_name']
                 form_data['Student Name'] = record['student_name']
                 form_data['Role'] = record['role']
                     
             form_meta = {'action': '/edit?success', 'method': 'post'}
+            token = sign({'action': action, 'type': type, 'school': g.school, **ids})
 
             if action == 'add':
                 title = 'Are you sure you want to add the following record?'
                 tdtype = 'hidden'
                 #get the correct values for the confirm page
                 if type == 'Activity':
-                    form_data['Activity'] = activities.get(form_data['Activity'])['activity_name']
+                    form_data['Activity'] = entity['activity_name']
                 else:
-                    form_data['CCA'] = ccas.get(form_data['CCA'])['cca_name']
-                form_data['Student Name'] = students.get(form_data['Student Name'])['student_name']
+                    form_data['CCA'] = entity['cca_name']
+                form_data['Student Name'] = student['student_name']
             elif action == 'edit':
                 title = 'Please edit the following details'
             else:
@@ -384,44 +664,53 @@ def edit():
         action = request.form['action']
         form_data = dict(request.form)
         form_data.pop('action')
+        ids = unsign(form_data.pop('token', ''))
         type = 'CCA' if 'CCA' in form_data.keys() else 'Activity'
 
-        if type == 'Activity':
-            record = {'activity_name': form_data['Activity'],
-                     'student_name': form_data['Student Name'],
-                     'role': form_data['Role'],
-                     'award': form_data['Award'],
-                     'hours': form_data['Hours']}
+        # a token is only valid for the school it was issued by
+        if (ids is None or ids['action'] != action or ids['type'] != type
+                or ids.get('school') != g.school):
+            error = 'This record could not be verified, please search for it again.'
+            form_meta = {'action': '/edit?searched', 'method': 'post'}
+            page_type = 'search'
+            title = f'Which student do you want to {action} from the {type}?' if action != 'add' else f'Which student do you want to {action} to the {type}?'
         else:
-            record = {'cca_name': form_data['CCA'],
-                     'student_name': form_data['Student Name'],
-                     'role': form_data['Role']}
-        
-        if action == 'add': # add form_data into database
-            word = 'added'
             if type == 'Activity':
-                activities.add_student(record) 
+                record = {'activity_id': ids['activity_id'],
+                         'student_id': ids['student_id'],
+                         'role': form_data['Role'],
+                         'award': form_data['Award'],
+                         'hours': form_data['Hours']}
             else:
-                ccas.add_student(record) 
+                record = {'cca_id': ids['cca_id'],
+                         'student_id': ids['student_id'],
+                         'role': form_data['Role']}
             
-        elif action == 'edit': # edit new data
-            word = 'edited'
-            if type == 'Activity':
-                activities.update_student(record)
-            else:
-                ccas.update_student(record)
-        
-        elif action == 'remove': # remove from database
-            word = 'removed'
-            if type == 'Activity':
-                activities.delete_student(form_data['Student Name'], 
-                                          form_data['Activity'])
-            else:
-                ccas.delete_student(form_data['Student Name'],
-                                    form_data['CCA'])
+            if action == 'add': # add form_data into database
+                word = 'added'
+                if type == 'Activity':
+                    activities.add_student_by_id(record) 
+                else:
+                    ccas.add_student_by_id(record) 
+                
+            elif action == 'edit': # edit new data
+                word = 'edited'
+                if type == 'Activity':
+                    activities.update_student_by_id(record)
+                else:
+                    ccas.update_student_by_id(record)
             
-        page_type = 'success'
-        title = f'The following record has been {word}!'
+            elif action == 'remove': # remove from database
+                word = 'removed'
+                if type == 'Activity':
+                    activities.delete_student_by_id(ids['student_id'], 
+                                                    ids['activity_id'])
+                else:
+                    ccas.delete_student_by_id(ids['student_id'],
+                                              ids['cca_id'])
+                
+            page_type = 'success'
+            title = f'The following record has been {word}!'
 
     return render_template('edit.html',
                            page_type=page_type,
@@ -433,7 +722,79 @@ def edit():
                            error=error,
                            form_data=form_data,
                            action=action,
-                           tdtype=tdtype)
+                           tdtype=tdtype,
+                           token=token,
+                           suggestions=suggestions)
+
+@app.route('/changes', methods=['GET'])
+def changes_feed():
+    '''
+    returns the changes after ?since=<version> as JSON, at most ?limit=
+    (up to 1000) per page; follow 'version' while 'more' is true
+    '''
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(int(request.args.get('limit', 500)), 1000)
+    except ValueError:
+        abort(400)
+    if since < 0 or limit < 1:
+        abort(400)
+    return jsonify(changes.since(since, limit))
+
+
+@app.route('/admin/memory', methods=['GET'])
+def memory_report():
+    '''
+    returns the memory measured per route and per query, and the allocation
+    sites of the worst requests, as JSON; ?reset=1 starts over afterwards
+    '''
+    require_admin()
+    recorder = app.extensions['memprofile']
+    if recorder is None:
+        abort(404)
+    report = recorder.report()
+    if request.args.get('reset') == '1':
+        recorder.reset()
+    return jsonify(report)
+
+
+@app.route('/admin/maintenance', methods=['GET'])
+def maintenance_reports():
+    '''
+    returns the latest database maintenance reports as JSON
+    '''
+    require_admin()
+    scheduler = app.extensions['maintenance']
+    if scheduler is None:
+        abort(404)
+    return jsonify(scheduler.reports())
+
+
+@app.route('/admin/profiles', methods=['GET'])
+def profile_list():
+    '''
+    returns the latest request profiles, with their route, wizard step and
+    time spent in queries, as JSON
+    '''
+    require_admin()
+    profiler = app.extensions['profiling']
+    if profiler is None:
+        abort(404)
+    return jsonify(profiler.profiles())
+
+
+@app.route('/admin/profiles/<int:profile_id>', methods=['GET'])
+def profile_stacks(profile_id):
+    '''
+    returns the collapsed stacks of a request profile, for flamegraph.pl or speedscope
+    '''
+    require_admin()
+    profiler = app.extensions['profiling']
+    stacks = profiler.stacks(profile_id) if profiler is not None else None
+    if stacks is None:
+        abort(404)
+    return app.response_class(stacks, mimetype='text/plain')
+
 
 @app.errorhandler(404)
 def page_not_found(error):
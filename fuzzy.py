@@ -0,0 +1,348 @@
+import argparse
+import random
+import threading
+import time
+from storage import Changes, Collection, normalize
+
+try:
+    from rapidfuzz.distance import Levenshtein as _levenshtein
+except ImportError: # optional: the pure Python distance below is used instead
+    _levenshtein = None
+
+# table -> (id column, name column) of the searchable entities
+ENTITIES = {'Students': ('student_id', 'student_name'),
+            'Classes': ('class_id', 'class_name'),
+            'CCAs': ('cca_id', 'cca_name'),
+            'Activities': ('activity_id', 'activity_name')}
+
+
+def _distance_to(pattern):
+    """Returns a function giving the edit distance from pattern to a word.
+    Uses Myers' bit-parallel algorithm: the pattern is compiled to one bit
+    mask per character once, then every word costs a single pass of integer
+    operations, which is what makes the BKTree fast without a C extension.
+    """
+    if _levenshtein is not None:
+        return lambda word: _levenshtein.distance(pattern, word)
+    m = len(pattern)
+    if m == 0:
+        return len
+    masks = {}
+    for i, char in enumerate(pattern):
+        masks[char] = masks.get(char, 0) | (1 << i)
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+
+    def distance_to(word):
+        vp = full
+        vn = 0
+        score = m
+        for char in word:
+            eq = masks.get(char, 0)
+            xv = eq | vn
+            xh = (((eq & vp) + vp) ^ vp) | eq
+            hp = vn | ~(xh | vp)
+            hn = vp & xh
+            if hp & last:
+                score += 1
+            elif hn & last:
+                score -= 1
+            hp = (hp << 1) | 1
+            hn <<= 1
+            vp = (hn | ~(xv | hp)) & full
+            vn = hp & xv & full
+        return score
+    return distance_to
+
+
+def distance(a, b):
+    """Returns the Levenshtein (edit) distance between a and b"""
+    return _distance_to(a)(b)
+
+
+def max_distance(token):
+    """Edits allowed when matching a token: short words need to be closer"""
+    if len(token) <= 2:
+        return 0
+    if len(token) <= 5:
+        return 1
+    return 2
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of words under the edit distance. Every child is
+    filed under its distance to its parent, so a search for words within
+    k of a query only has to visit the children filed between d - k and
+    d + k, where d is the query's distance to the parent.
+
+    Methods:
+    --------
+    add(word)
+    search(word, k)
+    """
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, word):
+        """Adds a word; adding a word that is already in the tree does nothing"""
+        if self._root is None:
+            self._root = (word, {})
+            self._size = 1
+            return
+        node_word, children = self._root
+        while True:
+            d = distance(word, node_word)
+            if d == 0:
+                return
+            if d not in children:
+                children[d] = (word, {})
+                self._size += 1
+                return
+            node_word, children = children[d]
+
+    def search(self, word, k):
+        """Returns {matching word: distance} for every word within k of word"""
+        found = {}
+        if self._root is None:
+            return found
+        distance_to = _distance_to(word)
+        stack = [self._root]
+        while stack:
+            node_word, children = stack.pop()
+            d = distance_to(node_word)
+            if d <= k:
+                found[node_word] = d
+            for child_d in range(max(d - k, 1), d + k + 1):
+                if child_d in children:
+                    stack.append(children[child_d])
+        return found
+
+
+class NameIndex:
+    """
+    Typo-tolerant index over the names of one table.
+
+    Names are split into normalized words. The distinct words go into a
+    BKTree, and an inverted index maps each word to the ids of the names
+    that contain it. A query is matched word by word, so the metric search
+    runs over the vocabulary, which is much smaller than the number of names.
+    Then the candidate ids are narrowed with set intersections and ranked
+    by their total edit distance.
+
+    Methods:
+    --------
+    add(name_id, name)
+    remove(name_id)
+    search(query, k=5)
+    """
+    def __init__(self):
+        self._words = BKTree()
+        self._postings = {} # word -> set of ids
+        self._names = {} # id -> (name, words)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name_id, name):
+        """Adds or replaces the name of name_id"""
+        self.remove(name_id)
+        words = tuple(normalize(name).split())
+        self._names[name_id] = (name, words)
+        for word in words:
+            if word not in self._postings:
+                self._postings[word] = set()
+                self._words.add(word)
+            self._postings[word].add(name_id)
+
+    def remove(self, name_id):
+        """Removes the name of name_id, if it is indexed"""
+        entry = self._names.pop(name_id, None)
+        if entry is None:
+            return
+        for word in entry[1]:
+            self._postings[word].discard(name_id)
+        # emptied words stay in the tree and are skipped because they have no ids
+
+    def _match(self, word):
+        """Returns {indexed word: distance} for the closest words that word
+        may be a typo of
+        """
+        if self._postings.get(word):
+            # an exact word is taken as meant; typos of it are not looked up
+            return {word: 0}
+        # a wider search visits far more of the tree, so only widen it if
+        # nothing is within one edit
+        for k in range(1, max_distance(word) + 1):
+            found = {match: d for match, d in self._words.search(word, k).items()
+                     if self._postings[match]}
+            if found:
+                return found
+        return {}
+
+    def search(self, query, k=5):
+        """Returns up to k [(name, distance), ...] ranked by total edit distance,
+        closest first. Names that contain a match for every word of the query
+        come first; if there are fewer than k of them, names missing one word
+        are added (unless there are too many) with that word's length as its
+        distance. Names further than the edits allowed for all the words of
+        the query put together are left out.
+        """
+        words = normalize(query).split()
+        if not words:
+            return []
+        matches = [self._match(word) for word in words]
+        hits = [set().union(*(self._postings[match] for match in found)) for found in matches]
+
+        candidates = set.intersection(*hits)
+        if len(candidates) < k and len(words) > 1:
+            for skip in range(len(words)):
+                relaxed = set.intersection(*(hits[:skip] + hits[skip + 1:]))
+                # hundreds of names sharing the other words say little about
+                # the query and would take longest to rank
+                if len(relaxed) <= 20 * k:
+                    candidates |= relaxed
+
+        ranked = []
+        for name_id in candidates:
+            name, name_words = self._names[name_id]
+            total = 0
+            for word, found in zip(words, matches):
+                total += min((found[w] for w in name_words if w in found), default=len(word))
+            # prefer names without extra words (then shorter names)
+            ranked.append((total, len(name_words) - len(words), len(name), name))
+        ranked.sort()
+        # stay within the edits allowed for the query as a whole
+        budget = max(sum(max_distance(word) for word in words), 1)
+        return [(name, total) for total, _, _, name in ranked[:k] if total <= budget]
+
+
+class FuzzySearch:
+    """
+    Typo-tolerant search over the names in ENTITIES, kept up to date from
+    the Changes feed. One set of indexes is built per database, so it
+    follows the shard selected for the current request.
+
+    Parameters:
+    dbname (defaults to the shard selected with Router.use, or DBNAME)
+
+    Methods:
+    --------
+    refresh()
+    search(tblname, query, k=5)
+    """
+    def __init__(self, dbname=None):
+        self._changes = Changes(dbname)
+        self._collections = {tblname: Collection(tblname, dbname) for tblname in ENTITIES}
+        self._states = {} # dbname -> {'lock', 'version', 'indexes'}
+        self._states_lock = threading.Lock()
+
+    def _state(self):
+        dbname = self._changes._dbname
+        with self._states_lock:
+            state = self._states.setdefault(dbname, {'lock': threading.Lock(),
+                                                     'version': None, 'indexes': None})
+        return state
+
+    def _build(self, state):
+        # read the version first, so that changes made during the build are
+        # applied again by the next refresh
+        state['version'] = self._changes.version()
+        indexes = {}
+        for tblname, (id_key, name_key) in ENTITIES.items():
+            index = NameIndex()
+            query = f"SELECT {id_key}, {name_key} FROM '{tblname}';"
+            for row in self._collections[tblname]._return(query, stream=True):
+                index.add(row[0], row[1])
+            indexes[tblname] = index
+        state['indexes'] = indexes
+
+    def refresh(self):
+        """Applies the changes made since the last refresh (builds the indexes
+        on first use, or rebuilds them if the feed was compacted past them)
+        """
+        state = self._state()
+        with state['lock']:
+            self._refresh(state)
+
+    def _refresh(self, state):
+        if state['indexes'] is None:
+            self._build(state)
+            return
+        while True:
+            page = self._changes.since(state['version'], limit=1000)
+            if page['resync']:
+                self._build(state)
+                return
+            for change in page['changes']:
+                if change['table'] not in ENTITIES:
+                    continue
+                id_key, name_key = ENTITIES[change['table']]
+                index = state['indexes'][change['table']]
+                if change['operation'] == 'delete':
+                    index.remove(change['key'][id_key])
+                else:
+                    if change['old'] is not None:
+                        index.remove(change['old'][id_key])
+                    index.add(change['key'][id_key], change['new'][name_key])
+            state['version'] = page['version']
+            if not page['more']:
+                return
+
+    def search(self, tblname, query, k=5):
+        """Returns up to k [(name, distance), ...] in tblname closest to query"""
+        state = self._state()
+        with state['lock']:
+            self._refresh(state)
+            return state['indexes'][tblname].search(query, k)
+
+
+def _typo(rng, name):
+    """Returns name with one random character replaced, inserted or deleted"""
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    i = rng.randrange(len(name))
+    edit = rng.choice(['replace', 'insert', 'delete'])
+    if edit == 'replace':
+        return name[:i] + rng.choice(letters) + name[i + 1:]
+    if edit == 'insert':
+        return name[:i] + rng.choice(letters) + name[i:]
+    return name[:i] + name[i + 1:]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the fuzzy name index')
+    parser.add_argument('--names', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    syllables = ['AH', 'BAO', 'CHEN', 'DA', 'EN', 'FANG', 'GUO', 'HUI', 'JIA', 'KAI',
+                 'LI', 'MEI', 'MING', 'NA', 'PING', 'QI', 'RUI', 'SHAN', 'TING', 'WEI',
+                 'XIN', 'YA', 'YONG', 'ZHI', 'AR', 'DEV', 'KUM', 'NUR', 'RAJ', 'SRI']
+    surnames = [a + b for a in syllables for b in ['', 'G', 'N', 'AN', 'ONG']]
+    names = [f'{rng.choice(surnames)} {rng.choice(syllables)}{rng.choice(syllables)} '
+             f'{rng.choice(syllables)}{rng.choice(syllables)}'.strip() for _ in range(args.names)]
+
+    start = time.perf_counter()
+    index = NameIndex()
+    for name_id, name in enumerate(names):
+        index.add(name_id, name)
+    print(f'Indexed {len(index)} names ({len(index._words)} distinct words) '
+          f'in {time.perf_counter() - start:.2f}s'
+          f"{'' if _levenshtein else ' (pure Python distance)'}")
+
+    queries = [_typo(rng, rng.choice(names)) for _ in range(args.queries)]
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f'{len(queries)} one-typo queries: '
+          f'p50 {timings[len(timings) // 2] * 1000:.3f}ms  '
+          f'p95 {timings[int(len(timings) * 0.95)] * 1000:.3f}ms  '
+          f'max {timings[-1] * 1000:.3f}ms')
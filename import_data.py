@@ -1,34 +1,95 @@
+import argparse
 import csv
-from storage import Students, Classes, CCAs
+import hashlib
+import time
+from storage import DBNAME, Students, Classes, CCAs
 
-classes = Classes()
-students = Students()
 
-with open("student.csv", 'r') as f:
-    students_list = csv.DictReader(f)
-    for student in students_list:
-        record = {}
-        record['student_name'] = student['student_name']
-        record['class_name'] = student['class_id']
-        record['age'] = 18
-        record['year_enrolled'] = student['year_enrolled']
-        record['grad_year'] = 2023
+def fingerprint(row: dict):
+    """Returns a content hash of a source CSV row"""
+    content = '\x1f'.join(f'{key}={row[key]}' for key in sorted(row))
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
 
+
+def read_students(path):
+    """Returns the student records in a student.csv export"""
+    with open(path, 'r') as f:
+        students_list = csv.DictReader(f)
+        records = []
+        for student in students_list:
+            record = {}
+            record['student_name'] = student['student_name']
+            record['class_name'] = student['class_id']
+            record['level'] = 'J2'
+            record['age'] = 18
+            record['year_enrolled'] = student['year_enrolled']
+            record['grad_year'] = 2023
+            record['source_hash'] = fingerprint(student)
+            records.append(record)
+    return records
+
+
+def read_ccas(path):
+    """Returns the CCA records in a cca.csv export"""
+    with open(path) as f:
+        cca_list = csv.DictReader(f)
+        records = []
+        for cca in cca_list:
+            record = {}
+            record['cca_name'] = cca['name']
+            record['type'] = cca['type']
+            record['source_hash'] = fingerprint(cca)
+            records.append(record)
+    return records
+
+
+def full_import(students_path, ccas_path, dbname=DBNAME):
+    """Adds every row one by one, skipping students and CCAs that already exist"""
+    classes = Classes(dbname)
+    students = Students(dbname)
+    for record in read_students(students_path):
         if classes.get(record['class_name']) == False:
-            classes.add({'class_name': record['class_name'], 'level': 'J2'})
+            classes.add({'class_name': record['class_name'], 'level': record['level']})
         students.add(record)
-students.display_all()        
-
-ccas = CCAs()
-with open('cca.csv') as f:
-    cca_list = csv.DictReader(f)
-    for cca in cca_list:
-        record = {}
-        record['cca_name'] = cca['name']
-        record['type'] = cca['type']
+    students.display_all()
+
+    ccas = CCAs(dbname)
+    for record in read_ccas(ccas_path):
         ccas.add(record)
-ccas.display_all()
-            
-        
-        
-    
\ No newline at end of file
+    ccas.display_all()
+
+
+def incremental_import(students_path, ccas_path, dbname=DBNAME, prune=False):
+    """Inserts new rows and updates changed rows only, using the row fingerprints
+    stored by the previous import. Returns {'Students': summary, 'CCAs': summary}
+    """
+    students = read_students(students_path)
+    ccas = read_ccas(ccas_path)
+    if prune and (not students or not ccas):
+        # an empty or truncated export would otherwise wipe the tables
+        raise ValueError('Refusing to prune with an empty export')
+    return {'Students': Students(dbname).sync(students, prune),
+            'CCAs': CCAs(dbname).sync(ccas, prune)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import students and CCAs from CSV exports')
+    parser.add_argument('--students', default='student.csv')
+    parser.add_argument('--ccas', default='cca.csv')
+    parser.add_argument('--db', default=DBNAME)
+    parser.add_argument('--incremental', action='store_true',
+                        help='only insert new rows and update changed rows')
+    parser.add_argument('--prune', action='store_true',
+                        help='with --incremental, delete imported rows missing from the files')
+    args = parser.parse_args()
+
+    if args.incremental:
+        start = time.perf_counter()
+        summaries = incremental_import(args.students, args.ccas, args.db, args.prune)
+        for tblname, summary in summaries.items():
+            print(f"{tblname}: {summary['inserted']} inserted, {summary['updated']} updated, "
+                  f"{summary['unchanged']} unchanged, {summary['removed']} removed"
+                  f"{' (deleted)' if args.prune else ''}")
+        print(f'Finished in {time.perf_counter() - start:.3f}s')
+    else:
+        full_import(args.students, args.ccas, args.db)
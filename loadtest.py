@@ -0,0 +1,294 @@
+import argparse
+import http.client
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from html.parser import HTMLParser
+from seed import populate
+from storage import PROFILES
+
+
+class FormParser(HTMLParser):
+    """Collects the action, method and input values of the first form in a page"""
+    def __init__(self):
+        super().__init__()
+        self.action = None
+        self.method = 'get'
+        self.fields = {}
+        self._in_form = False
+        self._done = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form' and not self._done:
+            self._in_form = True
+            self.action = attrs.get('action')
+            self.method = (attrs.get('method') or 'get').lower()
+        elif tag == 'input' and self._in_form and attrs.get('name'):
+            self.fields[attrs['name']] = attrs.get('value') or ''
+        elif tag == 'option' and self._in_form and 'choice' not in self.fields:
+            self.fields['choice'] = attrs.get('value') or ''
+
+    def handle_endtag(self, tag):
+        if tag == 'form' and self._in_form:
+            self._in_form = False
+            self._done = True
+
+
+class Client:
+    """One simulated user: a keep-alive connection that fills in the app's forms"""
+    def __init__(self, host, port, stats):
+        self._conn = http.client.HTTPConnection(host, port, timeout=30)
+        self._stats = stats
+
+    def request(self, step, method, url, fields=None):
+        """Sends a request, records its latency under step and returns the page"""
+        body = urllib.parse.urlencode(fields) if fields is not None else None
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+        start = time.perf_counter()
+        try:
+            self._conn.request(method.upper(), url, body=body, headers=headers)
+            response = self._conn.getresponse()
+            page = response.read().decode()
+            # the wizards report a rejected form as a 200 page with an error message
+            ok = response.status == 200 and "color: red'>Error" not in page
+        except (OSError, http.client.HTTPException):
+            self._conn.close()
+            page = ''
+            ok = False
+        self._stats.record(step, time.perf_counter() - start, ok)
+        return page
+
+    def submit(self, step, page, **values):
+        """Fills in the first form of page with values and submits it"""
+        form = FormParser()
+        form.feed(page)
+        if form.action is None:
+            self._stats.record(step, 0, False)
+            return ''
+        fields = {**form.fields, **values}
+        if form.method == 'get':
+            action = form.action.split('?')[0]
+            query = urllib.parse.urlencode(fields)
+            return self.request(step, 'get', f'{action}?{query}')
+        return self.request(step, 'post', form.action, fields)
+
+
+class Stats:
+    """Thread-safe latency samples per step"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, step, seconds, ok):
+        with self._lock:
+            if ok:
+                self.samples.setdefault(step, []).append(seconds)
+            else:
+                self.errors[step] = self.errors.get(step, 0) + 1
+
+    def report(self, elapsed):
+        steps = sorted(set(self.samples) | set(self.errors))
+        print(f"{'step':24} {'count':>7} {'errors':>6} {'req/s':>8} "
+              f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        total = 0
+        for step in steps:
+            samples = self.samples.get(step, [])
+            total += len(samples)
+            if len(samples) >= 2:
+                q = statistics.quantiles(samples, n=100, method='inclusive')
+                p50, p95, p99 = q[49] * 1000, q[94] * 1000, q[98] * 1000
+            else:
+                p50 = p95 = p99 = samples[0] * 1000 if samples else 0
+            print(f"{step:24} {len(samples):7} {self.errors.get(step, 0):6} "
+                  f"{len(samples) / elapsed:8.1f} {p50:8.1f} {p95:8.1f} {p99:8.1f}")
+        print(f'{total} requests in {elapsed:.1f}s: {total / elapsed:.1f} req/s')
+
+    def summary(self, elapsed):
+        """Returns {'requests', 'errors', 'rps', 'p50', 'p95', 'p99'} over all steps"""
+        samples = [sample for step in self.samples.values() for sample in step]
+        q = statistics.quantiles(samples, n=100, method='inclusive') if len(samples) >= 2 else [0] * 99
+        return {'requests': len(samples),
+                'errors': sum(self.errors.values()),
+                'rps': len(samples) / elapsed,
+                'p50': q[49] * 1000, 'p95': q[94] * 1000, 'p99': q[98] * 1000}
+
+
+class Dataset:
+    """Names in the seeded database, with the students split between workers
+    so that concurrent wizards never edit the same membership
+    """
+    def __init__(self, dbname, workers):
+        conn = sqlite3.connect(dbname)
+        self.students = [name for name, in conn.execute("SELECT student_name FROM 'Students';")]
+        self.classes = [name for name, in conn.execute("SELECT class_name FROM 'Classes';")]
+        self.ccas = [name for name, in conn.execute("SELECT cca_name FROM 'CCAs';")]
+        self.activities = [name for name, in conn.execute("SELECT activity_name FROM 'Activities';")]
+        self.memberships = {}
+        for student, cca in conn.execute("""
+                SELECT student_name, cca_name FROM 'Students-CCAs'
+                INNER JOIN 'Students' ON 'Students'.'student_id' = 'Students-CCAs'.'student_id'
+                INNER JOIN 'CCAs' ON 'CCAs'.'cca_id' = 'Students-CCAs'.'cca_id';"""):
+            self.memberships.setdefault(student, set()).add(cca)
+        conn.close()
+        self.partitions = [self.students[i::workers] for i in range(workers)]
+
+
+def view_flow(client, data, rng, worker, i):
+    """/view: pick Student or Class, then search for one"""
+    if rng.random() < 0.7:
+        page = client.request('view:choice', 'get', '/view?choice=Student')
+        client.submit('view:searched', page, Student=rng.choice(data.students))
+    else:
+        page = client.request('view:choice', 'get', '/view?choice=Class')
+        client.submit('view:searched', page, Class=rng.choice(data.classes))
+
+
+def edit_flow(client, data, rng, worker, i):
+    """/edit: add a student to a CCA, edit the role, then remove them again"""
+    student = rng.choice(data.partitions[worker])
+    cca = rng.choice([cca for cca in data.ccas if cca not in data.memberships.get(student, ())])
+    for choice, values in [('Add CCA Member', {'Role': 'Member'}),
+                           ('Edit CCA Member', {}),
+                           ('Remove CCA Member', {})]:
+        page = client.request('edit:choice', 'get',
+                              '/edit?' + urllib.parse.urlencode({'choice': choice}))
+        page = client.submit('edit:searched', page,
+                             **{'Student Name': student, 'CCA': cca, **values})
+        if choice == 'Edit CCA Member':
+            client.submit('edit:success', page, Role=rng.choice(['Member', 'Captain']))
+        else:
+            client.submit('edit:success', page)
+
+
+def add_flow(client, data, rng, worker, i):
+    """/add: add a new Activity through the confirm page"""
+    page = client.request('add:choice', 'get', '/add?choice=Activity')
+    page = client.submit('add:confirm', page, **{'Name': f'LOAD TEST {worker}-{i}-{rng.random():.8f}',
+                                                 'Start Date': '2022-06-01',
+                                                 'Description': 'Load test activity',
+                                                 'End Date': '2022-06-03'})
+    client.submit('add:result', page)
+
+
+FLOWS = {'view': view_flow, 'edit': edit_flow, 'add': add_flow}
+
+
+def run(host, port, data, workers, duration, mix, seed=0):
+    """Runs workers closed-loop users for duration seconds. Each user runs one
+    flow at a time, picked by the weights in mix, and starts the next as soon
+    as the last step returns. Returns the Stats and the elapsed time.
+    """
+    stats = Stats()
+    deadline = time.perf_counter() + duration
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    def user(worker):
+        rng = random.Random(seed * 1000 + worker)
+        client = Client(host, port, stats)
+        i = 0
+        while time.perf_counter() < deadline:
+            FLOWS[rng.choices(names, weights)[0]](client, data, rng, worker, i)
+            i += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(worker,)) for worker in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.perf_counter() - start
+
+
+def start_server(dbname, port, profile=None):
+    """Starts the app on a seeded database in a subprocess and waits until it
+    answers. profile picks the engine profile (see storage.PROFILES)
+    """
+    env = {**os.environ, 'CCA_DATABASE': os.path.abspath(dbname)}
+    if profile is not None:
+        env['CCA_DB_PROFILE'] = profile
+    server = subprocess.Popen(
+        [sys.executable, '-c', "import readmodels; from front import app; readmodels.start(app); "
+                               f"app.run(port={port}, threaded=True)"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('The server did not start')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay the /view, /edit and /add wizards under load')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--students', type=int, default=2000, help='size of the seeded school')
+    parser.add_argument('--mix', default='view=6,edit=3,add=1', help='flow weights')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--db', help='use this database instead of seeding one (it will be written to)')
+    parser.add_argument('--url', help='test a running server instead of starting one; needs --db')
+    parser.add_argument('--profiles', help='compare engine profiles, e.g. default,balanced '
+                                           '(each runs on a fresh copy of the database)')
+    args = parser.parse_args()
+    if args.profiles and set(args.profiles.split(',')) - set(PROFILES):
+        parser.error(f"--profiles: choose from {', '.join(PROFILES)}")
+    mix = {name: float(weight) for name, weight in
+           (item.split('=') for item in args.mix.split(','))}
+
+    with tempfile.TemporaryDirectory() as directory:
+        dbname = args.db
+        if dbname is None:
+            dbname = os.path.join(directory, 'loadtest.db')
+            populate(dbname, n_students=args.students)
+        data = Dataset(dbname, args.workers)
+
+        if args.profiles:
+            print(f"{'profile':12} {'requests':>9} {'errors':>6} {'req/s':>8} "
+                  f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+            for profile in args.profiles.split(','):
+                copy = os.path.join(directory, f'{profile}.db')
+                source, target = sqlite3.connect(dbname), sqlite3.connect(copy)
+                source.backup(target)
+                source.close()
+                target.close()
+                server = start_server(copy, args.port, profile)
+                try:
+                    stats, elapsed = run('127.0.0.1', args.port, data, args.workers, args.duration, mix)
+                finally:
+                    server.terminate()
+                    server.wait()
+                summary = stats.summary(elapsed)
+                print(f"{profile:12} {summary['requests']:9} {summary['errors']:6} "
+                      f"{summary['rps']:8.1f} {summary['p50']:8.1f} {summary['p95']:8.1f} "
+                      f"{summary['p99']:8.1f}")
+            raise SystemExit
+
+        server = None
+        if args.url:
+            url = urllib.parse.urlsplit(args.url)
+            host, port = url.hostname, url.port or 80
+        else:
+            host, port = '127.0.0.1', args.port
+            server = start_server(dbname, port)
+        try:
+            stats, elapsed = run(host, port, data, args.workers, args.duration, mix)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+        stats.report(elapsed)
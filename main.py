@@ -1,6 +1,8 @@
 from flask import Flask, render_template, request
+import readmodels
 from front import app
 
 
 if __name__ == '__main__':
+    readmodels.start(app)
     app.run('0.0.0.0')
@@ -0,0 +1,422 @@
+import argparse
+import collections
+import json
+import os
+import sqlite3
+import statistics
+import threading
+import time
+import warnings
+from storage import DBNAME, END_DAY, START_DAY
+
+# task -> seconds between two runs of it on the same database, in the order they run:
+# freed pages only leave a WAL database file once they are checkpointed
+TASKS = {'optimize': 3600, 'vacuum': 3600, 'checkpoint': 300, 'quick_check': 24 * 3600}
+BUDGET = 2.0 # seconds a task may take before it is interrupted
+# quick_check only reads, but reads every page and cannot resume where it was
+# interrupted, so it gets a budget that fits a whole check of a large database.
+# Without WAL its read transaction keeps writers from committing, so every task
+# is also interrupted as soon as the app gets a request, and retried later
+BUDGETS = {'quick_check': 300.0}
+POLL = 30 # seconds between two looks for due tasks in the background
+ANALYSIS_LIMIT = 1000 # rows ANALYZE samples per index
+VACUUM_STEP = 256 # pages freed per incremental_vacuum transaction
+PROGRESS_STEPS = 10000 # SQLite instructions between two looks at the deadline
+KEPT = 50 # latest reports kept in memory
+# reads the pages make, timed before and after a run while the app is idle;
+# each is an index lookup or stops early, so timing them costs little
+LATENCY_QUERIES = {
+    'student by name': """
+        SELECT * FROM 'Students'
+        WHERE student_name_norm = (SELECT student_name_norm FROM 'Students' ORDER BY student_id DESC LIMIT 1);""",
+    'name search': "SELECT student_id FROM 'Students' WHERE student_name LIKE '%an%' LIMIT 20;",
+    'class list': """
+        SELECT student_id, student_name FROM 'Students'
+        WHERE class_id = (SELECT MIN(class_id) FROM 'Classes') ORDER BY student_id;""",
+    'cca members': """
+        SELECT 'Students'.'student_name' FROM 'Students-CCAs'
+        INNER JOIN 'Students' ON 'Students'.'student_id' = 'Students-CCAs'.'student_id'
+        WHERE 'Students-CCAs'.'cca_id' = (SELECT MIN(cca_id) FROM 'CCAs');""",
+    'activities running': f"""
+        SELECT COUNT(*) FROM 'Activities'
+        WHERE {END_DAY} >= julianday('now', '-1 year') AND {START_DAY} <= julianday('now');""",
+}
+
+
+class _Skip(Exception):
+    """Raised by a task that has nothing to do, or must wait (busy=True)"""
+    def __init__(self, reason, busy=False):
+        super().__init__(reason)
+        self.busy = busy
+
+
+def database_busy(dbname):
+    """Whether another connection is writing to dbname (holds its write lock)"""
+    conn = sqlite3.connect(dbname, timeout=0, isolation_level=None)
+    try:
+        conn.execute('BEGIN IMMEDIATE;')
+        conn.execute('ROLLBACK;')
+        return False
+    except sqlite3.OperationalError:
+        return True
+    finally:
+        conn.close()
+
+
+def file_stats(dbname):
+    """Returns {'bytes' (with the WAL file), 'pages', 'free_pages'} of dbname"""
+    conn = sqlite3.connect(f'file:{dbname}?mode=ro', uri=True)
+    try:
+        pages = conn.execute('PRAGMA page_count;').fetchone()[0]
+        free_pages = conn.execute('PRAGMA freelist_count;').fetchone()[0]
+    finally:
+        conn.close()
+    size = os.path.getsize(dbname)
+    if os.path.exists(dbname + '-wal'):
+        size += os.path.getsize(dbname + '-wal')
+    return {'bytes': size, 'pages': pages, 'free_pages': free_pages}
+
+
+def latency(dbname, repeat=5):
+    """Returns {query name: median milliseconds} of the LATENCY_QUERIES, on a
+    new connection so that fresh statistics are used
+    """
+    conn = sqlite3.connect(f'file:{dbname}?mode=ro', uri=True)
+    timings = {}
+    try:
+        for name, query in LATENCY_QUERIES.items():
+            runs = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                try:
+                    conn.execute(query).fetchall()
+                except sqlite3.OperationalError:
+                    break # a table or column this database does not have
+                runs.append((time.perf_counter() - start) * 1000)
+            if runs:
+                timings[name] = round(statistics.median(runs), 3)
+    finally:
+        conn.close()
+    return timings
+
+
+def optimize(conn, deadline, busy):
+    """Refreshes the query planner statistics: ANALYZE sampling
+    ANALYSIS_LIMIT rows per index, then PRAGMA optimize
+    """
+    conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT};')
+    conn.execute('ANALYZE;')
+    conn.execute('PRAGMA optimize;')
+    indexes = conn.execute('SELECT COUNT(*) FROM sqlite_stat1;').fetchone()[0]
+    return {'analyzed': indexes}
+
+
+def vacuum(conn, deadline, busy):
+    """Gives free pages back to the file system VACUUM_STEP pages per
+    transaction, until there are none left, the deadline passes or the app
+    gets busy. Needs auto_vacuum = INCREMENTAL (see enable_incremental_vacuum)
+    """
+    free = conn.execute('PRAGMA freelist_count;').fetchone()[0]
+    if free == 0:
+        raise _Skip('no free pages')
+    if conn.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+        raise _Skip(f'{free} free pages, but auto_vacuum is not INCREMENTAL '
+                    '(run `python maintenance.py enable-vacuum` once)')
+    freed = 0
+    stopped = None
+    while free:
+        if time.monotonic() > deadline:
+            stopped = 'budget'
+            break
+        if freed and busy():
+            stopped = 'busy'
+            break
+        conn.execute(f'PRAGMA incremental_vacuum({VACUUM_STEP});').fetchall()
+        left = conn.execute('PRAGMA freelist_count;').fetchone()[0]
+        freed += free - left
+        free = left
+    return {'freed_pages': freed, 'free_pages': free, 'stopped': stopped}
+
+
+def checkpoint(conn, deadline, busy):
+    """Copies the WAL into the database file and truncates it"""
+    mode = conn.execute('PRAGMA journal_mode;').fetchone()[0]
+    if mode != 'wal':
+        raise _Skip(f'journal_mode is {mode}, there is no WAL')
+    blocked, wal_pages, checkpointed = conn.execute('PRAGMA wal_checkpoint(TRUNCATE);').fetchone()
+    return {'wal_pages': wal_pages, 'checkpointed': checkpointed, 'blocked': bool(blocked)}
+
+
+def quick_check(conn, deadline, busy):
+    """Checks the database structure (PRAGMA quick_check: integrity_check
+    without the index contents)
+    """
+    problems = [row[0] for row in conn.execute('PRAGMA quick_check(10);')]
+    return {'problems': [] if problems == ['ok'] else problems}
+
+
+RUNNERS = {'optimize': optimize, 'vacuum': vacuum, 'checkpoint': checkpoint,
+           'quick_check': quick_check}
+
+
+def enable_incremental_vacuum(dbname=DBNAME):
+    """Switches dbname to auto_vacuum = INCREMENTAL, which takes one full
+    VACUUM: the database is locked while the file is rewritten. Returns the
+    file stats before and after
+    """
+    before = file_stats(dbname)
+    conn = sqlite3.connect(dbname, isolation_level=None)
+    try:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+        conn.execute('VACUUM;')
+    finally:
+        conn.close()
+    return before, file_stats(dbname)
+
+
+class Maintenance:
+    """
+    Runs the maintenance TASKS on database files, each interrupted after
+    budget seconds (or its BUDGETS entry), skipped while the app is busy
+    and interrupted when it gets busy, and reports their effect on the file size and on the latency of
+    LATENCY_QUERIES, which is only measured while the app is not busy.
+
+    Each task runs on its own connection, outside of any request, in short
+    transactions, so the app only ever waits for one of them. A task
+    skipped because the app was busy stays due and is retried at the next
+    run_due(); the others wait for their TASKS interval.
+
+    Parameters:
+    dbnames (function returning the database files to maintain)
+    busy (function returning whether the app is busy; another connection
+          holding the write lock always counts as busy)
+    budget (seconds per task not in BUDGETS)
+    log (JSON lines file every report is appended to)
+
+    Methods:
+    run(dbname, tasks=None, force=False)
+    run_due()
+    start(poll)
+    stop()
+    reports()
+    """
+    def __init__(self, dbnames=lambda: [DBNAME], busy=None, budget=BUDGET, log=None):
+        self.dbnames = dbnames
+        self.budget = budget
+        self.budgets = {task: BUDGETS.get(task, budget) for task in TASKS}
+        self.log = log
+        self._app_busy = busy or (lambda: False)
+        self._last = {} # (dbname, task) -> time.monotonic() of its last run
+        self._reports = collections.deque(maxlen=KEPT)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run_task(self, dbname, task, busy, app_busy):
+        start = time.perf_counter()
+        result = {'task': task, 'status': 'done'}
+        conn = sqlite3.connect(dbname, timeout=0.1, isolation_level=None)
+        interrupted_busy = []
+
+        def interrupt():
+            # app_busy() is a counter: cheap enough to look at every PROGRESS_STEPS
+            if app_busy():
+                interrupted_busy.append(True)
+                return True
+            return time.monotonic() > deadline
+
+        try:
+            if busy():
+                raise _Skip('app busy', busy=True)
+            budget = self.budgets[task]
+            deadline = time.monotonic() + budget
+            conn.set_progress_handler(interrupt, PROGRESS_STEPS)
+            result.update(RUNNERS[task](conn, deadline, busy))
+            if result.get('problems'):
+                result['status'] = 'failed'
+        except _Skip as e:
+            result.update(status='skipped', reason=str(e), busy=e.busy)
+        except sqlite3.OperationalError as e:
+            if str(e) == 'interrupted' and interrupted_busy:
+                result.update(status='skipped', reason='interrupted, the app got busy', busy=True)
+            elif str(e) == 'interrupted':
+                result.update(status='timed out', reason=f'over the {budget}s budget')
+            elif 'locked' in str(e) or 'busy' in str(e):
+                result.update(status='skipped', reason=str(e), busy=True)
+            else:
+                result.update(status='failed', reason=str(e))
+        except sqlite3.Error as e:
+            result.update(status='failed', reason=str(e))
+        finally:
+            conn.close()
+        result['seconds'] = round(time.perf_counter() - start, 4)
+        return result
+
+    def run(self, dbname, tasks=None, force=False):
+        """Runs tasks (default: all the TASKS) on dbname; force runs them
+        even if the app is busy. Returns the report:
+        {'db', 'at', 'tasks': [{'task', 'status', 'seconds', ...}],
+         'before', 'after': {'bytes', 'pages', 'free_pages', 'latency_ms'}}
+        """
+        def app_busy():
+            return not force and self._app_busy()
+
+        def busy():
+            return app_busy() or database_busy(dbname)
+
+        def timings():
+            # the latency queries would compete with the app's own
+            return {} if busy() else latency(dbname)
+
+        with self._lock:
+            report = {'db': dbname, 'at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'tasks': []}
+            report['before'] = {**file_stats(dbname), 'latency_ms': timings()}
+            for task in tasks or TASKS:
+                result = self._run_task(dbname, task, busy, app_busy)
+                if not result.get('busy'):
+                    self._last[(dbname, task)] = time.monotonic()
+                report['tasks'].append(result)
+            report['after'] = {**file_stats(dbname), 'latency_ms': timings()}
+            self._reports.append(report)
+            if self.log:
+                with open(self.log, 'a') as f:
+                    f.write(json.dumps(report) + '\n')
+        return report
+
+    def run_due(self):
+        """Runs the tasks whose TASKS interval has passed on every database,
+        unless the app is busy. Returns the reports of the databases that
+        had tasks due
+        """
+        reports = []
+        now = time.monotonic()
+        for dbname in self.dbnames():
+            due = [task for task, interval in TASKS.items()
+                   if now - self._last.get((dbname, task), -interval) >= interval]
+            if due and not self._app_busy():
+                reports.append(self.run(dbname, due))
+        return reports
+
+    def _run_every(self, poll):
+        while not self._stop.wait(poll):
+            try:
+                self.run_due()
+            except Exception as e:
+                # a failed run should not stop the next one
+                warnings.warn(f'Maintenance failed: {e!r}')
+
+    def start(self, poll=POLL):
+        """Looks for due tasks every poll seconds in a background thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run_every, args=(poll,),
+                                        name='maintenance', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def reports(self):
+        """Returns the KEPT latest reports, latest first"""
+        with self._lock:
+            return list(reversed(self._reports))
+
+
+def init_app(app, dbnames):
+    """Runs the due maintenance tasks on the databases dbnames() returns in
+    a background thread if app.config['MAINTENANCE'] is set, skipping them
+    while a request is being served. Reports are appended to
+    app.config['MAINTENANCE_LOG'] if set. With several worker processes,
+    enable it in one of them only. The Maintenance is
+    app.extensions['maintenance'] (None if it is off)
+    """
+    if not app.config.get('MAINTENANCE'):
+        app.extensions['maintenance'] = None
+        return
+    from flask import g
+    in_flight = [0]
+    lock = threading.Lock()
+
+    def uncount():
+        with lock:
+            in_flight[0] -= 1
+
+    @app.before_request
+    def count_request():
+        with lock:
+            in_flight[0] += 1
+        g.uncount = uncount
+
+    # a streamed page is only sent once the response is closed
+    @app.after_request
+    def uncount_when_sent(response):
+        done = g.pop('uncount', None)
+        if done is not None and response.is_streamed:
+            response.call_on_close(done)
+        elif done is not None:
+            done()
+        return response
+
+    @app.teardown_request
+    def uncount_request(error):
+        done = g.pop('uncount', None)
+        if done is not None:
+            done()
+
+    maintenance = app.extensions['maintenance'] = Maintenance(
+        dbnames, busy=lambda: in_flight[0] > 0, log=app.config.get('MAINTENANCE_LOG'))
+    maintenance.start()
+
+
+def _format(report):
+    lines = [f"{report['db']} at {report['at']}"]
+    for result in report['tasks']:
+        details = {key: value for key, value in result.items()
+                   if key not in ('task', 'status', 'seconds', 'busy')}
+        lines.append(f"  {result['task']:12} {result['status']:9} {result['seconds']:7.3f}s  "
+                     + ', '.join(f'{key} {value}' for key, value in details.items()))
+    before, after = report['before'], report['after']
+    lines.append(f"  size {before['bytes'] / 1024:.0f}KiB -> {after['bytes'] / 1024:.0f}KiB, "
+                 f"free pages {before['free_pages']} -> {after['free_pages']}")
+    # latency is not measured while the app is busy
+    for name in LATENCY_QUERIES:
+        ms = [timings.get(name) for timings in (before['latency_ms'], after['latency_ms'])]
+        if ms != [None, None]:
+            lines.append(f"  {name:20} " + ' -> '.join('       -  ' if value is None else f'{value:8.3f}ms'
+                                                       for value in ms))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the database: statistics, free pages, WAL, checks')
+    parser.add_argument('--db', default=DBNAME)
+    parser.add_argument('--budget', type=float, default=BUDGET,
+                        help=f"seconds per task other than {', '.join(BUDGETS)}")
+    parser.add_argument('--log', help='JSON lines file the reports are appended to')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('run', help='run the tasks now')
+    command.add_argument('tasks', nargs='*', help=f"some of {', '.join(TASKS)} (default: all of them)")
+    command.add_argument('--force', action='store_true', help='run even if the database is busy')
+    command = commands.add_parser('schedule', help='run the tasks as they fall due')
+    command.add_argument('--poll', type=float, default=POLL, help='seconds between looks for due tasks')
+    commands.add_parser('enable-vacuum', help='switch to incremental vacuum (one full VACUUM)')
+    args = parser.parse_args()
+    maintenance = Maintenance(lambda: [args.db], budget=args.budget, log=args.log)
+
+    if args.command == 'run':
+        unknown = set(args.tasks) - set(TASKS)
+        if unknown:
+            parser.error(f"unknown tasks {', '.join(sorted(unknown))}, choose from {', '.join(TASKS)}")
+        print(_format(maintenance.run(args.db, args.tasks, args.force)))
+    elif args.command == 'schedule':
+        while True:
+            for report in maintenance.run_due():
+                print(_format(report))
+            time.sleep(args.poll)
+    elif args.command == 'enable-vacuum':
+        before, after = enable_incremental_vacuum(args.db)
+        print(f"Incremental vacuum enabled: {before['bytes'] / 1024:.0f}KiB -> "
+              f"{after['bytes'] / 1024:.0f}KiB, {before['free_pages']} free pages reclaimed")
@@ -0,0 +1,298 @@
+import argparse
+import contextlib
+import contextvars
+import io
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+import storage
+
+FRAMES = 5 # frames kept of every traced allocation; each one slows tracing down
+WORST = 10 # requests kept with their allocation sites
+TOP_SITES = 10
+MIN_SITE_BYTES = 64 * 1024 # smaller growth is not worth a snapshot
+
+# the request being measured in this context, see MemoryRecorder.begin
+_current = contextvars.ContextVar('memory_request', default=None)
+
+
+def shape(query):
+    """Returns a query with its whitespace collapsed, the key its
+    allocations are added up under
+    """
+    return ' '.join(query.split())[:200]
+
+
+class MemoryRecorder:
+    """
+    Samples the Python allocations of requests with tracemalloc and adds
+    them up per route and per query shape (every Collection query).
+
+    tracemalloc only runs while a sampled request is measured, so the
+    other requests are not slowed down. One request is measured at a time:
+    tracemalloc counts every thread's allocations, so requests that start
+    while one is measured are not sampled, but their allocations can still
+    show up in the measurement; a single worker thread gives exact figures.
+
+    Parameters:
+    sample_rate (fraction of requests measured, 0 to 1)
+
+    Methods:
+    begin(route)
+    probe(query)
+    end(state)
+    measure(route)
+    report()
+    reset()
+    """
+    def __init__(self, sample_rate=1.0):
+        self.sample_rate = sample_rate
+        self._measuring = threading.Lock()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets everything measured so far"""
+        with self._lock:
+            self._routes = {}
+            self._queries = {}
+            self._worst = []
+            self._sampled = 0
+
+    def _sites(self):
+        """Returns the TOP_SITES tracebacks holding the most memory of what
+        the request has allocated and not freed yet
+        """
+        stats = tracemalloc.take_snapshot().statistics('traceback')
+        return [{'size': stat.size, 'count': stat.count,
+                 'traceback': stat.traceback.format(most_recent_first=True)}
+                for stat in stats[:TOP_SITES]]
+
+    def _worth_sites(self, grown):
+        """Whether a request that has grown by this much could be one of the
+        WORST, so that its allocation sites are worth a snapshot
+        """
+        floor = self._worst[-1]['peak'] if len(self._worst) >= WORST else 0
+        return grown >= max(MIN_SITE_BYTES, floor)
+
+    def begin(self, route):
+        """Starts measuring a request if it is sampled and no other one is
+        being measured. Returns the state to pass to end(), or None
+        """
+        if random.random() >= self.sample_rate or not self._measuring.acquire(blocking=False):
+            return None
+        # already tracing (e.g. under benchmark.py): leave it running after
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(FRAMES)
+        start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        state = {'route': route, 'start': start, 'peak': start, 'sites_at': 0, 'sites': None,
+                 'queries': [], 'time': time.perf_counter(), 'started': started}
+        state['token'] = _current.set(state)
+        return state
+
+    @contextlib.contextmanager
+    def probe(self, query):
+        """Measures a query of the request being measured in this context.
+        Added to storage.QUERY_PROBES by enable(). A streamed read is only
+        measured until its first row (see storage.Collection._return)
+        """
+        state = _current.get()
+        if state is None:
+            yield
+            return
+        before, peak = tracemalloc.get_traced_memory()
+        state['peak'] = max(state['peak'], peak)
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            after, peak = tracemalloc.get_traced_memory()
+            state['peak'] = max(state['peak'], peak)
+            key = shape(query)
+            state['queries'].append((key, peak - before))
+            self._add(self._queries, key, peak - before, after - before)
+            # the rows are still alive here: where they were allocated is
+            # what the request's peak is made of. A snapshot costs as much
+            # as the traced blocks, so take one each time the growth doubles
+            grown = after - state['start']
+            if grown >= 2 * state['sites_at'] and self._worth_sites(grown):
+                state['sites_at'] = grown
+                state['sites'] = self._sites()
+
+    def end(self, state):
+        """Finishes measuring the request begin() returned state for"""
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(state['peak'], peak) - state['start']
+            net = current - state['start']
+            if state['sites'] is None and self._worth_sites(peak):
+                state['sites'] = self._sites()
+            self._add(self._routes, state['route'], peak, net)
+            queries = {}
+            for key, query_peak in state['queries']:
+                queries[key] = max(queries.get(key, 0), query_peak)
+            request = {'route': state['route'], 'peak': peak, 'net': net,
+                       'seconds': round(time.perf_counter() - state['time'], 4),
+                       'queries': sorted(queries.items(), key=lambda item: -item[1]),
+                       'sites': state['sites'] or []}
+            with self._lock:
+                self._sampled += 1
+                self._worst.append(request)
+                self._worst.sort(key=lambda request: -request['peak'])
+                del self._worst[WORST:]
+        finally:
+            _current.reset(state['token'])
+            if state['started']:
+                tracemalloc.stop()
+            self._measuring.release()
+
+    @contextlib.contextmanager
+    def measure(self, route):
+        """Measures the block as one request named route, e.g. an export
+        run from a script
+        """
+        state = self.begin(route)
+        try:
+            yield
+        finally:
+            if state is not None:
+                self.end(state)
+
+    def _add(self, totals, key, peak, net):
+        with self._lock:
+            total = totals.setdefault(key, {'count': 0, 'peak_max': 0, 'peak_total': 0,
+                                            'net_total': 0})
+            total['count'] += 1
+            total['peak_max'] = max(total['peak_max'], peak)
+            total['peak_total'] += peak
+            total['net_total'] += net
+
+    def report(self):
+        """Returns the routes and query shapes by their largest peak, with
+        their mean peak and net allocation in bytes, and the WORST requests
+        with the allocation sites of their peak
+        """
+        def rows(totals, name):
+            return sorted(({name: key, 'count': total['count'], 'peak_max': total['peak_max'],
+                            'peak_mean': total['peak_total'] // total['count'],
+                            'net_mean': total['net_total'] // total['count']}
+                           for key, total in totals.items()),
+                          key=lambda row: -row['peak_max'])
+        with self._lock:
+            return {'sample_rate': self.sample_rate,
+                    'sampled': self._sampled,
+                    'routes': rows(self._routes, 'route'),
+                    'queries': rows(self._queries, 'query'),
+                    'worst': list(self._worst)}
+
+
+def enable(sample_rate=1.0):
+    """Returns a MemoryRecorder that also measures every Collection query
+    of the requests it samples
+    """
+    recorder = MemoryRecorder(sample_rate)
+    storage.QUERY_PROBES.append(recorder.probe)
+    return recorder
+
+
+def route_of(request):
+    """Returns the name requests are added up under: the method, the URL
+    rule and the names of the query arguments and form fields
+    (POST /view?searched [Class])
+    """
+    rule = request.url_rule.rule if request.url_rule is not None else request.path
+    args = '&'.join(sorted(request.args))
+    fields = ', '.join(sorted(request.form)) if request.method == 'POST' else ''
+    return f"{request.method} {rule}{'?' + args if args else ''}{f' [{fields}]' if fields else ''}"
+
+
+def init_app(app):
+    """Measures a sample of app's requests if app.config['MEMORY_PROFILE']
+    (the fraction of requests to sample) is set. Streamed pages are measured
+    until their last chunk is sent. The recorder is app.extensions['memprofile']
+    """
+    sample_rate = app.config.get('MEMORY_PROFILE') or 0
+    if not sample_rate:
+        app.extensions['memprofile'] = None
+        return
+    recorder = app.extensions['memprofile'] = enable(sample_rate)
+    from flask import g, request
+
+    @app.before_request
+    def begin_measuring():
+        g.memory_state = recorder.begin(route_of(request))
+
+    # a streamed page is only sent once the response is closed
+    @app.after_request
+    def end_measuring_when_sent(response):
+        state = g.pop('memory_state', None)
+        if state is not None and response.is_streamed:
+            response.call_on_close(lambda: recorder.end(state))
+        elif state is not None:
+            recorder.end(state)
+        return response
+
+    @app.teardown_request
+    def end_measuring(error):
+        state = g.pop('memory_state', None)
+        if state is not None:
+            recorder.end(state)
+
+
+def _format(report):
+    lines = []
+    for title, rows, name in [('routes', report['routes'], 'route'),
+                              ('queries', report['queries'], 'query')]:
+        lines.append(f"{title:60}  {'count':>6}  {'peak max':>10}  {'peak mean':>10}  {'net mean':>10}")
+        for row in rows[:15]:
+            lines.append(f"{row[name][:60]:60}  {row['count']:6}  {row['peak_max'] // 1024:8}KiB"
+                         f"  {row['peak_mean'] // 1024:8}KiB  {row['net_mean'] // 1024:8}KiB")
+        lines.append('')
+    for request in report['worst'][:3]:
+        lines.append(f"{request['route']}: peak {request['peak'] // 1024}KiB, "
+                     f"net {request['net'] // 1024}KiB")
+        for site in request['sites'][:3]:
+            lines.append(f"  {site['size'] // 1024:6}KiB {site['count']:7} blocks  "
+                         f"{site['traceback'][0].strip()}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the memory of the app pages')
+    parser.add_argument('--views', type=int, default=3, help='rounds over the pages')
+    parser.add_argument('--json', action='store_true', help='print the full report as JSON')
+    args = parser.parse_args()
+
+    os.environ['CCA_MEMORY_PROFILE'] = '1' # every request
+    import front
+    recorder = front.app.extensions['memprofile']
+    client = front.app.test_client()
+    students = front.students
+    class_name = students._return("""
+            SELECT class_name FROM 'Classes'
+            INNER JOIN 'Students' ON 'Students'.'class_id' = 'Classes'.'class_id'
+            GROUP BY 'Classes'.'class_id' ORDER BY COUNT(*) DESC LIMIT 1;""")
+    student = students._return("SELECT student_name FROM 'Students' LIMIT 1;")
+    activity = students._return("SELECT start_date FROM 'Activities' ORDER BY start_date LIMIT 1;")
+    pages = [('get', '/', {}), ('get', '/view', {}), ('get', '/changes', {})]
+    if class_name:
+        pages.append(('post', '/view?searched', {'Class': class_name['class_name']}))
+    if student:
+        pages.append(('post', '/view?searched', {'Student': student['student_name']}))
+    if activity:
+        pages.append(('post', '/view?searched', {'From': activity['start_date'], 'To': ''}))
+    for _ in range(args.views):
+        for method, url, data in pages:
+            response = getattr(client, method)(url, data=data)
+            response.get_data()
+            response.close()
+    with recorder.measure('Collection.display_all Students'):
+        with contextlib.redirect_stdout(io.StringIO()):
+            students.display_all()
+    report = recorder.report()
+    print(json.dumps(report, indent=2) if args.json else _format(report))
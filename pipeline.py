@@ -0,0 +1,194 @@
+import argparse
+import csv
+import io
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+import time
+from storage import DBNAME, Activities, normalize
+from validation import activity_error
+
+# CSV header -> field name in the /add form
+COLUMNS = {'activity_name': 'Name', 'start_date': 'Start Date',
+           'description': 'Description', 'end_date': 'End Date'}
+
+
+def read_chunks(path, chunk_size):
+    """Yields (first line number, header, raw lines) with chunk_size records each.
+    Only splits between records, so quoted fields spanning lines stay whole;
+    the CSV itself is parsed by the workers.
+    """
+    with open(path, newline='') as f:
+        header = f.readline()
+        line_no = 2
+        lines = []
+        records = 0
+        in_quotes = False
+        for line in f:
+            lines.append(line)
+            if line.count('"') % 2:
+                in_quotes = not in_quotes
+            if not in_quotes:
+                records += 1
+                if records == chunk_size:
+                    yield line_no, header, lines
+                    line_no += len(lines)
+                    lines = []
+                    records = 0
+        if lines:
+            yield line_no, header, lines
+
+
+def validate_chunk(chunk):
+    """Parses and validates a chunk of activity records (runs in a worker process).
+    Returns (valid rows ready for insert, [(line number, error message), ...])
+    """
+    line_no, header, lines = chunk
+    reader = csv.DictReader(io.StringIO(header + ''.join(lines)))
+    rows = []
+    errors = []
+    start = 0
+    for row in reader:
+        # reader.line_num counts the header, so the record began on the line after
+        # the previous record ended
+        line = line_no + start
+        start = reader.line_num - 1
+        data = {label: (row[column] or '').strip() for column, label in COLUMNS.items()}
+        error = activity_error(data)
+        if error:
+            errors.append((line, error))
+            continue
+        rows.append((data['Name'], data['Start Date'], data['End Date'],
+                     data['Description'], normalize(data['Name'])))
+    return rows, errors
+
+
+WAIT = 0.1 # seconds between two looks at whether the writer has failed
+
+
+def _write(dbname, batches, stats, failed):
+    """Writer thread: inserts every validated batch over a single connection.
+    The first error (e.g. database is locked) is appended to failed, after
+    which the batches are still taken off the queue, but not inserted, so
+    the rest of the pipeline is never left waiting for the writer
+    """
+    query = """
+            INSERT OR IGNORE INTO 'Activities' (
+                'activity_name', 'start_date', 'end_date', 'description',
+                'activity_name_norm'
+            ) VALUES (?, ?, ?, ?, ?);
+            """
+    conn = None
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        rows, slot = batch
+        try:
+            if not failed:
+                conn = conn or sqlite3.connect(dbname)
+                # rowcount, unlike total_changes, leaves out the Changes triggers' rows
+                with conn:
+                    inserted = conn.executemany(query, rows).rowcount
+                stats['inserted'] += inserted
+                stats['duplicates'] += len(rows) - inserted
+        except Exception as e:
+            failed.append(e)
+        finally:
+            slot.release() # the chunk has left the pipeline
+    if conn is not None:
+        conn.close()
+
+
+def _put(batches, batch, writer):
+    """Queues batch for the writer, unless the writer thread has ended"""
+    while writer.is_alive():
+        try:
+            batches.put(batch, timeout=WAIT)
+            return
+        except queue.Full:
+            pass
+
+
+def import_activities(path, dbname=DBNAME, workers=None, chunk_size=5000, in_flight=None):
+    """Imports activity records from a CSV file with columns activity_name,
+    start_date, end_date and description.
+
+    The main process splits the file into chunks, a process pool parses and
+    validates them in parallel and a single writer thread inserts the valid
+    rows. At most in_flight chunks (default 2 per worker) are being parsed or
+    waiting to be written at any time, so memory stays bounded however large
+    the file is. Activities that already exist are skipped. If writing
+    fails, the import stops and the writer's error is raised; the batches
+    written until then stay in the database.
+
+    Returns the stats and the [(line number, error message), ...] of invalid rows.
+    """
+    with open(path, newline='') as f:
+        header = next(csv.reader(f), [])
+    missing = [column for column in COLUMNS if column not in header]
+    if missing:
+        raise ValueError(f'{path} is missing the column(s): {", ".join(missing)}')
+    Activities(dbname) # brings the database up to date before writing to it
+    workers = workers or os.cpu_count()
+    in_flight = in_flight or 2 * workers
+    slots = threading.BoundedSemaphore(in_flight)
+    batches = queue.Queue(maxsize=in_flight)
+    stats = {'rows': 0, 'inserted': 0, 'duplicates': 0, 'errors': 0}
+    errors = []
+    failed = [] # the writer's error
+
+    def chunks():
+        for chunk in read_chunks(path, chunk_size):
+            # backpressure: wait for a chunk to be written
+            while not slots.acquire(timeout=WAIT):
+                if failed:
+                    return
+            if failed:
+                return
+            yield chunk
+
+    writer = threading.Thread(target=_write, args=(dbname, batches, stats, failed))
+    writer.start()
+    start = time.perf_counter()
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            for rows, chunk_errors in pool.imap(validate_chunk, chunks()):
+                if failed:
+                    break
+                stats['rows'] += len(rows) + len(chunk_errors)
+                stats['errors'] += len(chunk_errors)
+                errors.extend(chunk_errors)
+                _put(batches, (rows, slots), writer)
+    finally:
+        _put(batches, None, writer)
+        writer.join()
+    if failed:
+        raise failed[0]
+    stats['seconds'] = time.perf_counter() - start
+    return stats, errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import activity records from a CSV file in parallel')
+    parser.add_argument('path')
+    parser.add_argument('--db', default=DBNAME)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--errors', default='import_errors.csv',
+                        help='where to write the line numbers and errors of invalid rows')
+    args = parser.parse_args()
+
+    stats, errors = import_activities(args.path, args.db, args.workers, args.chunk_size)
+    if errors:
+        with open(args.errors, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['line', 'error'])
+            writer.writerows(errors)
+    print(f"{stats['rows']} rows: {stats['inserted']} inserted, "
+          f"{stats['duplicates']} already existed, {stats['errors']} invalid "
+          f"in {stats['seconds']:.2f}s ({stats['rows'] / stats['seconds']:.0f} rows/s)")
+    if errors:
+        print(f'Errors written to {args.errors}')
@@ -0,0 +1,226 @@
+import collections
+import contextlib
+import contextvars
+import hmac
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+import storage
+
+INTERVAL = 0.001 # seconds between two samples of the profiled request's stack
+KEPT = 50 # latest profiles kept
+# query arguments of the /add, /view and /edit wizards, in the order they are handled
+STEPS = ['choice', 'searched', 'confirm', 'result', 'success']
+
+# the request being profiled in this context, see RequestProfiler.begin
+_current = contextvars.ContextVar('profiled_request', default=None)
+
+
+def frame_name(frame):
+    """Returns the name of a frame in a collapsed stack: function (file:line)"""
+    code = frame.f_code
+    return f'{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def collapse(frame):
+    """Returns the stack ending at frame as one collapsed-stack line:
+    the frame names from the outermost call in, separated by ';'
+    """
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class RequestProfiler:
+    """
+    Profiles single requests by sampling the stack of the thread serving
+    them every interval seconds, and keeps the KEPT latest profiles as
+    collapsed stacks ("outer;inner;leaf samples" per line, the input of
+    flamegraph.pl and speedscope), tagged with their route, wizard step and
+    the time spent in Collection queries.
+
+    One request is profiled at a time: requests that start while one is
+    profiled are not. The interpreter switches threads at most every
+    sys.getswitchinterval() (5ms by default), which is lowered to interval
+    while a request is profiled so the sampler gets to run.
+
+    Parameters:
+    sample_rate (fraction of requests profiled without being asked to, 0 to 1)
+    interval (seconds between samples)
+
+    Methods:
+    begin(route, step, trigger)
+    probe(query)
+    end(state, status)
+    profiles()
+    stacks(profile_id)
+    """
+    def __init__(self, sample_rate=0.0, interval=INTERVAL):
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self._profiling = threading.Lock()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._kept = collections.OrderedDict()
+
+    def sampled(self):
+        """Whether a request not asked to be profiled is in the sample"""
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _sample(self, state):
+        """Counts the collapsed stack of the profiled thread every interval
+        until end() sets state['stop']
+        """
+        stacks = state['stacks']
+        while not state['stop'].wait(self.interval):
+            frame = sys._current_frames().get(state['thread'])
+            if frame is not None:
+                stack = collapse(frame)
+                stacks[stack] = stacks.get(stack, 0) + 1
+            del frame
+
+    def begin(self, route, step, trigger):
+        """Starts profiling the request served by this thread unless another
+        one is being profiled. Returns the state to pass to end(), or None
+        """
+        if not self._profiling.acquire(blocking=False):
+            return None
+        state = {'route': route, 'step': step, 'trigger': trigger,
+                 'thread': threading.get_ident(), 'stacks': {}, 'stop': threading.Event(),
+                 'db_seconds': 0.0, 'queries': 0,
+                 'switch': sys.getswitchinterval(), 'time': time.perf_counter()}
+        sys.setswitchinterval(min(state['switch'], self.interval))
+        state['token'] = _current.set(state)
+        state['sampler'] = threading.Thread(target=self._sample, args=(state,),
+                                            name='request-profiler', daemon=True)
+        state['sampler'].start()
+        return state
+
+    @contextlib.contextmanager
+    def probe(self, query):
+        """Times a query of the request being profiled in this context.
+        Added to storage.QUERY_PROBES by enable(). A streamed read is only
+        timed until its first row (see storage.Collection._return)
+        """
+        state = _current.get()
+        if state is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            state['db_seconds'] += time.perf_counter() - start
+            state['queries'] += 1
+
+    def end(self, state, status=None):
+        """Finishes profiling the request begin() returned state for"""
+        try:
+            seconds = time.perf_counter() - state['time']
+            state['stop'].set()
+            state['sampler'].join()
+            stacks = sorted(state['stacks'].items(), key=lambda item: -item[1])
+            profile = {'route': state['route'], 'step': state['step'],
+                       'trigger': state['trigger'], 'status': status,
+                       'at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'seconds': round(seconds, 4),
+                       'db_seconds': round(state['db_seconds'], 4),
+                       'queries': state['queries'],
+                       'samples': sum(count for _, count in stacks),
+                       'interval': self.interval}
+            with self._lock:
+                profile['id'] = next(self._ids)
+                self._kept[profile['id']] = (profile, stacks)
+                while len(self._kept) > KEPT:
+                    self._kept.popitem(last=False)
+        finally:
+            _current.reset(state['token'])
+            sys.setswitchinterval(state['switch'])
+            self._profiling.release()
+
+    def profiles(self):
+        """Returns the kept profiles without their stacks, latest first"""
+        with self._lock:
+            return [profile for profile, _ in reversed(self._kept.values())]
+
+    def stacks(self, profile_id):
+        """Returns the collapsed stacks of a kept profile, most sampled
+        first, or None if it is not kept (any more)
+        """
+        with self._lock:
+            kept = self._kept.get(profile_id)
+        if kept is None:
+            return None
+        return ''.join(f'{stack} {count}\n' for stack, count in kept[1])
+
+
+def enable(sample_rate=0.0, interval=INTERVAL):
+    """Returns a RequestProfiler that also times every Collection query of
+    the requests it profiles
+    """
+    profiler = RequestProfiler(sample_rate, interval)
+    storage.QUERY_PROBES.append(profiler.probe)
+    return profiler
+
+
+def step_of(request):
+    """Returns the wizard step of a request: its first STEPS query argument
+    with the choice made or the action done (choice=Edit CCA Member,
+    searched=edit), or 'start'
+    """
+    for step in STEPS:
+        if step in request.args:
+            detail = request.args.get('choice') or request.form.get('action')
+            return f'{step}={detail}' if detail else step
+    return 'start'
+
+
+def init_app(app):
+    """Profiles the requests sent with an X-Profile header and the admin
+    token (app.config['ADMIN_TOKEN']), and a sample of the others if
+    app.config['REQUEST_PROFILE'] (the fraction of requests to profile) is
+    set. Streamed pages are profiled until their last chunk is sent.
+    With neither set nothing is profiled, no query is probed and
+    app.extensions['profiling'] (the profiler) is None
+    """
+    sample_rate = app.config.get('REQUEST_PROFILE') or 0
+    if not sample_rate and not app.config.get('ADMIN_TOKEN'):
+        app.extensions['profiling'] = None
+        return
+    profiler = app.extensions['profiling'] = enable(sample_rate)
+    from flask import g, request
+
+    def asked():
+        token = app.config.get('ADMIN_TOKEN')
+        return ('X-Profile' in request.headers and bool(token)
+                and hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode(),
+                                        token.encode()))
+
+    @app.before_request
+    def begin_profiling():
+        trigger = 'header' if asked() else 'sample' if profiler.sampled() else None
+        if trigger is None:
+            return
+        rule = request.url_rule.rule if request.url_rule is not None else request.path
+        g.profile_state = profiler.begin(f'{request.method} {rule}', step_of(request), trigger)
+
+    # a streamed page is only sent once the response is closed
+    @app.after_request
+    def end_profiling_when_sent(response):
+        state = g.pop('profile_state', None)
+        if state is not None and response.is_streamed:
+            response.call_on_close(lambda: profiler.end(state, response.status_code))
+        elif state is not None:
+            profiler.end(state, response.status_code)
+        return response
+
+    @app.teardown_request
+    def end_profiling(error):
+        state = g.pop('profile_state', None)
+        if state is not None:
+            profiler.end(state, 500)
@@ -0,0 +1,92 @@
+import argparse
+import threading
+import time
+import warnings
+from storage import DBNAME, ReadModels
+
+POLL = 2.0 # seconds between two looks at the Changes feed in the background
+
+
+def refresh_all(dbnames):
+    """Refreshes the documents of every database in dbnames.
+    Returns {dbname: documents rebuilt}
+    """
+    return {dbname: ReadModels(dbname).refresh() for dbname in dbnames}
+
+
+def follow(dbnames, poll=POLL):
+    """Refreshes the documents of the databases dbnames() returns every
+    poll seconds, forever
+    """
+    while True:
+        time.sleep(poll)
+        try:
+            refresh_all(dbnames())
+        except Exception as e:
+            # a failed refresh should not stop the next one
+            warnings.warn(f'Refreshing the read models failed: {e!r}')
+
+
+def init_app(app, dbnames, writers=('add', 'add_bulk', 'edit')):
+    """Keeps the /view documents of the databases dbnames() returns up to
+    date outside of page lookups: they are refreshed after every POST to
+    the writers endpoints, so an edit shows up on the next page. If
+    app.config['READ_MODELS_POLL'] is set, start() is called too
+    """
+    from flask import request
+    read_models = ReadModels() # the shard of the request
+    app.extensions['readmodels'] = {'dbnames': dbnames, 'thread': None}
+
+    @app.after_request
+    def refresh_after_write(response):
+        if request.method == 'POST' and request.endpoint in writers:
+            read_models.refresh()
+        return response
+
+    if app.config.get('READ_MODELS_POLL'):
+        start(app)
+
+
+def start(app, poll=None):
+    """Refreshes the documents of every database the app serves, then every
+    poll seconds (default: app.config['READ_MODELS_POLL'] or POLL) in a
+    background thread, which picks up the writes made outside the app.
+    Does nothing if it has already been started
+    """
+    state = app.extensions['readmodels']
+    if state['thread'] is not None:
+        return
+    poll = poll or app.config.get('READ_MODELS_POLL') or POLL
+    refresh_all(state['dbnames']())
+    state['thread'] = threading.Thread(target=follow, args=(state['dbnames'], poll),
+                                       name='read-models', daemon=True)
+    state['thread'].start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild or check the /view page documents')
+    parser.add_argument('--db', default=DBNAME)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('rebuild', help='rebuild every document from the tables')
+    commands.add_parser('refresh', help='rebuild the documents changed since the last refresh')
+    commands.add_parser('check', help='compare the documents with the tables')
+    command = commands.add_parser('follow', help='refresh the documents as the tables change')
+    command.add_argument('--poll', type=float, default=POLL, help='seconds between refreshes')
+    args = parser.parse_args()
+    read_models = ReadModels(args.db)
+
+    start = time.perf_counter()
+    if args.command == 'rebuild':
+        print(f'Rebuilt {read_models.rebuild()} documents in {time.perf_counter() - start:.2f}s')
+    elif args.command == 'refresh':
+        print(f'Refreshed {read_models.refresh()} documents in {time.perf_counter() - start:.2f}s')
+    elif args.command == 'follow':
+        print(f'Refreshed {read_models.refresh()} documents, following the changes')
+        follow(lambda: [args.db], args.poll)
+    elif args.command == 'check':
+        problems = read_models.check()
+        for kind, entity_id, problem in problems:
+            print(f'{kind} {entity_id}: {problem}')
+        print(f'{len(problems)} problems found' if problems else 'All documents are consistent')
+        if problems:
+            raise SystemExit(1)
@@ -0,0 +1,225 @@
+import argparse
+import os
+import re
+import sqlite3
+import time
+import pandas as pd
+from storage import DBNAME, TABLES, Students, CCAs, Activities
+
+
+class Reports:
+    """
+    Builds school-wide reports from whole-table reads.
+
+    Every table is read once with pandas.read_sql and the reports are
+    built with joins, groupby and pivot on the resulting DataFrames
+    instead of one query per student or CCA.
+
+    Methods:
+    --------
+    cca_rosters()
+    activity_hours()
+    student_summary()
+    class_summary()
+    write_cca_rosters(path)
+    write_activity_hours(path)
+    write_summary(path)
+    """
+    def __init__(self, dbname=DBNAME):
+        self._dbname = dbname
+        self._tables = None
+
+    def _load(self):
+        """Reads every table once and caches the DataFrames"""
+        if self._tables is None:
+            conn = sqlite3.connect(self._dbname)
+            self._tables = {tblname: pd.read_sql(f"SELECT * FROM '{tblname}';", conn)
+                            for tblname in TABLES}
+            conn.close()
+        return self._tables
+
+    def _students(self):
+        """Students joined with their class name"""
+        tables = self._load()
+        classes = tables['Classes'].rename(columns={'level': 'class_level'})
+        return tables['Students'].merge(classes, on='class_id', how='left')
+
+    def cca_rosters(self):
+        """Returns one row per CCA member, sorted by CCA then student name"""
+        tables = self._load()
+        roster = (tables['Students-CCAs']
+                  .merge(tables['CCAs'], on='cca_id')
+                  .merge(self._students(), on='student_id'))
+        roster = roster[['cca_name', 'type', 'student_id', 'student_name',
+                         'class_name', 'role']]
+        return roster.sort_values(['cca_name', 'student_name'], ignore_index=True)
+
+    def activity_hours(self):
+        """Returns activity hours per student (rows) and activity (columns),
+        with a Total column, indexed by class and student name
+        """
+        tables = self._load()
+        hours = (tables['Students-Activities']
+                 .merge(tables['Activities'][['activity_id', 'activity_name']],
+                        on='activity_id')
+                 .merge(self._students(), on='student_id'))
+        hours['hours'] = pd.to_numeric(hours['hours'], errors='coerce').fillna(0)
+        table = hours.pivot_table(index=['class_name', 'student_name'],
+                                  columns='activity_name', values='hours',
+                                  aggfunc='sum', fill_value=0)
+        table['Total'] = table.sum(axis=1)
+        return table
+
+    def student_summary(self):
+        """Returns the number of subjects, CCAs, activities and total activity
+        hours of every student
+        """
+        tables = self._load()
+        students = self._students()[['student_id', 'student_name', 'class_name',
+                                     'year_enrolled', 'grad_year']]
+        activities = tables['Students-Activities'].assign(
+            hours=pd.to_numeric(tables['Students-Activities']['hours'], errors='coerce'))
+        counts = pd.DataFrame({
+            'subjects': tables['Students-Subjects'].groupby('student_id').size(),
+            'ccas': tables['Students-CCAs'].groupby('student_id').size(),
+            'activities': activities.groupby('student_id').size(),
+            'hours': activities.groupby('student_id')['hours'].sum(),
+        })
+        summary = students.merge(counts, left_on='student_id', right_index=True, how='left')
+        summary[['subjects', 'ccas', 'activities', 'hours']] = (
+            summary[['subjects', 'ccas', 'activities', 'hours']].fillna(0))
+        return summary.sort_values(['class_name', 'student_name'], ignore_index=True)
+
+    def class_summary(self):
+        """Returns the class size, CCA participation and activity hours per class"""
+        summary = self.student_summary()
+        return summary.groupby('class_name').agg(
+            students=('student_id', 'count'),
+            students_without_cca=('ccas', lambda ccas: int((ccas == 0).sum())),
+            total_hours=('hours', 'sum'),
+            mean_hours=('hours', 'mean'),
+        ).reset_index()
+
+    def write_cca_rosters(self, path):
+        """Writes a Summary sheet and one roster sheet per CCA"""
+        roster = self.cca_rosters()
+        sheets = {'Summary': roster.groupby(['cca_name', 'type']).size()
+                                   .rename('members').reset_index()}
+        for cca_name, members in roster.groupby('cca_name'):
+            sheets[cca_name] = members.drop(columns=['cca_name', 'type'])
+        return _write_sheets(path, sheets)
+
+    def write_activity_hours(self, path):
+        """Writes one sheet of activity hours per class"""
+        hours = self.activity_hours()
+        sheets = {}
+        for class_name, table in hours.groupby(level='class_name'):
+            table = table.droplevel('class_name')
+            # keep only the activities someone in the class took part in
+            sheets[class_name] = table.loc[:, (table != 0).any()].reset_index()
+        return _write_sheets(path, sheets)
+
+    def write_summary(self, path):
+        """Writes the student and class summaries"""
+        return _write_sheets(path, {'Students': self.student_summary(),
+                                    'Classes': self.class_summary()})
+
+
+def _sheet_name(name, used):
+    """Returns a unique sheet name within Excel's 31 character limit"""
+    name = re.sub(r'[\[\]:*?/\\]', '_', str(name))[:31] or 'Sheet'
+    candidate = name
+    i = 1
+    while candidate.lower() in used:
+        suffix = f' ({i})'
+        candidate = name[:31 - len(suffix)] + suffix
+        i += 1
+    used.add(candidate.lower())
+    return candidate
+
+
+def _write_sheets(path, sheets):
+    """Writes a dict of DataFrames as sheets of an .xlsx workbook.
+    Falls back to a directory of CSV files (one per sheet) if no Excel
+    writer engine is installed. Returns the path written to.
+    """
+    used = set()
+    names = {_sheet_name(name, used): df for name, df in sheets.items()}
+    if not names:  # a workbook needs at least one sheet
+        names = {'Sheet1': pd.DataFrame()}
+    try:
+        with pd.ExcelWriter(path) as writer:
+            for name, df in names.items():
+                df.to_excel(writer, sheet_name=name, index=False)
+        return path
+    except ImportError:
+        if os.path.exists(path):
+            os.remove(path)
+        directory = os.path.splitext(path)[0]
+        os.makedirs(directory, exist_ok=True)
+        for name, df in names.items():
+            df.to_csv(os.path.join(directory, f'{name}.csv'), index=False)
+        return directory
+
+
+def per_entity_reports(dbname=DBNAME):
+    """Builds the CCA rosters and activity hours by looping over every
+    student with the Collection getters. Used as the baseline for compare().
+    """
+    students = Students(dbname)
+    ccas = CCAs(dbname)
+    activities = Activities(dbname)
+    rows = students._return("SELECT student_name FROM 'Students';", multi=True)
+
+    rosters = {}
+    hours = {}
+    for row in rows:
+        name = row['student_name']
+        student = students.get(name)
+        for cca in ccas.get_student(name) or []:
+            rosters.setdefault(cca['cca_name'], []).append(
+                (student['student_name'], student['class_name'], cca['role']))
+        for activity in activities.get_student(name) or []:
+            key = (student['class_name'], student['student_name'])
+            hours.setdefault(key, {})[activity['activity_name']] = activity['hours']
+    return rosters, hours
+
+
+def compare(dbname=DBNAME):
+    """Times the per-entity loop against the vectorized reports.
+    Returns a dict of timings in seconds.
+    """
+    start = time.perf_counter()
+    per_entity_reports(dbname)
+    per_entity = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reports = Reports(dbname)
+    reports.cca_rosters()
+    reports.activity_hours()
+    vectorized = time.perf_counter() - start
+
+    return {'per_entity': per_entity, 'vectorized': vectorized,
+            'speedup': per_entity / vectorized if vectorized else float('inf')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate school-wide reports')
+    parser.add_argument('--db', default=DBNAME)
+    parser.add_argument('--out', default='reports')
+    parser.add_argument('--compare', action='store_true',
+                        help='time the per-entity approach against the vectorized one')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    reports = Reports(args.db)
+    for filename, write in [('cca_rosters.xlsx', reports.write_cca_rosters),
+                            ('activity_hours.xlsx', reports.write_activity_hours),
+                            ('summary.xlsx', reports.write_summary)]:
+        print('Wrote', write(os.path.join(args.out, filename)))
+
+    if args.compare:
+        timings = compare(args.db)
+        print(f"per-entity: {timings['per_entity']:.3f}s  "
+              f"vectorized: {timings['vectorized']:.3f}s  "
+              f"speedup: {timings['speedup']:.1f}x")
@@ -0,0 +1,97 @@
+import argparse
+import os
+import random
+import sqlite3
+from storage import ReadModels, close_pool, create_tables, migrate
+
+FIRST_NAMES = ['ANG', 'CHIA', 'CUI', 'DYLAN', 'EMMA', 'FOO', 'GOH', 'HO', 'IAN',
+               'JOEL', 'KOH', 'LIM', 'MOSES', 'NG', 'ONG', 'PHUA', 'QUEK', 'RAJ',
+               'SIM', 'TAN', 'WONG', 'YEO', 'ZHANG']
+SUBJECTS = ['GP', 'PW', 'MATH', 'PHY', 'CHEM', 'BIO', 'ECONS', 'HIST', 'GEOG',
+            'LIT', 'COMPUTING', 'CHINESE']
+CCA_TYPES = ['Sports', 'Uniformed Groups', 'Performing Arts', 'Clubs and Societies']
+ROLES = ['Member', 'Member', 'Member', 'Vice-Captain', 'Captain']
+AWARDS = ['', '', 'Gold', 'Silver', 'Bronze']
+
+
+def populate(dbname, n_students=2000, n_classes=80, n_ccas=60, n_activities=400,
+             ccas_per_student=2, activities_per_student=5, seed=0):
+    """Fills a new database file with a synthetic school.
+    Every student takes 3 subjects and joins ccas_per_student CCAs and
+    activities_per_student activities.
+    """
+    close_pool(dbname)
+    if os.path.exists(dbname):
+        os.remove(dbname)
+    create_tables(dbname)
+    rng = random.Random(seed)
+
+    classes = [(i, f'{22 + i % 2}{i:02d}', 'J1' if i % 2 else 'J2')
+               for i in range(1, n_classes + 1)]
+    subjects = [(i * 3 + j + 1, subj, level)
+                for i, subj in enumerate(SUBJECTS)
+                for j, level in enumerate(['H1', 'H2', 'H3'])]
+    ccas = [(i, f'CCA {i:04d}', rng.choice(CCA_TYPES)) for i in range(1, n_ccas + 1)]
+    activities = []
+    for i in range(1, n_activities + 1):
+        month = rng.randint(1, 12)
+        day = rng.randint(1, 20)
+        activities.append((i, f'ACTIVITY {i:05d}', f'2022-{month:02d}-{day:02d}',
+                           f'2022-{month:02d}-{day + rng.randint(0, 8):02d}',
+                           f'Synthetic activity {i}'))
+    students = []
+    for i in range(1, n_students + 1):
+        name = f'{rng.choice(FIRST_NAMES)} {rng.choice(FIRST_NAMES)} {i:06d}'
+        students.append((i, name, 18, 2022, 2023, rng.randint(1, n_classes)))
+
+    students_subjects = []
+    students_ccas = []
+    students_activities = []
+    for student_id, *_ in students:
+        for subj_id in rng.sample(range(1, len(subjects) + 1), 3):
+            students_subjects.append((student_id, subj_id))
+        for cca_id in rng.sample(range(1, n_ccas + 1), min(ccas_per_student, n_ccas)):
+            students_ccas.append((student_id, cca_id, rng.choice(ROLES)))
+        for activity_id in rng.sample(range(1, n_activities + 1),
+                                      min(activities_per_student, n_activities)):
+            students_activities.append((student_id, activity_id, 'Participant',
+                                        rng.choice(AWARDS), rng.randint(1, 12)))
+
+    conn = sqlite3.connect(dbname)
+    with conn:
+        conn.executemany("""INSERT INTO 'Classes' (class_id, class_name, level)
+                            VALUES (?, ?, ?);""", classes)
+        conn.executemany("""INSERT INTO 'Subjects' (subj_id, subj_name, level)
+                            VALUES (?, ?, ?);""", subjects)
+        conn.executemany("""INSERT INTO 'CCAs' (cca_id, cca_name, type)
+                            VALUES (?, ?, ?);""", ccas)
+        conn.executemany("""INSERT INTO 'Activities' (activity_id, activity_name,
+                            start_date, end_date, description)
+                            VALUES (?, ?, ?, ?, ?);""", activities)
+        conn.executemany("""INSERT INTO 'Students' (student_id, student_name, age,
+                            year_enrolled, grad_year, class_id)
+                            VALUES (?, ?, ?, ?, ?, ?);""", students)
+        conn.executemany("""INSERT INTO 'Students-Subjects' (student_id, subj_id)
+                            VALUES (?, ?);""", students_subjects)
+        conn.executemany("""INSERT INTO 'Students-CCAs' (student_id, cca_id, role)
+                            VALUES (?, ?, ?);""", students_ccas)
+        conn.executemany("""INSERT INTO 'Students-Activities' (student_id, activity_id,
+                            role, award, hours)
+                            VALUES (?, ?, ?, ?, ?);""", students_activities)
+    conn.close()
+    # fill in the normalized name columns
+    migrate(dbname)
+    # the /view documents, which the app does not build when pages are looked up
+    ReadModels(dbname).rebuild()
+    close_pool(dbname)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create a database filled with a synthetic school')
+    parser.add_argument('dbname')
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--classes', type=int, default=80)
+    parser.add_argument('--ccas', type=int, default=60)
+    parser.add_argument('--activities', type=int, default=400)
+    args = parser.parse_args()
+    populate(args.dbname, args.students, args.classes, args.ccas, args.activities)
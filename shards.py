@@ -0,0 +1,74 @@
+import argparse
+import csv
+import os
+from backup import backup
+from storage import TABLES, Collection, Router, close_pool
+
+SHARD_DIR = os.environ.get('CCA_SHARD_DIR', 'shards')
+
+
+def create(router, school, source=None):
+    """Creates the shard of a new school, empty or as an online copy of
+    the database file source. Returns its database file
+    """
+    if school.lower() in router.schools():
+        raise ValueError(f'{school} already has a shard')
+    if source is None:
+        return router.create(school)
+    os.makedirs(router.directory, exist_ok=True)
+    dbname = os.path.join(router.directory, f'{school.lower()}.db')
+    close_pool(dbname)
+    backup(dbname, source)
+    return router.dbname(school)
+
+
+def export(router, tblname, path):
+    """Writes tblname from every shard into one CSV file with a leading
+    school column. Rows are streamed one shard at a time.
+    Returns {school: rows written}
+    """
+    counts = {}
+    with open(path, 'w', newline='') as f:
+        writer = None
+        for school in router.schools():
+            with router.use(school):
+                rows = Collection(tblname)._return(f"SELECT * FROM '{tblname}';", stream=True)
+                counts[school] = 0
+                for row in rows:
+                    # leave out the storage layer's own columns
+                    keys = [key for key in row.keys()
+                            if not key.endswith('_norm') and key != 'source_hash']
+                    if writer is None:
+                        writer = csv.writer(f)
+                        writer.writerow(['school', *keys])
+                    writer.writerow([school, *[row[key] for key in keys]])
+                    counts[school] += 1
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the per-school database shards')
+    parser.add_argument('--dir', default=SHARD_DIR, help='shard directory (CCA_SHARD_DIR)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('create', help='create the shard of a new school')
+    command.add_argument('school')
+    command.add_argument('--from', dest='source', help='copy this database into the shard')
+    commands.add_parser('stats', help='size, rows and pool usage of every shard')
+    command = commands.add_parser('export', help='export a table from every shard to one CSV')
+    command.add_argument('path')
+    command.add_argument('--table', default='Students', choices=TABLES)
+    args = parser.parse_args()
+    router = Router(args.dir)
+
+    if args.command == 'create':
+        print('Created', create(router, args.school, args.source))
+    elif args.command == 'stats':
+        print(f"{'school':16} {'MiB':>8} {'pages':>8} {'free':>6} {'students':>9} {'rows':>9}")
+        for school, stats in router.stats().items():
+            print(f"{school:16} {stats['bytes'] / 2**20:8.2f} {stats['pages']:8} "
+                  f"{stats['free_pages']:6} {stats['rows'].get('Students', 0):9} "
+                  f"{sum(stats['rows'].values()):9}")
+    elif args.command == 'export':
+        counts = export(router, args.table, args.path)
+        print(f'Exported {sum(counts.values())} {args.table} rows from '
+              f'{len(counts)} schools to {args.path}')
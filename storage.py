@@ -1,6 +1,841 @@
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import queue
+import re
 import sqlite3
+import threading
+import warnings
 import pandas as pd
-DBNAME = "webapp_database.db"
+from datetime import datetime
+# CCA_DATABASE points the app at another database file, e.g. a seeded copy
+DBNAME = os.environ.get("CCA_DATABASE", "webapp_database.db")
+
+# Table definitions of webapp_database.db, used to set up new database files
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS "Classes" (
+	"class_id"	INTEGER,
+	"class_name"	TEXT NOT NULL,
+	"level"	TEXT,
+	PRIMARY KEY("class_id")
+);
+CREATE TABLE IF NOT EXISTS "Students" (
+	`student_id`	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	`student_name`	TEXT NOT NULL,
+	`age`	INTEGER,
+	`year_enrolled`	INTEGER,
+	`grad_year`	INTEGER,
+	`class_id`	INTEGER,
+	FOREIGN KEY(`class_id`) REFERENCES `Classes`(`class_id`)
+);
+CREATE TABLE IF NOT EXISTS "Subjects" (
+	"subj_id"	INTEGER,
+	"subj_name"	TEXT NOT NULL,
+	"level"	TEXT NOT NULL,
+	PRIMARY KEY("subj_id")
+);
+CREATE TABLE IF NOT EXISTS "CCAs" (
+	"cca_id"	INTEGER,
+	"cca_name"	TEXT NOT NULL,
+	"type"	TEXT,
+	PRIMARY KEY("cca_id")
+);
+CREATE TABLE IF NOT EXISTS "Activities" (
+	"activity_id"	INTEGER,
+	"activity_name"	TEXT NOT NULL,
+	"start_date"	TEXT NOT NULL,
+	"end_date"	TEXT,
+	"description"	TEXT NOT NULL,
+	PRIMARY KEY("activity_id")
+);
+CREATE TABLE IF NOT EXISTS "Students-Subjects" (
+	"student_id"	INTEGER,
+	"subj_id"	INTEGER,
+	PRIMARY KEY("student_id","subj_id"),
+	FOREIGN KEY("student_id") REFERENCES "Students"("student_id"),
+	FOREIGN KEY("subj_id") REFERENCES "Subjects"("subj_id")
+);
+CREATE TABLE IF NOT EXISTS "Students-CCAs" (
+	"student_id"	INTEGER,
+	"cca_id"	INTEGER,
+	"role"	TEXT DEFAULT 'member',
+	PRIMARY KEY("student_id","cca_id"),
+	FOREIGN KEY("student_id") REFERENCES "CCAs"("cca_id"),
+	FOREIGN KEY("cca_id") REFERENCES "Students"("student_id")
+);
+CREATE TABLE IF NOT EXISTS "Students-Activities" (
+	"student_id"	INTEGER,
+	"activity_id"	INTEGER,
+	"role"	TEXT NOT NULL DEFAULT 'participant',
+	"award"	TEXT,
+	"hours"	INTEGER,
+	PRIMARY KEY("student_id","activity_id"),
+	FOREIGN KEY("student_id") REFERENCES "Students"("student_id"),
+	FOREIGN KEY("activity_id") REFERENCES "Activities"("activity_id")
+);
+"""
+
+
+# (table, name column, columns that must be unique together with the name)
+NAME_COLUMNS = [
+    ('Students', 'student_name', ()),
+    ('Classes', 'class_name', ()),
+    ('CCAs', 'cca_name', ()),
+    ('Activities', 'activity_name', ()),
+    ('Subjects', 'subj_name', ('level',)),
+]
+
+
+# (table, column, declaration) of columns added to the original tables
+COLUMNS = [
+    ('Students', 'source_hash', 'TEXT'), # fingerprint of the imported source row
+    ('CCAs', 'source_hash', 'TEXT'),
+]
+TABLES = ['Students', 'Classes', 'Subjects', 'CCAs', 'Activities',
+          'Students-Subjects', 'Students-CCAs', 'Students-Activities']
+# Change log written by triggers on every table in TABLES; versions are
+# AUTOINCREMENT so they are never reused, even after compaction
+CHANGES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS "Changes" (
+	"version"	INTEGER PRIMARY KEY AUTOINCREMENT,
+	"table_name"	TEXT NOT NULL,
+	"operation"	TEXT NOT NULL,
+	"row_key"	TEXT NOT NULL,
+	"old"	TEXT,
+	"new"	TEXT,
+	"changed_at"	TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# one JSON document per /view page, see ReadModels
+READ_MODELS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS "ReadModels" (
+	"kind"	TEXT NOT NULL,
+	"entity_id"	INTEGER NOT NULL,
+	"name"	TEXT NOT NULL,
+	"name_norm"	TEXT NOT NULL,
+	"doc"	TEXT NOT NULL,
+	PRIMARY KEY("kind","entity_id")
+);
+CREATE INDEX IF NOT EXISTS "ReadModels_name_norm" ON "ReadModels" ("kind", "name_norm");
+CREATE TABLE IF NOT EXISTS "ReadModelsVersion" (
+	"version"	INTEGER NOT NULL
+);
+"""
+
+# julian day numbers of an activity's first and last day; an activity
+# without an end date lasts one day. Date-range queries must use these
+# exact expressions for SQLite to use the Activities_days index
+START_DAY = "julianday(start_date)"
+END_DAY = "COALESCE(julianday(end_date), julianday(start_date))"
+# indexes for the date-range queries of Activities: activities are found by
+# their last day first, as "what's on" ranges are recent ones that most
+# activities ended before; participants and hours are then read from the
+# activity_id index without touching the junction table
+DATE_INDEXES = f"""
+CREATE INDEX IF NOT EXISTS "Activities_days" ON "Activities" ({END_DAY}, {START_DAY});
+CREATE INDEX IF NOT EXISTS "Students-Activities_activity_id"
+ON "Students-Activities" ("activity_id", "student_id", "hours");
+"""
+
+
+def normalize(name):
+    """Returns name casefolded with its whitespace collapsed, as stored in
+    the *_norm columns
+    """
+    return ' '.join(str(name).split()).casefold()
+
+
+def iso_date(date):
+    """Returns date as stored in Activities: YYYY-MM-DD, the only form
+    julianday() reads (' 2024-3-1' -> '2024-03-01'). Empty and unreadable
+    dates are returned as they are
+    """
+    if not date:
+        return date
+    try:
+        return datetime.strptime(str(date).strip(), '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        return date
+
+
+def create_tables(dbname):
+    """Creates the tables of webapp_database.db in dbname if they do not exist"""
+    conn = sqlite3.connect(dbname)
+    # only takes effect before the first table is created: lets
+    # maintenance.py give the pages of deleted rows back bit by bit
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+    conn.executescript(SCHEMA)
+    conn.close()
+    migrate(dbname)
+
+
+def migrate(dbname):
+    """Brings an existing database up to date with the current storage layer.
+    Safe to run repeatedly.
+
+    - adds a {name}_norm column (normalize()d name, COLLATE NOCASE) to every
+      table in NAME_COLUMNS, fills it in for rows that do not have it yet,
+      and puts a unique index on it
+    - adds the COLUMNS that are missing
+    - creates the Changes log and (re)creates its triggers on every table
+      in TABLES, so they cover the current columns
+    - creates the ReadModels tables (filled in by ReadModels.rebuild)
+    - creates the DATE_INDEXES
+    - rewrites the Activities dates that are not YYYY-MM-DD (see iso_date)
+    """
+    conn = sqlite3.connect(dbname)
+    with conn:
+        for tblname, column, declaration in COLUMNS:
+            _add_column(conn, tblname, column, declaration)
+        for tblname, name_key, unique_with in NAME_COLUMNS:
+            norm_key = f'{name_key}_norm'
+            _add_column(conn, tblname, norm_key, 'TEXT COLLATE NOCASE')
+            rows = conn.execute(f"""
+                                SELECT rowid, {name_key}
+                                FROM '{tblname}'
+                                WHERE {norm_key} IS NULL;
+                                """).fetchall()
+            conn.executemany(f"UPDATE '{tblname}' SET {norm_key} = ? WHERE rowid = ?;",
+                             [(normalize(name), rowid) for rowid, name in rows])
+
+    for tblname, name_key, unique_with in NAME_COLUMNS:
+        index_columns = ', '.join([f"'{name_key}_norm' COLLATE NOCASE", *unique_with])
+        query = f"""
+                CREATE UNIQUE INDEX IF NOT EXISTS '{tblname}_{name_key}_norm'
+                ON '{tblname}' ({index_columns});
+                """
+        try:
+            with conn:
+                conn.execute(query)
+        except sqlite3.IntegrityError:
+            # existing duplicate names; still index the column for lookups
+            warnings.warn(f'{tblname} has duplicate names, {name_key}_norm is not unique')
+            with conn:
+                conn.execute(query.replace('UNIQUE INDEX', 'INDEX'))
+
+    with conn:
+        conn.execute(CHANGES_SCHEMA)
+        for tblname in TABLES:
+            _create_change_triggers(conn, tblname)
+    conn.executescript(READ_MODELS_SCHEMA)
+    conn.executescript(DATE_INDEXES)
+    with conn:
+        rows = conn.execute("""
+                            SELECT activity_id, start_date, end_date
+                            FROM 'Activities'
+                            WHERE start_date NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+                            OR end_date NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]';
+                            """).fetchall()
+        dates = [(iso_date(start_date), iso_date(end_date), activity_id)
+                 for activity_id, start_date, end_date in rows]
+        conn.executemany("UPDATE 'Activities' SET start_date = ?, end_date = ? WHERE activity_id = ?;",
+                         [row for row, old in zip(dates, rows) if row[:2] != old[1:]])
+    conn.close()
+
+
+def _add_column(conn, tblname, column, declaration):
+    """Adds a column to a table unless it already has it"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info('{tblname}');")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE '{tblname}' ADD COLUMN '{column}' {declaration};")
+
+
+def _create_change_triggers(conn, tblname):
+    """Creates the insert, update and delete triggers that log tblname's
+    changes to Changes, replacing any that were made for other columns.
+    The row key and the old/new rows are stored as JSON objects; the
+    storage layer's own columns (*_norm, source_hash) are left out.
+    """
+    info = conn.execute(f"PRAGMA table_info('{tblname}');").fetchall()
+    columns = [row[1] for row in info
+               if not row[1].endswith('_norm') and row[1] != 'source_hash']
+    keys = [row[1] for row in sorted(info, key=lambda row: row[5]) if row[5]]
+
+    def as_json(ref, names):
+        return 'json_object(' + ', '.join(f"'{name}', {ref}.\"{name}\"" for name in names) + ')'
+
+    quoted = ', '.join(f'"{column}"' for column in columns)
+    changed = ' OR '.join(f'OLD."{column}" IS NOT NEW."{column}"' for column in columns)
+    triggers = {
+        'insert': ('INSERT', 'NEW', 'NULL', as_json('NEW', columns)),
+        'update': (f'UPDATE OF {quoted}', 'NEW', as_json('OLD', columns), as_json('NEW', columns)),
+        'delete': ('DELETE', 'OLD', as_json('OLD', columns), 'NULL'),
+    }
+    existing = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger';"))
+    for operation, (event, ref, old, new) in triggers.items():
+        name = f'{tblname}_changes_{operation}'
+        # updates that leave every logged column as it was are not changes
+        when = f'\nWHEN {changed}' if operation == 'update' else ''
+        sql = (f'CREATE TRIGGER "{name}" AFTER {event} ON "{tblname}"{when}\n'
+               f'BEGIN\n'
+               f'    INSERT INTO "Changes" ("table_name", "operation", "row_key", "old", "new")\n'
+               f"    VALUES ('{tblname}', '{operation}', {as_json(ref, keys)}, {old}, {new});\n"
+               f'END')
+        if existing.get(name) != sql:
+            conn.execute(f'DROP TRIGGER IF EXISTS "{name}";')
+            conn.execute(sql)
+
+
+_migrated = set() # databases migrated by this process
+_migrated_lock = threading.Lock()
+
+
+def _ensure_migrated(dbname):
+    """Runs migrate() on dbname the first time this process uses it, and
+    builds its ReadModels documents if they have never been built (once
+    per database file; after that they are refreshed, see readmodels.py)
+    """
+    if dbname not in _migrated:
+        with _migrated_lock:
+            if dbname not in _migrated:
+                migrate(dbname)
+                _migrated.add(dbname)
+                conn = sqlite3.connect(dbname)
+                try:
+                    built = conn.execute("SELECT 1 FROM 'ReadModelsVersion' LIMIT 1;").fetchone()
+                finally:
+                    conn.close()
+                if built is None:
+                    ReadModels(dbname).rebuild()
+
+
+# engine settings applied to every pooled connection, picked with
+# CCA_DB_PROFILE. journal_mode = WAL is stored in the database file, so
+# switching back to 'default' keeps WAL until it is set to DELETE by hand
+PROFILES = {
+    # SQLite's own defaults: rollback journal, full sync, 2 MiB cache
+    'default': [],
+    # WAL lets readers run during a write; every commit is still synced
+    'durable': ['journal_mode = WAL',
+                'synchronous = FULL',
+                'cache_size = -16384'],
+    # in WAL a crash can lose the last commits but never corrupts the file
+    'balanced': ['journal_mode = WAL',
+                 'synchronous = NORMAL',
+                 'cache_size = -32768',
+                 'temp_store = MEMORY'],
+    # reads go through a 256 MiB memory map instead of read() calls
+    'read-heavy': ['journal_mode = WAL',
+                   'synchronous = NORMAL',
+                   'cache_size = -65536',
+                   'temp_store = MEMORY',
+                   'mmap_size = 268435456'],
+}
+PROFILE = os.environ.get('CCA_DB_PROFILE', 'default')
+# seconds a thread waits for a pooled connection when every one is in use
+POOL_TIMEOUT = float(os.environ.get('CCA_POOL_TIMEOUT', 30))
+
+
+class ConnectionPool:
+    """
+    A pool of up to size reusable connections to one database file.
+    Connections are shared between threads, but only one thread holds a
+    connection at a time. Every connection is set up with the PRAGMAs of
+    an engine profile from PROFILES.
+
+    Parameters:
+    dbname
+    size (defaults to 8)
+    profile (defaults to PROFILE, from CCA_DB_PROFILE)
+    timeout (seconds to wait for a connection when all size are in use,
+             defaults to POOL_TIMEOUT, from CCA_POOL_TIMEOUT)
+
+    Methods:
+    connection()
+    close()
+    """
+    def __init__(self, dbname, size=8, profile=None, timeout=None):
+        profile = profile or PROFILE
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown profile {profile!r}, choose from {', '.join(PROFILES)}")
+        self.dbname = dbname
+        self.profile = profile
+        self._size = size
+        self._timeout = POOL_TIMEOUT if timeout is None else timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.stats = {'opened': 0, 'checkouts': 0, 'waits': 0}
+
+    def __repr__(self):
+        return f'ConnectionPool({self.dbname!r}, size={self._size}, profile={self.profile!r})'
+
+    def _checkout(self):
+        with self._lock:
+            self.stats['checkouts'] += 1
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            opening = self.stats['opened'] < self._size
+            if opening:
+                self.stats['opened'] += 1
+            else:
+                self.stats['waits'] += 1
+        if opening:
+            # outside the lock: setting journal_mode may wait for other connections
+            try:
+                return self._open()
+            except sqlite3.Error:
+                with self._lock:
+                    self.stats['opened'] -= 1
+                raise
+        # every connection is in use: wait for one to come back
+        try:
+            return self._idle.get(timeout=self._timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(
+                f'No connection to {self.dbname} was returned within {self._timeout:g}s: '
+                f'all {self._size} are in use (is a streamed read left unfinished?)') from None
+
+    def _open(self):
+        conn = sqlite3.connect(self.dbname, check_same_thread=False)
+        for pragma in PROFILES[self.profile]:
+            conn.execute(f'PRAGMA {pragma};')
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Lends out a connection for the duration of a with block.
+        Anything left uncommitted is rolled back when it is returned
+        """
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = None
+            self._idle.put(conn)
+
+    def close(self):
+        """Closes the idle connections"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self.stats['opened'] = 0
+
+
+class _JournalledCursor:
+    """A cursor of a _JournalledConnection: its execute() and executemany()
+    go through the connection, everything else is the sqlite3 cursor's
+    """
+    def __init__(self, conn, cursor):
+        self._journalled = conn
+        self._cursor = cursor
+
+    def execute(self, sql, parameters=()):
+        self._journalled._run(self._cursor.execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._journalled._run(self._cursor.executemany, sql, list(seq_of_parameters), many=True)
+        return self
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _JournalledConnection:
+    """
+    The connection MemoryBackend lends out: an sqlite3 connection that
+    hands every write statement it runs, with its parameters, to
+    backend._record. Only the statements the Collections run are seen, not
+    the ones their triggers run, which the replay runs again by itself.
+
+    Methods:
+    execute(sql, parameters)
+    executemany(sql, seq_of_parameters)
+    cursor()
+    commit()
+    rollback()
+    """
+    def __init__(self, backend, conn):
+        self._backend = backend
+        self._conn = conn
+
+    def _run(self, execute, sql, parameters, many=False):
+        changes = self._conn.total_changes
+        result = execute(sql, parameters)
+        # after it ran, so a failed statement is never journalled
+        self._backend._record(sql, parameters, many, self._conn.total_changes != changes)
+        return result
+
+    def execute(self, sql, parameters=()):
+        return self._run(self._conn.execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(self._conn.executemany, sql, list(seq_of_parameters), many=True)
+
+    def cursor(self):
+        return _JournalledCursor(self, self._conn.cursor())
+
+    def commit(self):
+        self._conn.commit()
+        self._backend._record('COMMIT', ())
+
+    def rollback(self):
+        self._conn.rollback()
+        self._backend._record('ROLLBACK', ())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    @property
+    def row_factory(self):
+        return self._conn.row_factory
+
+    @row_factory.setter
+    def row_factory(self, row_factory):
+        self._conn.row_factory = row_factory
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class MemoryBackend:
+    """
+    Keeps a whole database in memory, for kiosks, demos and fast test runs.
+    Offers the same connection() as ConnectionPool, so every Collection
+    works unchanged on it.
+
+    The database file is loaded into one in-memory SQLite connection that
+    threads take turns to use. Every committed write statement the
+    Collections run is appended, with its parameters, to an append-only
+    journal (dbname + '.journal', one JSON transaction per line), and a snapshot is written back to dbname every snapshot_interval
+    seconds, after which the journal is emptied. On startup the last
+    snapshot is loaded and the journal replayed on top of it, so a crash
+    loses at most the transaction being written. A journalled transaction
+    that no longer applies (the snapshot is older, or the schema has
+    changed) stops the replay with an error rather than lose its writes.
+
+    Parameters:
+    dbname
+    snapshot_interval (defaults to 60 seconds; None to only snapshot on close)
+    fsync (defaults to False; True to sync the journal on every commit)
+
+    Methods:
+    connection()
+    snapshot()
+    close()
+    """
+    _writes = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'DROP', 'ALTER')
+
+    def __init__(self, dbname, snapshot_interval=60, fsync=False):
+        self.dbname = dbname
+        self.journal = dbname + '.journal'
+        self._fsync = fsync
+        self._lock = threading.RLock()
+        self._depth = 0 # nested connection() calls by the thread holding the lock
+        self._pending = [] # statements of the open transaction
+        self.stats = {'opened': 1, 'checkouts': 0, 'waits': 0,
+                      'journaled': 0, 'replayed': 0, 'snapshots': 0}
+
+        self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+        source = sqlite3.connect(dbname)
+        try:
+            source.backup(self._conn)
+        finally:
+            source.close()
+        self._seq = self._snapshot_seq = self._conn.execute('PRAGMA user_version;').fetchone()[0]
+        self._replay()
+        self._journal = open(self.journal, 'a')
+        self._lent = _JournalledConnection(self, self._conn)
+
+        self._closed = threading.Event()
+        self._thread = None
+        if snapshot_interval is not None:
+            self._thread = threading.Thread(target=self._snapshot_every, args=(snapshot_interval,),
+                                            daemon=True)
+            self._thread.start()
+
+    def __repr__(self):
+        return f'MemoryBackend({self.dbname!r})'
+
+    def _replay(self):
+        """Applies the journalled transactions that are newer than the snapshot"""
+        if not os.path.exists(self.journal):
+            return
+        with open(self.journal) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break # the last line was cut short by a crash
+                if entry['seq'] <= self._seq:
+                    continue
+                try:
+                    with self._conn:
+                        for statement in entry['statements']:
+                            run = self._conn.executemany if statement.get('many') else self._conn.execute
+                            run(statement['sql'], statement['parameters'])
+                except sqlite3.Error as e:
+                    # only committed transactions are journalled: skipping one loses its writes
+                    raise sqlite3.DatabaseError(
+                        f"Cannot replay transaction {entry['seq']} of {self.journal} "
+                        f"on {self.dbname}: {e}") from e
+                self._seq = entry['seq']
+                self.stats['replayed'] += 1
+
+    def _record(self, sql, parameters, many=False, changed=False):
+        """Collects the write statements of a transaction (and those that
+        changed rows, e.g. WITH ... INSERT) and journals them on commit
+        """
+        verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+        if verb in ('COMMIT', 'END'):
+            self._write_journal(self._pending)
+            self._pending = []
+        elif verb == 'ROLLBACK':
+            self._pending = []
+        elif verb in self._writes or changed:
+            statement = {'sql': sql, 'parameters': parameters}
+            if many:
+                statement['many'] = True
+            self._pending.append(statement)
+            if not self._conn.in_transaction:
+                # autocommitted, e.g. CREATE outside of a transaction
+                self._write_journal(self._pending)
+                self._pending = []
+
+    def _write_journal(self, statements):
+        if not statements:
+            return
+        self._seq += 1
+        self._journal.write(json.dumps({'seq': self._seq, 'statements': statements}) + '\n')
+        self._journal.flush()
+        if self._fsync:
+            os.fsync(self._journal.fileno())
+        self.stats['journaled'] += 1
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Lends out the in-memory connection for the duration of a with block.
+        Anything left uncommitted is rolled back when it is returned
+        """
+        if not self._lock.acquire(blocking=False):
+            self.stats['waits'] += 1
+            self._lock.acquire()
+        self.stats['checkouts'] += 1
+        self._depth += 1
+        try:
+            yield self._lent
+        finally:
+            self._depth -= 1
+            # a nested block must not end its caller's transaction
+            if self._depth == 0:
+                if self._conn.in_transaction:
+                    self._lent.rollback()
+                self._conn.row_factory = None
+            self._lock.release()
+
+    def snapshot(self):
+        """Writes the database back to dbname and empties the journal"""
+        with self._lock:
+            if self._seq == self._snapshot_seq or self._conn.in_transaction:
+                return
+            # user_version records which journal entries the snapshot contains
+            self._conn.execute(f'PRAGMA user_version = {self._seq};')
+            target = sqlite3.connect(self.dbname)
+            try:
+                self._conn.backup(target)
+            finally:
+                target.close()
+            self._journal.truncate(0)
+            self._snapshot_seq = self._seq
+            self.stats['snapshots'] += 1
+
+    def _snapshot_every(self, interval):
+        while not self._closed.wait(interval):
+            self.snapshot()
+
+    def close(self):
+        """Takes a last snapshot and releases the database"""
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+            self.snapshot()
+            self._journal.close()
+            self._conn.close()
+
+
+# storage backends, picked with CCA_BACKEND
+BACKENDS = {'sqlite': ConnectionPool, 'memory': MemoryBackend}
+BACKEND = os.environ.get('CCA_BACKEND', 'sqlite')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(dbname):
+    """Returns the backend of dbname (a ConnectionPool unless CCA_BACKEND
+    says otherwise), creating it on first use
+    """
+    pool = _pools.get(dbname)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(dbname)
+            if pool is None:
+                if BACKEND not in BACKENDS:
+                    raise ValueError(f"Unknown backend {BACKEND!r}, choose from {', '.join(BACKENDS)}")
+                pool = _pools[dbname] = BACKENDS[BACKEND](dbname)
+    return pool
+
+
+def open_backend(dbname, backend, **options):
+    """Serves dbname from backend (a name in BACKENDS) from now on, e.g.
+    open_backend('demo.db', 'memory', snapshot_interval=None).
+    Returns the backend
+    """
+    _ensure_migrated(dbname)
+    close_pool(dbname)
+    _migrated.add(dbname)
+    with _pools_lock:
+        pool = _pools[dbname] = BACKENDS[backend](dbname, **options)
+    return pool
+
+
+def close_pool(dbname):
+    """Closes and forgets the pool of dbname, e.g. before the file is replaced"""
+    with _pools_lock:
+        pool = _pools.pop(dbname, None)
+    if pool is not None:
+        pool.close()
+    _migrated.discard(dbname)
+
+
+# database of the school selected for the current request (see Router.use)
+_current_db = contextvars.ContextVar('current_db', default=None)
+# context managers entered around every Collection query as probe(query),
+# added by opt-in instrumentation (see memprofile.py, profiling.py).
+# A streamed read is probed until its first row, not until it is exhausted
+QUERY_PROBES = []
+
+
+def _probed(query):
+    """Returns a context manager entering every QUERY_PROBES probe for query"""
+    if not QUERY_PROBES:
+        return contextlib.nullcontext()
+    stack = contextlib.ExitStack()
+    try:
+        for probe in QUERY_PROBES:
+            stack.enter_context(probe(query))
+    except BaseException:
+        stack.close()
+        raise
+    return stack
+
+
+class Router:
+    """
+    Maps each school to its own database file (shard) in directory, each
+    with its own connection pool, so schools do not share a write lock or
+    page cache. Collections created without a dbname run their queries
+    against the shard selected with use().
+
+    Parameters:
+    directory: folder holding one <school>.db per school
+
+    Methods:
+    dbname(school)
+    schools()
+    create(school)
+    select(school)
+    reset(token)
+    use(school)
+    stats()
+    """
+    _school_pattern = re.compile(r'[a-z0-9][a-z0-9_-]*')
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __repr__(self):
+        return f'Router({self.directory!r})'
+
+    def dbname(self, school):
+        """Returns the database file of school.
+        Raises KeyError if there is no such school
+        """
+        school = str(school).lower()
+        if not self._school_pattern.fullmatch(school):
+            raise KeyError(school)
+        dbname = os.path.join(self.directory, f'{school}.db')
+        if not os.path.exists(dbname):
+            raise KeyError(school)
+        _ensure_migrated(dbname)
+        return dbname
+
+    def schools(self):
+        """Returns the schools that have a shard, sorted"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(filename[:-3] for filename in os.listdir(self.directory)
+                      if filename.endswith('.db') and self._school_pattern.fullmatch(filename[:-3]))
+
+    def create(self, school):
+        """Creates an empty shard for a new school. Returns its database file"""
+        school = str(school).lower()
+        if not self._school_pattern.fullmatch(school):
+            raise ValueError(f'Invalid school name: {school!r}')
+        os.makedirs(self.directory, exist_ok=True)
+        create_tables(os.path.join(self.directory, f'{school}.db'))
+        return self.dbname(school)
+
+    def select(self, school):
+        """Routes Collection queries in the current context to school's shard
+        until reset(token) is called with the token this returns.
+        Raises KeyError if there is no such school
+        """
+        return _current_db.set(self.dbname(school))
+
+    def reset(self, token):
+        """Undoes a select()"""
+        _current_db.reset(token)
+
+    @contextlib.contextmanager
+    def use(self, school):
+        """Routes the Collection queries in a with block to school's shard"""
+        token = self.select(school)
+        try:
+            yield
+        finally:
+            self.reset(token)
+
+    def stats(self):
+        """Returns {school: {'bytes', 'pages', 'free_pages', 'rows', **pool stats}}"""
+        stats = {}
+        for school in self.schools():
+            dbname = self.dbname(school)
+            with get_pool(dbname).connection() as conn:
+                tables = [name for name, in conn.execute("""
+                            SELECT name FROM sqlite_master
+                            WHERE type = 'table' AND name NOT LIKE 'sqlite_%';""")]
+                stats[school] = {
+                    'bytes': os.path.getsize(dbname),
+                    'pages': conn.execute('PRAGMA page_count;').fetchone()[0],
+                    'free_pages': conn.execute('PRAGMA freelist_count;').fetchone()[0],
+                    'rows': {tblname: conn.execute(f"SELECT COUNT(*) FROM '{tblname}';").fetchone()[0]
+                             for tblname in tables},
+                    **get_pool(dbname).stats,
+                }
+        return stats
+
 
 class Collection:
     """
@@ -8,47 +843,131 @@ class Collection:
 
     Parameters:
     tblname
+    dbname (defaults to the shard selected with Router.use, or DBNAME)
 
     Methods:
     _execute(query, values=None)
-    _return(query, values=None, multi=False)
+    _execute_all(statements)
+    _insert(query, values)
+    _return(query, values=None, multi=False, stream=False)
+    _fetch(query, values=None, multi=False, stream=False)
+    _stream(query, values=None)
     _is_exist(tblname, left_key, left_value, right_key=None, right_value=None)
+    _return_match(query, names, multi=False, stream=False)
     _display(row_list)
+    _id_query(tblname, name_key, id_key, param)
     _retrieve_id(tblname, name, name_key, id_key, like=False)
+    resolve_ids(names, like=False)
     display_all()
     """
-    def __init__(self, tblname):
-        self._dbname = DBNAME
+    # name and id columns of the collection's table, used by resolve_ids
+    _name_key = None
+    _id_key = None
+    # rows fetched at a time by streamed results
+    _batch_size = 500
+
+    def __init__(self, tblname, dbname=None):
+        self._fixed_dbname = dbname
         self._tblname = tblname
+        if dbname is not None:
+            _ensure_migrated(dbname)
+
+    @property
+    def _dbname(self):
+        """The database file queries run against"""
+        dbname = self._fixed_dbname or _current_db.get()
+        if dbname is None:
+            # no shard selected; Router.dbname migrates the shards
+            dbname = DBNAME
+            _ensure_migrated(dbname)
+        return dbname
+
+    def _connection(self):
+        """Borrows a connection to the database from its backend (see get_pool)"""
+        return get_pool(self._dbname).connection()
 
     def __repr__(self):
         return f'Collection({self.tblname})'
 
     def _execute(self, query, values=None):
-        conn = sqlite3.connect(self._dbname)
-        c = conn.cursor()
-        if values is None:
-            c.execute(query)
-        else:
-            c.execute(query, values)
-        conn.commit()
-        conn.close()
-
-    def _return(self, query, values=None, multi=False):
-        conn = sqlite3.connect(self._dbname)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        if values is None:
-            c.execute(query)
-        else:
-            c.execute(query, values)
-        if multi:
-            row = c.fetchall()
-        else:
-            row = c.fetchone()
-        conn.close()
+        with _probed(query), self._connection() as conn:
+            c = conn.cursor()
+            if values is None:
+                c.execute(query)
+            else:
+                c.execute(query, values)
+            rowcount = c.rowcount
+            conn.commit()
+        return rowcount # number of rows changed by the query
+
+    def _insert(self, query, values):
+        """Runs an INSERT ... ON CONFLICT DO NOTHING RETURNING statement.
+        Returns the returned row, or None if nothing was inserted because
+        a UNIQUE constraint was hit (or an INSERT ... SELECT selected nothing)
+        """
+        with _probed(query), self._connection() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(query, values).fetchall()
+            conn.commit()
+        return rows[0] if rows else None
+
+    def _execute_all(self, statements):
+        """Executes a list of (query, values) in a single transaction.
+        Returns the number of rows changed by each query
+        """
+        rowcounts = []
+        with self._connection() as conn, conn:
+            for query, values in statements:
+                with _probed(query):
+                    rowcounts.append(conn.execute(query, values).rowcount)
+        return rowcounts
+
+    def _return(self, query, values=None, multi=False, stream=False):
+        """Returns the first row, or all rows if multi=True.
+        stream=True returns the rows lazily instead (see _stream), or []
+        if there are none, so the `== []` checks work for both. The
+        QUERY_PROBES then only see the query run and its first row fetched:
+        the rest are fetched while the caller (a streamed page) renders, and
+        timing them would count the rendering too
+        """
+        with _probed(query):
+            return self._fetch(query, values, multi, stream)
+
+    def _fetch(self, query, values=None, multi=False, stream=False):
+        """Runs a query for _return"""
+        if stream:
+            rows = self._stream(query, values)
+            first = next(rows, None)
+            if first is None:
+                return []
+            return itertools.chain([first], rows)
+        with self._connection() as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor()
+            if values is None:
+                c.execute(query)
+            else:
+                c.execute(query, values)
+            if multi:
+                row = c.fetchall()
+            else:
+                row = c.fetchone()
         return row # sqlite3.Row object (supports both numerical and key indexing)
 
+    def _stream(self, query, values=None):
+        """Yields the rows of query, fetching _batch_size rows at a time.
+        A pooled connection is borrowed when the first row is requested and
+        returned as soon as the rows run out or the generator is closed
+        """
+        with self._connection() as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.execute(query, values or ())
+            while True:
+                rows = c.fetchmany(self._batch_size)
+                if not rows:
+                    break
+                yield from rows
+
     def _is_exist(self, tblname, left_key, left_value, right_key=None, right_value=None):
         """Checks whether a record exists in a table.
         Supports composite keys for junction tables
@@ -73,6 +992,23 @@ class Collection:
             return False
         return True
 
+    def _return_match(self, query, names, multi=False, stream=False):
+        """Runs a query that has a {} placeholder in its WHERE clause for
+        each (tblname, name_key, name) in names.
+
+        The names are first matched exactly on their normalized {name_key}_norm
+        columns, which is an index probe. Only if that finds nothing is the query
+        run again as a LIKE substring search on name_key.
+        """
+        exact = query.format(*[f"'{tblname}'.'{name_key}_norm' = ?" for tblname, name_key, _ in names])
+        row = self._return(exact, tuple(normalize(name) for *_, name in names),
+                           multi=multi, stream=stream)
+        if row is None or row == []:
+            like = query.format(*[f"'{tblname}'.'{name_key}' LIKE ?" for tblname, name_key, _ in names])
+            row = self._return(like, tuple('%'+name+'%' for *_, name in names),
+                               multi=multi, stream=stream)
+        return row
+
     def _display(self, row_list):
         headers = row_list[0].keys()
         tables = []
@@ -81,9 +1017,23 @@ class Collection:
         df = pd.DataFrame(tables, columns = headers)
         print(df)
 
+    def _id_query(self, tblname, name_key, id_key, param):
+        """Returns a subquery selecting the id linked to the name in the
+        :{param}_norm and :{param}_like parameters: an index probe on the
+        normalized name, then a substring search if it finds nothing
+        """
+        return f"""
+                SELECT {id_key} FROM (
+                    SELECT {id_key} FROM '{tblname}' WHERE {name_key}_norm = :{param}_norm
+                    UNION ALL
+                    SELECT {id_key} FROM '{tblname}' WHERE {name_key} LIKE :{param}_like
+                ) LIMIT 1
+                """
+
     def _retrieve_id(self, tblname, name, name_key, id_key, like=False):
         """Retrieves id linked to name; return False if name
-        does not exist in tblname
+        does not exist in tblname. Names are matched case-insensitively;
+        like=True falls back to a substring search if there is no exact match
 
         E.g. _retrieve_id(tblname='Students', name='Moses', name_key='student_name', 
         id_key='student_id')
@@ -91,19 +1041,16 @@ class Collection:
 
         # retrieve student_id
         if like:
-            query = f"""
-                SELECT {id_key}
-                FROM {tblname}
-                WHERE {name_key} LIKE ?;
-                """
-            values = ('%'+name+'%',)
+            # the LIKE scan only runs if the index probe returns no row
+            query = self._id_query(tblname, name_key, id_key, 'name') + ';'
+            values = {'name_norm': normalize(name), 'name_like': '%'+name+'%'}
         else:
             query = f"""
                     SELECT {id_key}
-                    FROM {tblname}
-                    WHERE {name_key} = ?;
+                    FROM '{tblname}'
+                    WHERE {name_key}_norm = ?;
                     """
-            values = (name,)
+            values = (normalize(name),)
         row = self._return(query, values, multi=False)
         #check if name exists
         if row is None:
@@ -111,6 +1058,44 @@ class Collection:
         name_id = row[id_key]
         return name_id
 
+    def resolve_ids(self, names, like=False):
+        """Batched _retrieve_id for the collection's own table.
+        Returns a dict of {name: id}, with False for names that do not exist.
+        Exact names are resolved with one IN query per 500 names on the
+        normalized name index; with like=True, the names that miss are then
+        looked up with LIKE over a single connection.
+        """
+        names = list(dict.fromkeys(names))
+        ids = dict.fromkeys(names, False)
+        by_norm = {}
+        for name in names:
+            by_norm.setdefault(normalize(name), []).append(name)
+        norms = list(by_norm)
+        with self._connection() as conn:
+            for i in range(0, len(norms), 500):
+                chunk = norms[i:i+500]
+                query = f"""
+                        SELECT {self._name_key}_norm, {self._id_key}
+                        FROM '{self._tblname}'
+                        WHERE {self._name_key}_norm IN ({', '.join('?' * len(chunk))});
+                        """
+                for norm, name_id in conn.execute(query, chunk):
+                    for name in by_norm.get(norm.casefold(), []):
+                        if ids[name] is False:
+                            ids[name] = name_id
+            if like:
+                query = f"""
+                        SELECT {self._id_key}
+                        FROM '{self._tblname}'
+                        WHERE {self._name_key} LIKE ?;
+                        """
+                for name in names:
+                    if ids[name] is False:
+                        row = conn.execute(query, ('%'+name+'%',)).fetchone()
+                        if row is not None:
+                            ids[name] = row[0]
+        return ids
+
     def display_all(self):
         """Display all the records in a collection"""
         query = f"""SELECT * FROM '{self._tblname}'"""
@@ -124,37 +1109,78 @@ class Students(Collection):
     Methods:
     --------
     add(record)
+    add_by_id(record)
     get(student_name)
+    get_by_id(student_id)
     update(student_name, record)
+    update_by_id(student_id, record)
     delete(student_name)
+    delete_by_id(student_id)
+    sync(records, prune=False)
     """
-    def __init__(self):
-        super().__init__("Students")
+    _name_key = 'student_name'
+    _id_key = 'student_id'
+
+    def __init__(self, dbname=None):
+        super().__init__("Students", dbname)
 
     def add(self, record):
-        """Adds a student record into the database."""
-        # check if student exists
-        if self._is_exist(self._tblname, "student_name", record["student_name"]):
-            return False
-        
-        class_id = self._retrieve_id('Classes', record['class_name'], 'class_name', 'class_id')
-        if not class_id:
+        """Adds a student record into the database.
+        Returns False if the student exists or the class does not
+        """
+        # the class is resolved and the unique student_name_norm index
+        # checked by the INSERT itself. NOT EXISTS skips existing students
+        # before the insert: a conflict would still rewrite sqlite_sequence
+        # (student_id is AUTOINCREMENT), a disk write for nothing, and
+        # migrate() may have had to leave the index non-unique
+        record["student_name_norm"] = normalize(record["student_name"])
+        record["class_name_norm"] = normalize(record["class_name"])
+        query = f"""
+                INSERT INTO '{self._tblname}' (
+                    'student_name', 'age', 'year_enrolled', 'grad_year', 'class_id',
+                    'student_name_norm'
+                )
+                SELECT :student_name, :age, :year_enrolled, :grad_year, class_id,
+                    :student_name_norm
+                FROM 'Classes' WHERE class_name_norm = :class_name_norm
+                AND NOT EXISTS (
+                    SELECT 1 FROM '{self._tblname}' WHERE student_name_norm = :student_name_norm
+                )
+                LIMIT 1
+                ON CONFLICT DO NOTHING
+                RETURNING student_id, class_id;
+                """
+        row = self._insert(query, record)
+        if row is None:
             return False
-        record["class_id"] = class_id
-        
-        # add student record
+        record["student_id"], record["class_id"] = row
+        return
+
+    def add_by_id(self, record):
+        """Adds a student record with a class_id instead of a class_name.
+        Returns False if the student or class does not exist
+        """
+        record["student_name_norm"] = normalize(record["student_name"])
         query = f"""
                 INSERT INTO '{self._tblname}' (
-                    'student_name', 'age', 'year_enrolled', 'grad_year', 'class_id'
-                ) VALUES (:student_name, :age, :year_enrolled, :grad_year, :class_id);
+                    'student_name', 'age', 'year_enrolled', 'grad_year', 'class_id',
+                    'student_name_norm'
+                )
+                SELECT :student_name, :age, :year_enrolled, :grad_year, :class_id,
+                    :student_name_norm
+                WHERE EXISTS (SELECT 1 FROM 'Classes' WHERE class_id = :class_id)
+                AND NOT EXISTS (
+                    SELECT 1 FROM '{self._tblname}' WHERE student_name_norm = :student_name_norm
+                );
                 """
-        self._execute(query, record)
+        if self._execute(query, record) == 0:
+            return False
         return
         
     def get(self, student_name):
         """Returns a student's record."""
         #retrieve student record
-        query = f"""
+        query = """
                 SELECT
                     'Students'.'student_name',
                     'Students'.'age',
@@ -162,13 +1188,12 @@ class Students(Collection):
                     'Students'.'grad_year',
                     'Classes'.'class_name',
                     'Students'.'student_id'
-                FROM '{self._tblname}'
+                FROM 'Students'
                 INNER JOIN 'Classes'
                 ON 'Students'.'class_id' = 'Classes'.'class_id'
-                WHERE student_name LIKE ?;
+                WHERE {};
                 """
-        values = ('%' + student_name + '%',)
-        row = self._return(query, values, multi=False)
+        row = self._return_match(query, [('Students', 'student_name', student_name)], multi=False)
 
         # check if student exists
         if row is None:
@@ -184,10 +1209,30 @@ class Students(Collection):
 
         return data
 
+    def get_by_id(self, student_id):
+        """Returns a student's record by student_id."""
+        query = f"""
+                SELECT
+                    'Students'.'student_name',
+                    'Students'.'age',
+                    'Students'.'year_enrolled',
+                    'Students'.'grad_year',
+                    'Classes'.'class_name',
+                    'Students'.'student_id'
+                FROM '{self._tblname}'
+                INNER JOIN 'Classes'
+                ON 'Students'.'class_id' = 'Classes'.'class_id'
+                WHERE 'Students'.'student_id' = ?;
+                """
+        row = self._return(query, (student_id,), multi=False)
+        if row is None:
+            return False
+        return dict(row)
+
     def update(self, student_name, record):
         """Updates student record in database."""
         # check if student exists
-        if not self._is_exist(self._tblname, "student_name", student_name):
+        if not self._is_exist(self._tblname, "student_name_norm", normalize(student_name)):
             return False
 
         # retrieve class_id
@@ -202,12 +1247,34 @@ class Students(Collection):
                     'age' = ?,
                     'year_enrolled' = ?,
                     'grad_year' = ?,
-                    'class_id' = ?
-                WHERE student_name = ?;
+                    'class_id' = ?,
+                    'student_name_norm' = ?
+                WHERE student_name_norm = ?;
                 """
-        values = (record["new_student_name"], record["new_age"], record["new_year_enrolled"], record["new_grad_year"], class_id, student_name,)
+        values = (record["new_student_name"], record["new_age"], record["new_year_enrolled"], record["new_grad_year"], class_id, normalize(record["new_student_name"]), normalize(student_name),)
         self._execute(query, values)
         return
+
+    def update_by_id(self, student_id, record):
+        """Updates student record by student_id.
+        record = {'new_student_name': ..., 'new_age': ..., 'new_year_enrolled': ...,
+        'new_grad_year': ..., 'new_class_id': ...}
+        Returns False if the student does not exist
+        """
+        query = f"""
+                UPDATE '{self._tblname}' SET
+                    'student_name' = ?,
+                    'age' = ?,
+                    'year_enrolled' = ?,
+                    'grad_year' = ?,
+                    'class_id' = ?,
+                    'student_name_norm' = ?
+                WHERE student_id = ?;
+                """
+        values = (record["new_student_name"], record["new_age"], record["new_year_enrolled"], record["new_grad_year"], record["new_class_id"], normalize(record["new_student_name"]), student_id,)
+        if self._execute(query, values) == 0:
+            return False
+        return
         
     def delete(self, student_name):
         """Deletes student record from database."""
@@ -227,6 +1294,78 @@ class Students(Collection):
             self._execute(query, values)
         return
 
+    def delete_by_id(self, student_id):
+        """Deletes student record and its subject, CCA and activity records
+        in one transaction. Returns False if the student does not exist
+        """
+        tblnames = ["Students-Activities", "Students-CCAs", "Students-Subjects", "Students"]
+        statements = [(f"DELETE FROM '{tblname}' WHERE student_id = ?;", (student_id,))
+                      for tblname in tblnames]
+        if self._execute_all(statements)[-1] == 0:
+            return False
+        return
+
+    def sync(self, records, prune=False):
+        """Brings the Students table in line with a full import, in one transaction.
+        records = [{'student_name': ..., 'class_name': ..., 'level': ..., 'age': ...,
+                    'year_enrolled': ..., 'grad_year': ..., 'source_hash': ...}, ...]
+
+        Students are matched on their normalized name. New students are inserted,
+        students whose source_hash changed are updated and the rest are left alone.
+        Missing classes are created with the record's level. Imported students
+        (with a source_hash) that are not in records are counted as removed, and
+        deleted with their subject, CCA and activity records if prune is True.
+        Returns {'inserted': n, 'updated': n, 'unchanged': n, 'removed': n}
+        """
+        records = {normalize(record['student_name']): record for record in records}
+        summary = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+        with self._connection() as conn, conn:
+            existing = {norm: (student_id, source_hash) for norm, student_id, source_hash in
+                        conn.execute("SELECT student_name_norm, student_id, source_hash FROM 'Students';")}
+            class_ids = dict(conn.execute("SELECT class_name_norm, class_id FROM 'Classes';"))
+
+            inserts = []
+            updates = []
+            for norm, record in records.items():
+                if norm in existing and existing[norm][1] == record['source_hash']:
+                    summary['unchanged'] += 1
+                    continue
+                class_norm = normalize(record['class_name'])
+                if class_norm not in class_ids:
+                    cursor = conn.execute("""
+                        INSERT INTO 'Classes' ('class_name', 'level', 'class_name_norm')
+                        VALUES (?, ?, ?);
+                        """, (record['class_name'], record.get('level'), class_norm))
+                    class_ids[class_norm] = cursor.lastrowid
+                values = (record['student_name'], record['age'], record['year_enrolled'],
+                          record['grad_year'], class_ids[class_norm], norm, record['source_hash'])
+                if norm in existing:
+                    updates.append(values + (existing[norm][0],))
+                else:
+                    inserts.append(values)
+            conn.executemany("""
+                INSERT INTO 'Students' (
+                    'student_name', 'age', 'year_enrolled', 'grad_year', 'class_id',
+                    'student_name_norm', 'source_hash'
+                ) VALUES (?, ?, ?, ?, ?, ?, ?);
+                """, inserts)
+            conn.executemany("""
+                UPDATE 'Students' SET
+                    'student_name' = ?, 'age' = ?, 'year_enrolled' = ?, 'grad_year' = ?,
+                    'class_id' = ?, 'student_name_norm' = ?, 'source_hash' = ?
+                WHERE student_id = ?;
+                """, updates)
+            summary['inserted'] = len(inserts)
+            summary['updated'] = len(updates)
+
+            removed = [(student_id,) for norm, (student_id, source_hash) in existing.items()
+                       if source_hash is not None and norm not in records]
+            summary['removed'] = len(removed)
+            if prune:
+                for tblname in ["Students-Activities", "Students-CCAs", "Students-Subjects", "Students"]:
+                    conn.executemany(f"DELETE FROM '{tblname}' WHERE student_id = ?;", removed)
+        return summary
+
 
 class Classes(Collection):
     """
@@ -235,38 +1374,48 @@ class Classes(Collection):
     Methods:
     --------
     add(record)
-    get(class_name)
+    get(class_name, stream=False)
+    get_by_id(class_id, stream=False)
     get_info(class_name)
+    get_info_by_id(class_id)
     update(class_name, record)
+    update_by_id(class_id, record)
     """
-    def __init__(self):
-        super().__init__("Classes")
+    _name_key = 'class_name'
+    _id_key = 'class_id'
+
+    def __init__(self, dbname=None):
+        super().__init__("Classes", dbname)
 
     def add(self, record):
         """Adds a class record to the database."""
-        # check if class exists
-        if self._is_exist(self._tblname, "class_name", record["class_name"]):
-            return False
-
-        # add class record
+        # NOT EXISTS skips an existing class even where migrate() could not
+        # make the class_name_norm index unique; the index catches the rest
+        record["class_name_norm"] = normalize(record["class_name"])
         query = f"""
                 INSERT INTO '{self._tblname}' (
-                    'class_name', 'level'
-                ) VALUES (:class_name, :level);
+                    'class_name', 'level', 'class_name_norm'
+                )
+                SELECT :class_name, :level, :class_name_norm
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM '{self._tblname}' WHERE class_name_norm = :class_name_norm
+                )
+                ON CONFLICT DO NOTHING
+                RETURNING class_id;
                 """
-        self._execute(query, record)
+        if self._insert(query, record) is None:
+            return False
         return
 
     def get_info(self, class_name):
         """Returns the class info"""
         # retrieve Class record
         query = """
-                SELECT *
+                SELECT class_id, class_name, level
                 FROM 'Classes'
-                WHERE class_name LIKE ?;
+                WHERE {};
                 """
-        values = ('%'+class_name+'%',)
-        row = self._return(query, values, multi=False)
+        row = self._return_match(query, [('Classes', 'class_name', class_name)], multi=False)
         if row is None:
             return False
         
@@ -277,8 +1426,22 @@ class Classes(Collection):
             data[elem] = row[i]
         return data
 
-    def get(self, class_name):
-        """Returns all students in the corresponding class."""
+    def get_info_by_id(self, class_id):
+        """Returns the class info by class_id"""
+        query = """
+                SELECT class_id, class_name, level
+                FROM 'Classes'
+                WHERE class_id = ?;
+                """
+        row = self._return(query, (class_id,), multi=False)
+        if row is None:
+            return False
+        return dict(row)
+
+    def get(self, class_name, stream=False):
+        """Returns all students in the corresponding class.
+        stream=True returns a generator that reads the rows lazily
+        """
         # retrieve student_id and student_name
         query = """
                 SELECT 
@@ -287,40 +1450,69 @@ class Classes(Collection):
                 FROM 'Students'
                 INNER JOIN 'Classes'
                 ON 'Students'.'class_id' = 'Classes'.'class_id'
-                WHERE 'Classes'.'class_name' LIKE ?
+                WHERE {}
                 ORDER BY 'student_id' ASC;
                 """
-        values = ('%'+class_name+'%',)
-        row = self._return(query, values, multi=True)
+        row = self._return_match(query, [('Classes', 'class_name', class_name)],
+                                 multi=True, stream=stream)
         if row == []:
             return False
 
         # convert data to dictionary (key=id, value=student_name)
-        data = []
-        for item in row:
-            record = {}
-            record['student_id'] = item['student_id']
-            record['student_name'] = item["student_name"]
-            data.append(record)
-        return data
+        def records():
+            for item in row:
+                record = {}
+                record['student_id'] = item['student_id']
+                record['student_name'] = item["student_name"]
+                yield record
+        return records() if stream else list(records())
+
+    def get_by_id(self, class_id, stream=False):
+        """Returns all students in the class with class_id."""
+        query = """
+                SELECT student_id, student_name
+                FROM 'Students'
+                WHERE class_id = ?
+                ORDER BY student_id ASC;
+                """
+        row = self._return(query, (class_id,), multi=True, stream=stream)
+        if row == []:
+            return False
+        data = (dict(item) for item in row)
+        return data if stream else list(data)
 
     def update(self, class_name, record):
         """Updates class record in the database."""
         # check if class exists
-        if not self._is_exist(self._tblname, "class_name", class_name):
+        if not self._is_exist(self._tblname, "class_name_norm", normalize(class_name)):
             return False
 
         # update class record
         query = f"""
                 UPDATE '{self._tblname}' SET
                     'class_name' = ?,
-                    'level' = ?
-                WHERE class_name = ?;
+                    'level' = ?,
+                    'class_name_norm' = ?
+                WHERE class_name_norm = ?;
                 """
-        values = (record["new_class_name"], record["new_level"], class_name,)
+        values = (record["new_class_name"], record["new_level"], normalize(record["new_class_name"]), normalize(class_name),)
         self._execute(query, values)
         return
 
+    def update_by_id(self, class_id, record):
+        """Updates class record by class_id. Returns False if it does not exist"""
+        query = f"""
+                UPDATE '{self._tblname}' SET
+                    'class_name' = ?,
+                    'level' = ?,
+                    'class_name_norm' = ?
+                WHERE class_id = ?;
+                """
+        values = (record["new_class_name"], record["new_level"], normalize(record["new_class_name"]), class_id,)
+        if self._execute(query, values) == 0:
+            return False
+        return
+
 
 class Subjects(Collection):
     """
@@ -330,11 +1522,17 @@ class Subjects(Collection):
     --------
     _subj_is_exist(subj_list)
     add_student(record)
-    get_student(student_name)
+    add_student_by_id(student_id, subj_id_list)
+    get_student(student_name, stream=False)
+    get_student_by_id(student_id, stream=False)
     delete_student(record)
+    delete_student_by_id(student_id, subj_id)
     """
-    def __init__(self):
-        super().__init__("Subjects")
+    _name_key = 'subj_name'
+    _id_key = 'subj_id'
+
+    def __init__(self, dbname=None):
+        super().__init__("Subjects", dbname)
 
     def _subj_is_exist(self, subj_list):
         """Returns a list of subj_id for each subj in subj_list
@@ -344,10 +1542,10 @@ class Subjects(Collection):
             query = f"""
                     SELECT *
                     FROM '{self._tblname}'
-                    WHERE subj_name = ?
+                    WHERE subj_name_norm = ?
                     AND level = ?;
                     """
-            values = tuple(subj.values())
+            values = (normalize(subj['subj_name']), subj['level'],)
             row = self._return(query, values, multi=False)
             if row is None:
                 return False
@@ -384,7 +1582,19 @@ class Subjects(Collection):
             self._execute(query, record)
         return
 
-    def get_student(self, student_name):
+    def add_student_by_id(self, student_id, subj_id_list):
+        """Adds a student's subjects by id in one transaction.
+        Subjects the student already takes are skipped.
+        """
+        query = """
+                INSERT OR IGNORE INTO 'Students-Subjects' (
+                    'student_id', 'subj_id'
+                ) VALUES (?, ?);
+                """
+        self._execute_all([(query, (student_id, subj_id)) for subj_id in subj_id_list])
+        return
+
+    def get_student(self, student_name, stream=False):
         """Returns a list of subj that student takes"""
         #retrieve the subj_id for subj that student takes
         query = """
@@ -394,16 +1604,29 @@ class Subjects(Collection):
                 ON 'Students-Subjects'.'subj_id' = 'Subjects'.'subj_id'
                 INNER JOIN 'Students'
                 ON 'Students'.'student_id' = 'Students-Subjects'.'student_id'
-                WHERE student_name LIKE ?;
+                WHERE {};
                 """
-        values = ('%'+student_name+'%',)
-        subj_list = self._return(query, values, multi=True)
+        subj_list = self._return_match(query, [('Students', 'student_name', student_name)],
+                                       multi=True, stream=stream)
         if subj_list == []:
             return False
-        data = []
-        for subj in subj_list:
-            data.append({'subj_name': subj['subj_name'], 'level': subj['level']})
-        return data
+        data = ({'subj_name': subj['subj_name'], 'level': subj['level']} for subj in subj_list)
+        return data if stream else list(data)
+
+    def get_student_by_id(self, student_id, stream=False):
+        """Returns a list of subj that the student with student_id takes"""
+        query = """
+                SELECT 'Subjects'.'subj_name', 'Subjects'.'level'
+                FROM 'Students-Subjects'
+                INNER JOIN 'Subjects'
+                ON 'Students-Subjects'.'subj_id' = 'Subjects'.'subj_id'
+                WHERE 'Students-Subjects'.'student_id' = ?;
+                """
+        subj_list = self._return(query, (student_id,), multi=True, stream=stream)
+        if subj_list == []:
+            return False
+        data = (dict(subj) for subj in subj_list)
+        return data if stream else list(data)
         
     def delete_student(self, record):
         """Deletes a student's subject.
@@ -424,7 +1647,7 @@ class Subjects(Collection):
             return False
         
         # check if student takes that subject
-        if not self._is_exists('Students-Subjects', 'student_id', student_id, 'subj_id', subj_id):
+        if not self._is_exist('Students-Subjects', 'student_id', student_id, 'subj_id', subj_id):
             return False
         
         # delete student-subject record
@@ -436,6 +1659,19 @@ class Subjects(Collection):
         values = (student_id, subj_id)
         self._execute(query, values)
         return
+
+    def delete_student_by_id(self, student_id, subj_id):
+        """Deletes a student's subject by id.
+        Returns False if the student does not take that subject
+        """
+        query = """
+                DELETE FROM 'Students-Subjects'
+                WHERE student_id = ?
+                AND subj_id = ?;
+                """
+        if self._execute(query, (student_id, subj_id)) == 0:
+            return False
+        return
             
 
 class CCAs(Collection):
@@ -446,65 +1682,100 @@ class CCAs(Collection):
     --------
     add(record)
     add_student(record)
+    add_student_by_id(record)
     get(cca_name)
-    get_student(student_name)
+    get_by_id(cca_id)
+    get_student(student_name, cca_name=None, stream=False)
+    get_student_by_id(student_id, cca_id=None, stream=False)
     update(cca_name, record)
+    update_by_id(cca_id, record)
     update_student(record)
+    update_student_by_id(record)
     delete(cca_name)
+    delete_by_id(cca_id)
     delete_student(student_name, cca_name)
+    delete_student_by_id(student_id, cca_id)
+    sync(records, prune=False)
     """
-    def __init__(self):
-        super().__init__("CCAs")
+    _name_key = 'cca_name'
+    _id_key = 'cca_id'
+
+    def __init__(self, dbname=None):
+        super().__init__("CCAs", dbname)
 
     def add(self, record):
         """Adds a CCA record to the database."""
-        # check if CCA exists
-        if self._is_exist(self._tblname, "cca_name", record["cca_name"]):
-            return False
-
-        # add CCA record
+        # NOT EXISTS skips an existing CCA even where migrate() could not
+        # make the cca_name_norm index unique; the index catches the rest
+        record["cca_name_norm"] = normalize(record["cca_name"])
         query = f"""
                 INSERT INTO '{self._tblname}' (
-                    'cca_name', 'type'
-                ) VALUES (:cca_name, :type);
+                    'cca_name', 'type', 'cca_name_norm'
+                )
+                SELECT :cca_name, :type, :cca_name_norm
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM '{self._tblname}' WHERE cca_name_norm = :cca_name_norm
+                )
+                ON CONFLICT DO NOTHING
+                RETURNING cca_id;
                 """
-        self._execute(query, record)
+        if self._insert(query, record) is None:
+            return False
         return
 
     def add_student(self, record):
         """Adds a student to a CCA.
         record = {'student_name': ..., 'cca_name': ..., 'role': ...}
+        Returns False if the student or cca does not exist, or the student
+        is already in that cca
         """
-        # check if student/cca exists and retrive ids
-        record["student_id"] = self._retrieve_id("Students", record["student_name"], "student_name", "student_id", like=True)
-        record["cca_id"] = self._retrieve_id("CCAs", record["cca_name"], "cca_name", "cca_id", like=True)
-        
-        if record["student_id"] == False or record['cca_id'] == False:
-            return False
-        
-        #check if student is already in that cca
-        if self._is_exist('Students-CCAs', 'student_id', record['student_id'], 'cca_id', record['cca_id']):
+        # resolve both names and insert in one statement; the primary key
+        # turns an existing membership into a no-op
+        values = {'role': record['role'],
+                  'student_norm': normalize(record['student_name']),
+                  'student_like': '%' + record['student_name'] + '%',
+                  'cca_norm': normalize(record['cca_name']),
+                  'cca_like': '%' + record['cca_name'] + '%'}
+        query = f"""
+                INSERT INTO 'Students-CCAs' (
+                    'student_id', 'cca_id', 'role'
+                )
+                SELECT student.student_id, cca.cca_id, :role
+                FROM ({self._id_query('Students', 'student_name', 'student_id', 'student')}) AS student,
+                     ({self._id_query('CCAs', 'cca_name', 'cca_id', 'cca')}) AS cca
+                WHERE true
+                ON CONFLICT DO NOTHING
+                RETURNING student_id, cca_id;
+                """
+        row = self._insert(query, values)
+        if row is None:
             return False
+        record["student_id"], record["cca_id"] = row
+        return
 
-        # otherwise add student-cca record
+    def add_student_by_id(self, record):
+        """Adds a student to a CCA without resolving any names.
+        record = {'student_id': ..., 'cca_id': ..., 'role': ...}
+        Returns False if the student is already in that cca
+        """
         query = """
-                INSERT INTO 'Students-CCAs' (
+                INSERT OR IGNORE INTO 'Students-CCAs' (
                     'student_id', 'cca_id', 'role'
                 ) VALUES (:student_id, :cca_id, :role);
                 """
-        self._execute(query, record)
+        if self._execute(query, record) == 0:
+            return False
         return
         
     def get(self, cca_name):
             """Returns a CCA's details."""
             # retrieve CCA record
             query = """
-                    SELECT *
+                    SELECT cca_id, cca_name, type
                     FROM 'CCAs'
-                    WHERE cca_name LIKE ?;
+                    WHERE {};
                     """
-            values = ('%'+cca_name+'%',)
-            row = self._return(query, values, multi=False)
+            row = self._return_match(query, [('CCAs', 'cca_name', cca_name)], multi=False)
             if row is None:
                 return False
             
@@ -514,13 +1785,25 @@ class CCAs(Collection):
             for i, elem in enumerate(field_names):
                 data[elem] = row[i]
             return data
+
+    def get_by_id(self, cca_id):
+        """Returns a CCA's details by cca_id."""
+        query = """
+                SELECT cca_id, cca_name, type
+                FROM 'CCAs'
+                WHERE cca_id = ?;
+                """
+        row = self._return(query, (cca_id,), multi=False)
+        if row is None:
+            return False
+        return dict(row)
         
-    def get_student(self, student_name, cca_name=None):
+    def get_student(self, student_name, cca_name=None, stream=False):
         """Returns a list of dict of student's CCAs (if student_cca is None)
         Returns False if student does not have any ccas.
-        Returns specific cca for student if student_cca is specified
+        Returns specific cca for student if student_cca is specified (with student_id and cca_id)
+        stream=True returns a generator that reads the rows lazily
         """
-        data = []
 
         # retrieve cca_id and role
         if cca_name is not None:
@@ -528,15 +1811,17 @@ class CCAs(Collection):
                 SELECT 
                     'CCAs'.'cca_name' AS 'cca_name',
                     'Students-CCAs'.'role' AS 'role',
-                    'Students'.'student_name' AS 'student_name'
+                    'Students'.'student_name' AS 'student_name',
+                    'Students'.'student_id' AS 'student_id',
+                    'CCAs'.'cca_id' AS 'cca_id'
                 FROM 'Students'
                 INNER JOIN 'Students-CCAs'
                 ON 'Students'.'student_id' = 'Students-CCAS'.'student_id'
                 INNER JOIN CCAs
                 ON 'CCAs'.'cca_id' = 'Students-CCAs'.'cca_id'
-                WHERE 'Students'.'student_name' LIKE ? AND 'CCAs'.'cca_name' LIKE ?;
+                WHERE {} AND {};
                 """
-            values = ('%'+student_name+'%', '%'+cca_name+'%',)
+            names = [('Students', 'student_name', student_name), ('CCAs', 'cca_name', cca_name)]
         else:
             query = """
                     SELECT 
@@ -547,43 +1832,108 @@ class CCAs(Collection):
                     ON 'Students'.'student_id' = 'Students-CCAS'.'student_id'
                     INNER JOIN CCAs
                     ON 'CCAs'.'cca_id' = 'Students-CCAs'.'cca_id'
-                    WHERE student_name LIKE ?;
+                    WHERE {};
                     """
-
-            values = ('%'+student_name+'%',)
-        row = self._return(query, values, multi=True)
+            names = [('Students', 'student_name', student_name)]
+        row = self._return_match(query, names, multi=True, stream=stream)
 
         #check if student have any ccas at all
         if row == []:
             return False
 
-        for cca in row:
-            record = {}
-            record['cca_name'] = cca['cca_name']
-            record['role'] = cca['role']
-            if cca_name is not None:
-                record['student_name'] = cca['student_name']
-            data.append(record)
+        def records():
+            for cca in row:
+                record = {}
+                record['cca_name'] = cca['cca_name']
+                record['role'] = cca['role']
+                if cca_name is not None:
+                    record['student_name'] = cca['student_name']
+                    record['student_id'] = cca['student_id']
+                    record['cca_id'] = cca['cca_id']
+                yield record
 
-        return data
+        return records() if stream else list(records())
+
+    def get_student_by_id(self, student_id, cca_id=None, stream=False):
+        """Same as get_student, looked up by student_id (and cca_id)"""
+
+        if cca_id is not None:
+            query = """
+                SELECT 
+                    'CCAs'.'cca_name' AS 'cca_name',
+                    'Students-CCAs'.'role' AS 'role',
+                    'Students'.'student_name' AS 'student_name',
+                    'Students'.'student_id' AS 'student_id',
+                    'CCAs'.'cca_id' AS 'cca_id'
+                FROM 'Students-CCAs'
+                INNER JOIN 'Students'
+                ON 'Students'.'student_id' = 'Students-CCAs'.'student_id'
+                INNER JOIN CCAs
+                ON 'CCAs'.'cca_id' = 'Students-CCAs'.'cca_id'
+                WHERE 'Students-CCAs'.'student_id' = ? AND 'Students-CCAs'.'cca_id' = ?;
+                """
+            values = (student_id, cca_id,)
+        else:
+            query = """
+                    SELECT 
+                        'CCAs'.'cca_name' AS 'cca_name',
+                        'Students-CCAs'.'role' AS 'role'
+                    FROM 'Students-CCAs'
+                    INNER JOIN CCAs
+                    ON 'CCAs'.'cca_id' = 'Students-CCAs'.'cca_id'
+                    WHERE 'Students-CCAs'.'student_id' = ?;
+                    """
+            values = (student_id,)
+        row = self._return(query, values, multi=True, stream=stream)
+
+        if row == []:
+            return False
+
+        def records():
+            for cca in row:
+                record = {}
+                record['cca_name'] = cca['cca_name']
+                record['role'] = cca['role']
+                if cca_id is not None:
+                    record['student_name'] = cca['student_name']
+                    record['student_id'] = cca['student_id']
+                    record['cca_id'] = cca['cca_id']
+                yield record
+
+        return records() if stream else list(records())
 
     def update(self, cca_name, record):
         """Updates an acitivty's record."""
         # check if cca exists
-        if not self._is_exist(self._tblname, "cca_name", cca_name):
+        if not self._is_exist(self._tblname, "cca_name_norm", normalize(cca_name)):
             return False
 
         # update cca record
         query = f"""
                 UPDATE '{self._tblname}' SET
                     'cca_name' = ?,
-                    'type' = ?
-                WHERE cca_name = ?;
+                    'type' = ?,
+                    'cca_name_norm' = ?
+                WHERE cca_name_norm = ?;
                 """
-        values = (record["new_cca_name"], record["new_type"], cca_name)
+        values = (record["new_cca_name"], record["new_type"], normalize(record["new_cca_name"]), normalize(cca_name))
         self._execute(query, values)
         return
 
+    def update_by_id(self, cca_id, record):
+        """Updates a CCA's record by cca_id. Returns False if it does not exist"""
+        query = f"""
+                UPDATE '{self._tblname}' SET
+                    'cca_name' = ?,
+                    'type' = ?,
+                    'cca_name_norm' = ?
+                WHERE cca_id = ?;
+                """
+        values = (record["new_cca_name"], record["new_type"], normalize(record["new_cca_name"]), cca_id)
+        if self._execute(query, values) == 0:
+            return False
+        return
+
     def update_student(self, record):
         """Updates a student's CCA record (update role only).
         record = {'student_name': ..., 'cca_name': ..., 'role': ...}
@@ -608,10 +1958,24 @@ class CCAs(Collection):
         self._execute(query, values)
         return
 
+    def update_student_by_id(self, record):
+        """Updates a student's CCA role without resolving any names.
+        record = {'student_id': ..., 'cca_id': ..., 'role': ...}
+        Returns False if the student is not in that cca
+        """
+        query = """
+                UPDATE 'Students-CCAs' SET
+                    'role' = :role
+                WHERE student_id = :student_id AND cca_id = :cca_id;
+                """
+        if self._execute(query, record) == 0:
+            return False
+        return
+
     def delete(self, cca_name):
         """Deletes a CCA record."""
         # check if CCA exists
-        if not self._is_exist(self._tblname, "cca_name", cca_name):
+        if not self._is_exist(self._tblname, "cca_name_norm", normalize(cca_name)):
             return False
 
         # retrieve cca_id
@@ -627,6 +1991,17 @@ class CCAs(Collection):
             values = (cca_id,)
             self._execute(query, values)
         return
+
+    def delete_by_id(self, cca_id):
+        """Deletes a CCA record and its student records in one
+        transaction. Returns False if it does not exist
+        """
+        tblnames = ["Students-CCAs", "CCAs"]
+        statements = [(f"DELETE FROM '{tblname}' WHERE cca_id = ?;", (cca_id,))
+                      for tblname in tblnames]
+        if self._execute_all(statements)[-1] == 0:
+            return False
+        return
         
     def delete_student(self, student_name, cca_name):
         """Deletes a student's CCA record"""
@@ -650,6 +2025,61 @@ class CCAs(Collection):
         self._execute(query, values)
         return
 
+    def delete_student_by_id(self, student_id, cca_id):
+        """Deletes a student's CCA record without resolving any names.
+        Returns False if the student is not in that cca
+        """
+        query = """
+                DELETE FROM 'Students-CCAs'
+                WHERE student_id = ?
+                AND cca_id = ?;
+                """
+        values = (student_id, cca_id)
+        if self._execute(query, values) == 0:
+            return False
+        return
+
+    def sync(self, records, prune=False):
+        """Brings the CCAs table in line with a full import, in one transaction.
+        records = [{'cca_name': ..., 'type': ..., 'source_hash': ...}, ...]
+        Works like Students.sync; pruned CCAs lose their student records too.
+        Returns {'inserted': n, 'updated': n, 'unchanged': n, 'removed': n}
+        """
+        records = {normalize(record['cca_name']): record for record in records}
+        summary = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+        with self._connection() as conn, conn:
+            existing = {norm: (cca_id, source_hash) for norm, cca_id, source_hash in
+                        conn.execute("SELECT cca_name_norm, cca_id, source_hash FROM 'CCAs';")}
+            inserts = []
+            updates = []
+            for norm, record in records.items():
+                values = (record['cca_name'], record['type'], norm, record['source_hash'])
+                if norm not in existing:
+                    inserts.append(values)
+                elif existing[norm][1] != record['source_hash']:
+                    updates.append(values + (existing[norm][0],))
+                else:
+                    summary['unchanged'] += 1
+            conn.executemany("""
+                INSERT INTO 'CCAs' ('cca_name', 'type', 'cca_name_norm', 'source_hash')
+                VALUES (?, ?, ?, ?);
+                """, inserts)
+            conn.executemany("""
+                UPDATE 'CCAs' SET
+                    'cca_name' = ?, 'type' = ?, 'cca_name_norm' = ?, 'source_hash' = ?
+                WHERE cca_id = ?;
+                """, updates)
+            summary['inserted'] = len(inserts)
+            summary['updated'] = len(updates)
+
+            removed = [(cca_id,) for norm, (cca_id, source_hash) in existing.items()
+                       if source_hash is not None and norm not in records]
+            summary['removed'] = len(removed)
+            if prune:
+                for tblname in ["Students-CCAs", "CCAs"]:
+                    conn.executemany(f"DELETE FROM '{tblname}' WHERE cca_id = ?;", removed)
+        return summary
+
         
 class Activities(Collection):
     """
@@ -658,67 +2088,137 @@ class Activities(Collection):
     Methods:
     --------
     add(record)
+    add_many(records)
     add_student(record)
+    add_student_by_id(record)
     get(activity_name)
-    get_student(student_name)
+    get_by_id(activity_id)
+    get_student(student_name, activity_name=None, stream=False)
+    get_student_by_id(student_id, activity_id=None, stream=False)
+    get_between(start_date, end_date=None, stream=False)
+    get_overlaps(start_date, end_date=None, stream=False)
+    get_hours(start_date, end_date=None, stream=False)
     update(activity_name, record)
+    update_by_id(activity_id, record)
     update_student(record)
+    update_student_by_id(record)
     delete(activity_name)
+    delete_by_id(activity_id)
     delete_student(student_name, activity_name)
+    delete_student_by_id(student_id, activity_id)
     """
-    def __init__(self):
-        super().__init__("Activities")
+    _name_key = 'activity_name'
+    _id_key = 'activity_id'
 
-    def add(self, record):
-        """Adds an activity record into the database."""
-        # check if activity exists
-        if self._is_exist(self._tblname, "activity_name", record["activity_name"]):
-            return False
+    def __init__(self, dbname=None):
+        super().__init__("Activities", dbname)
 
-        # add activity record
-        query = f"""
+    def _add_query(self):
+        """Returns the INSERT of add() and add_many(), which returns the
+        activity_id, or no row if the activity already exists
+        """
+        # NOT EXISTS skips an existing activity even where migrate() could
+        # not make the activity_name_norm index unique; the index catches the rest
+        return f"""
                 INSERT INTO '{self._tblname}' (
-                    'activity_name', 'start_date', 'end_date', 'description'
-                ) VALUES (:activity_name, :start_date, :end_date, :description);
+                    'activity_name', 'start_date', 'end_date', 'description',
+                    'activity_name_norm'
+                )
+                SELECT :activity_name, :start_date, :end_date, :description,
+                    :activity_name_norm
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM '{self._tblname}' WHERE activity_name_norm = :activity_name_norm
+                )
+                ON CONFLICT DO NOTHING
+                RETURNING activity_id;
                 """
-        self._execute(query, record)
+
+    def add(self, record):
+        """Adds an activity record into the database."""
+        record["activity_name_norm"] = normalize(record["activity_name"])
+        record["start_date"] = iso_date(record["start_date"])
+        record["end_date"] = iso_date(record["end_date"])
+        if self._insert(self._add_query(), record) is None:
+            return False
         return
 
+    def add_many(self, records):
+        """Adds activity records in a single transaction.
+        records = [{'activity_name': ..., 'start_date': ..., 'end_date': ...,
+                    'description': ...}, ...]
+        Returns a list with False for every record that was not added because
+        the activity already exists (in the database or earlier in records),
+        and None for the others
+        """
+        # one INSERT ... RETURNING per record, so each result is what that
+        # INSERT did, whatever was added before it (in this batch or by others)
+        query = self._add_query()
+        result = []
+        with self._connection() as conn, conn:
+            for record in records:
+                values = {**record, 'activity_name_norm': normalize(record['activity_name']),
+                          'start_date': iso_date(record['start_date']),
+                          'end_date': iso_date(record['end_date'])}
+                with _probed(query):
+                    inserted = conn.execute(query, values).fetchall()
+                result.append(None if inserted else False)
+        return result
+
     def add_student(self, record):
         """Adds a student to an activity.
         record = {'student_name': ..., 'activity_name': ..., 'role': ..., 'award: ...',
         'hours': ...}
+        Returns False if the student or activity does not exist, or the
+        student is already linked to that activity
         """
-        # check if student/activity exists and retrive ids
-        record["student_id"] = self._retrieve_id("Students", record["student_name"], "student_name", "student_id", like=True)
-        record["activity_id"] = self._retrieve_id("Activities", record["activity_name"], "activity_name", "activity_id", like=True)
-        
-        if record["student_id"] == False or record['activity_id'] == False:
-            return False
-
-        #check if student already linked to activity
-        if self._is_exist('Students-Activities', 'student_id', record['student_id'], 'activity_id', record['activity_id']):
+        # resolve both names and insert in one statement; the primary key
+        # turns an existing link into a no-op
+        values = {'role': record['role'], 'award': record['award'], 'hours': record['hours'],
+                  'student_norm': normalize(record['student_name']),
+                  'student_like': '%' + record['student_name'] + '%',
+                  'activity_norm': normalize(record['activity_name']),
+                  'activity_like': '%' + record['activity_name'] + '%'}
+        query = f"""
+                INSERT INTO 'Students-Activities' (
+                    'student_id', 'activity_id', 'role', 'award', 'hours'
+                )
+                SELECT student.student_id, activity.activity_id, :role, :award, :hours
+                FROM ({self._id_query('Students', 'student_name', 'student_id', 'student')}) AS student,
+                     ({self._id_query('Activities', 'activity_name', 'activity_id', 'activity')}) AS activity
+                WHERE true
+                ON CONFLICT DO NOTHING
+                RETURNING student_id, activity_id;
+                """
+        row = self._insert(query, values)
+        if row is None:
             return False
+        record["student_id"], record["activity_id"] = row
+        return
 
-        # add student-activity record
+    def add_student_by_id(self, record):
+        """Adds a student to an activity without resolving any names.
+        record = {'student_id': ..., 'activity_id': ..., 'role': ..., 'award': ...,
+        'hours': ...}
+        Returns False if the student is already linked to that activity
+        """
         query = """
-                INSERT INTO 'Students-Activities' (
+                INSERT OR IGNORE INTO 'Students-Activities' (
                     'student_id', 'activity_id', 'role', 'award', 'hours'
                 ) VALUES (:student_id, :activity_id, :role, :award, :hours);
                 """
-        self._execute(query, record)
+        if self._execute(query, record) == 0:
+            return False
         return
 
     def get(self, activity_name):
         """Returns an activity's details."""
         # retrieve activity record
-        query = f"""
-                SELECT *
-                FROM '{self._tblname}'
-                WHERE activity_name LIKE ?;
+        query = """
+                SELECT activity_id, activity_name, start_date, end_date, description
+                FROM 'Activities'
+                WHERE {};
                 """
-        values = ('%'+activity_name+'%',)
-        row = self._return(query, values, multi=False)
+        row = self._return_match(query, [('Activities', 'activity_name', activity_name)], multi=False)
         if row is None:
             return False
 
@@ -728,15 +2228,26 @@ class Activities(Collection):
         for i, elem in enumerate(field_names):
             data[elem] = row[i]
         return data
+
+    def get_by_id(self, activity_id):
+        """Returns an activity's details by activity_id."""
+        query = """
+                SELECT activity_id, activity_name, start_date, end_date, description
+                FROM 'Activities'
+                WHERE activity_id = ?;
+                """
+        row = self._return(query, (activity_id,), multi=False)
+        if row is None:
+            return False
+        return dict(row)
         
-    def get_student(self, student_name, activity_name=None):
+    def get_student(self, student_name, activity_name=None, stream=False):
         """
         Return a list of student's activity records.
         Return False if no records found
-        Return a specific record if activity_name is specified
+        Return a specific record if activity_name is specified (with student_id and activity_id)
+        stream=True returns a generator that reads the rows lazily
         """
-        data = []
-            
         # retrieve activity_id, role, award, hours, activity_name
         if activity_name is not None:
             query = """
@@ -745,15 +2256,17 @@ class Activities(Collection):
                     'Students-Activities'.'role',
                     'Students-Activities'.'award',
                     'Students-Activities'.'hours',
-                    'Students'.'student_name'
+                    'Students'.'student_name',
+                    'Students'.'student_id',
+                    'Activities'.'activity_id'
                 FROM 'Students'
                 INNER JOIN 'Students-Activities'
                 ON 'Students'.'student_id' = 'Students-Activities'.'student_id'
                 INNER JOIN 'Activities'
                 ON 'Activities'.'activity_id' = 'Students-Activities'.'activity_id'
-                WHERE 'Students'.'student_name' LIKE ? AND 'Activities'.'activity_name' LIKE ?;
+                WHERE {} AND {};
                 """
-            values = ('%'+student_name+'%', '%'+activity_name+'%',)
+            names = [('Students', 'student_name', student_name), ('Activities', 'activity_name', activity_name)]
         else:
             query = """
                     SELECT
@@ -766,31 +2279,192 @@ class Activities(Collection):
                     ON 'Students'.'student_id' = 'Students-Activities'.'student_id'
                     INNER JOIN 'Activities'
                     ON 'Activities'.'activity_id' = 'Students-Activities'.'activity_id'
-                    WHERE student_name LIKE ?;
+                    WHERE {};
                     """
-            values = ('%'+student_name+'%',)
-        row = self._return(query, values, multi=True)
+            names = [('Students', 'student_name', student_name)]
+        row = self._return_match(query, names, multi=True, stream=stream)
 
         # check if student has an activity
         if row == []:
             return False
 
-        for activity in row:
-            record = {}
-            if activity_name is not None:
-                record["student_name"] = activity['student_name']
-            record["role"] = activity["role"]
-            record["award"] = activity["award"]
-            record["hours"] = activity["hours"]
-            record["activity_name"] = activity["activity_name"]
-            data.append(record)
+        def records():
+            for activity in row:
+                record = {}
+                if activity_name is not None:
+                    record["student_name"] = activity['student_name']
+                    record["student_id"] = activity['student_id']
+                    record["activity_id"] = activity['activity_id']
+                record["role"] = activity["role"]
+                record["award"] = activity["award"]
+                record["hours"] = activity["hours"]
+                record["activity_name"] = activity["activity_name"]
+                yield record
             
-        return data
+        return records() if stream else list(records())
+
+    def get_student_by_id(self, student_id, activity_id=None, stream=False):
+        """Same as get_student, looked up by student_id (and activity_id)"""
+
+        if activity_id is not None:
+            query = """
+                SELECT
+                    'Activities'.'activity_name',
+                    'Students-Activities'.'role',
+                    'Students-Activities'.'award',
+                    'Students-Activities'.'hours',
+                    'Students'.'student_name',
+                    'Students'.'student_id',
+                    'Activities'.'activity_id'
+                FROM 'Students-Activities'
+                INNER JOIN 'Students'
+                ON 'Students'.'student_id' = 'Students-Activities'.'student_id'
+                INNER JOIN 'Activities'
+                ON 'Activities'.'activity_id' = 'Students-Activities'.'activity_id'
+                WHERE 'Students-Activities'.'student_id' = ?
+                AND 'Students-Activities'.'activity_id' = ?;
+                """
+            values = (student_id, activity_id,)
+        else:
+            query = """
+                    SELECT
+                        'Activities'.'activity_name',
+                        'Students-Activities'.'role',
+                        'Students-Activities'.'award',
+                        'Students-Activities'.'hours'
+                    FROM 'Students-Activities'
+                    INNER JOIN 'Activities'
+                    ON 'Activities'.'activity_id' = 'Students-Activities'.'activity_id'
+                    WHERE 'Students-Activities'.'student_id' = ?;
+                    """
+            values = (student_id,)
+        row = self._return(query, values, multi=True, stream=stream)
+
+        if row == []:
+            return False
+
+        def records():
+            for activity in row:
+                record = {}
+                if activity_id is not None:
+                    record["student_name"] = activity['student_name']
+                    record["student_id"] = activity['student_id']
+                    record["activity_id"] = activity['activity_id']
+                record["role"] = activity["role"]
+                record["award"] = activity["award"]
+                record["hours"] = activity["hours"]
+                record["activity_name"] = activity["activity_name"]
+                yield record
+
+        return records() if stream else list(records())
+
+    def _running(self, query, start_date, end_date, stream):
+        """Runs a query over the activities in its running CTE, those running
+        at some point between start_date and end_date (YYYY-MM-DD, both days
+        included; end_date defaults to start_date). Returns the rows as
+        dictionaries, or False if there are none
+        """
+        values = {'start_date': iso_date(start_date), 'end_date': iso_date(end_date or start_date)}
+        query = f"""
+                WITH running AS (
+                    SELECT activity_id, activity_name, start_date, end_date,
+                        {START_DAY} AS start_day, {END_DAY} AS end_day
+                    FROM 'Activities'
+                    WHERE {END_DAY} >= julianday(:start_date)
+                    AND {START_DAY} <= julianday(:end_date)
+                )
+                {query}
+                """
+        rows = self._return(query, values, multi=True, stream=stream)
+        if rows == []:
+            return False
+        records = (dict(row) for row in rows)
+        return records if stream else list(records)
+
+    def get_between(self, start_date, end_date=None, stream=False):
+        """Returns the activities running at some point between start_date
+        and end_date, with their number of participants, by start date.
+        Return False if there are none
+        stream=True returns a generator that reads the rows lazily
+        """
+        query = """
+                SELECT activity_id, activity_name, start_date, end_date,
+                    (SELECT COUNT(*) FROM 'Students-Activities'
+                     WHERE 'Students-Activities'.'activity_id' = running.activity_id
+                    ) AS participants
+                FROM running
+                ORDER BY start_day, activity_name;
+                """
+        return self._running(query, start_date, end_date, stream)
+
+    def get_overlaps(self, start_date, end_date=None, stream=False):
+        """Returns the pairs of activities running between start_date and
+        end_date that a student takes part in on the same days, with the
+        days they overlap, by student name.
+        Return False if there are none
+        stream=True returns a generator that reads the rows lazily
+        """
+        query = """
+                , taking AS MATERIALIZED (
+                    SELECT student_id, running.*
+                    FROM running
+                    INNER JOIN 'Students-Activities'
+                    ON 'Students-Activities'.'activity_id' = running.activity_id
+                    ORDER BY student_id
+                ), overlaps AS MATERIALIZED (
+                    SELECT
+                        a.student_id,
+                        a.activity_name AS activity_name,
+                        b.activity_name AS other_activity_name,
+                        date(MAX(a.start_day, b.start_day)) AS overlap_start,
+                        date(MIN(a.end_day, b.end_day)) AS overlap_end
+                    FROM taking AS a
+                    INNER JOIN 'Students-Activities' AS other
+                    ON other.student_id = a.student_id
+                    AND other.activity_id > a.activity_id
+                    INNER JOIN running AS b
+                    ON b.activity_id = other.activity_id
+                    WHERE b.start_day <= a.end_day AND a.start_day <= b.end_day
+                )
+                SELECT
+                    'Students'.'student_id',
+                    'Students'.'student_name',
+                    activity_name,
+                    other_activity_name,
+                    overlap_start,
+                    overlap_end
+                FROM overlaps
+                INNER JOIN 'Students' ON 'Students'.'student_id' = overlaps.student_id
+                ORDER BY 'Students'.'student_name', overlap_start;
+                """
+        return self._running(query, start_date, end_date, stream)
+
+    def get_hours(self, start_date, end_date=None, stream=False):
+        """Returns the hours each student logged in the activities running
+        between start_date and end_date (e.g. a term), most hours first.
+        Return False if there are none
+        stream=True returns a generator that reads the rows lazily
+        """
+        query = """
+                SELECT
+                    'Students'.'student_id',
+                    'Students'.'student_name',
+                    COUNT(*) AS activities,
+                    COALESCE(SUM('Students-Activities'.'hours'), 0) AS hours
+                FROM running
+                INNER JOIN 'Students-Activities'
+                ON 'Students-Activities'.'activity_id' = running.activity_id
+                INNER JOIN 'Students'
+                ON 'Students'.'student_id' = 'Students-Activities'.'student_id'
+                GROUP BY 'Students'.'student_id'
+                ORDER BY hours DESC, 'Students'.'student_name';
+                """
+        return self._running(query, start_date, end_date, stream)
 
     def update(self, activity_name, record):
         """Updates an acitivty's record."""
         # check if activity exists
-        if not self._is_exist(self._tblname, "activity_name", activity_name):
+        if not self._is_exist(self._tblname, "activity_name_norm", normalize(activity_name)):
             return False
 
         # update activity record
@@ -799,13 +2473,30 @@ class Activities(Collection):
                     'activity_name' = ?,
                     'start_date' = ?,
                     'end_date' = ?,
-                    'description' = ?
-                WHERE activity_name = ?;
+                    'description' = ?,
+                    'activity_name_norm' = ?
+                WHERE activity_name_norm = ?;
                 """
-        values = (record["new_activity_name"], record["new_start_date"], record["new_end_date"], record["new_description"], activity_name)
+        values = (record["new_activity_name"], iso_date(record["new_start_date"]), iso_date(record["new_end_date"]), record["new_description"], normalize(record["new_activity_name"]), normalize(activity_name))
         self._execute(query, values)
         return
 
+    def update_by_id(self, activity_id, record):
+        """Updates an activity's record by activity_id. Returns False if it does not exist"""
+        query = f"""
+                UPDATE '{self._tblname}' SET
+                    'activity_name' = ?,
+                    'start_date' = ?,
+                    'end_date' = ?,
+                    'description' = ?,
+                    'activity_name_norm' = ?
+                WHERE activity_id = ?;
+                """
+        values = (record["new_activity_name"], iso_date(record["new_start_date"]), iso_date(record["new_end_date"]), record["new_description"], normalize(record["new_activity_name"]), activity_id)
+        if self._execute(query, values) == 0:
+            return False
+        return
+
     def update_student(self, record):
         """Updates a student's activity record (updates role, award, hours).
         record = {'student_name': ..., 'activity_name', 'award': ..., 'role': ..., 
@@ -834,10 +2525,28 @@ class Activities(Collection):
         self._execute(query, values)
         return
 
+    def update_student_by_id(self, record):
+        """Updates a student's activity record without resolving any names.
+        record = {'student_id': ..., 'activity_id': ..., 'role': ..., 'award': ...,
+        'hours': ...}
+        Returns False if the student is not linked to that activity
+        """
+        query = """
+                UPDATE 'Students-Activities' SET
+                    'role' = :role,
+                    'award' = :award,
+                    'hours' = :hours
+                WHERE student_id = :student_id
+                AND activity_id = :activity_id;
+                """
+        if self._execute(query, record) == 0:
+            return False
+        return
+
     def delete(self, activity_name):
         """Deletes an activity record."""
         # check if activity exists
-        if not self._is_exist(self._tblname, "activity_name", activity_name):
+        if not self._is_exist(self._tblname, "activity_name_norm", normalize(activity_name)):
             return False
 
         # retrieve activity_id
@@ -853,6 +2562,17 @@ class Activities(Collection):
             values = (activity_id,)
             self._execute(query, values)
         return
+
+    def delete_by_id(self, activity_id):
+        """Deletes an activity record and its student records in one
+        transaction. Returns False if it does not exist
+        """
+        tblnames = ["Students-Activities", "Activities"]
+        statements = [(f"DELETE FROM '{tblname}' WHERE activity_id = ?;", (activity_id,))
+                      for tblname in tblnames]
+        if self._execute_all(statements)[-1] == 0:
+            return False
+        return
         
     def delete_student(self, student_name, activity_name):
         """Deletes a student's activity record"""
@@ -874,4 +2594,354 @@ class Activities(Collection):
                 """
         values = (student_id, activity_id)
         self._execute(query, values)
-        return
\ No newline at end of file
+        return
+
+    def delete_student_by_id(self, student_id, activity_id):
+        """Deletes a student's activity record without resolving any names.
+        Returns False if the student is not linked to that activity
+        """
+        query = """
+                DELETE FROM 'Students-Activities'
+                WHERE student_id = ?
+                AND activity_id = ?;
+                """
+        values = (student_id, activity_id)
+        if self._execute(query, values) == 0:
+            return False
+        return
+
+
+class Changes(Collection):
+    """
+    Changes Collection: the change log written by the triggers on every
+    table in TABLES. Each insert, update and delete gets a version number
+    that only ever increases, so consumers can sync by asking for the
+    changes since the last version they saw.
+
+    Methods:
+    --------
+    version()
+    since(version, limit=500)
+    compact(before_version=None, older_than_days=None)
+    """
+    def __init__(self, dbname=None):
+        super().__init__("Changes", dbname)
+
+    def version(self):
+        """Returns the latest version (0 if nothing has changed yet)"""
+        row = self._return("SELECT seq FROM sqlite_sequence WHERE name = 'Changes';")
+        if row is None:
+            return 0
+        return row['seq']
+
+    def since(self, version, limit=500):
+        """Returns a page of up to limit changes after version, oldest first:
+        {'changes': [{'version', 'table', 'operation', 'key', 'old', 'new',
+                      'changed_at'}, ...],
+         'version': version of the last change in the page (pass it back
+                    to get the next page),
+         'more': whether there are more changes after this page,
+         'resync': True if changes after version have been compacted away,
+                   in which case the consumer has to re-read the tables}
+        """
+        with self._connection() as conn:
+            oldest = conn.execute("SELECT MIN(version) FROM 'Changes';").fetchone()[0]
+            if oldest is None:
+                row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'Changes';").fetchone()
+                oldest = (row[0] if row else 0) + 1
+            if version + 1 < oldest:
+                return {'changes': [], 'version': version, 'more': False, 'resync': True}
+            rows = conn.execute("""
+                    SELECT version, table_name, operation, row_key, old, new, changed_at
+                    FROM 'Changes'
+                    WHERE version > ?
+                    ORDER BY version ASC
+                    LIMIT ?;
+                    """, (version, limit + 1)).fetchall()
+        changes = []
+        for row in rows[:limit]:
+            changes.append({'version': row[0],
+                            'table': row[1],
+                            'operation': row[2],
+                            'key': json.loads(row[3]),
+                            'old': json.loads(row[4]) if row[4] is not None else None,
+                            'new': json.loads(row[5]) if row[5] is not None else None,
+                            'changed_at': row[6]})
+        return {'changes': changes,
+                'version': changes[-1]['version'] if changes else version,
+                'more': len(rows) > limit,
+                'resync': False}
+
+    def compact(self, before_version=None, older_than_days=None):
+        """Deletes the changes up to and including before_version that are
+        older than older_than_days (either condition may be left out).
+        Consumers further behind than the oldest change left are told to
+        resync. Returns the number deleted
+        """
+        conditions = []
+        values = []
+        if before_version is not None:
+            conditions.append("version <= ?")
+            values.append(before_version)
+        if older_than_days is not None:
+            conditions.append("changed_at < datetime('now', ?)")
+            values.append(f'-{older_than_days} days')
+        if not conditions:
+            return 0
+        query = f"DELETE FROM 'Changes' WHERE {' AND '.join(conditions)};"
+        return self._execute(query, values)
+
+
+# one lock per database for ReadModels refreshes, so shards do not wait for each other
+_refresh_locks = {}
+_refresh_locks_lock = threading.Lock()
+
+
+class ReadModels(Collection):
+    """
+    ReadModels Collection: one precomputed JSON document per /view page
+    (Student, Class, CCA and Activity), so that showing a page is one
+    indexed lookup instead of several joins.
+
+    Documents are kept up to date from the Changes feed by refresh(): each
+    change marks the pages that show the changed row, and those documents
+    are rebuilt with the *_by_id getters. get() does not refresh, so the app
+    refreshes after its own writes and in the background (see readmodels.py).
+    A document is {'data': {...}, 'lists': {title: [rows] or False}}.
+
+    Methods:
+    --------
+    refresh()
+    changed_pages(version)
+    documents(pages=None)
+    names(kind)
+    get(kind, name)
+    rebuild()
+    check()
+    """
+    # kind -> (table, id column)
+    KINDS = {'Student': ('Students', 'student_id'),
+             'Class': ('Classes', 'class_id'),
+             'CCA': ('CCAs', 'cca_id'),
+             'Activity': ('Activities', 'activity_id')}
+    # table -> (id column, junction table, columns shown on student pages)
+    _SHOWN_ON_STUDENT_PAGES = {'Classes': ('class_id', 'Students', ['class_name']),
+                               'Subjects': ('subj_id', 'Students-Subjects', ['subj_name', 'level']),
+                               'CCAs': ('cca_id', 'Students-CCAs', ['cca_name']),
+                               'Activities': ('activity_id', 'Students-Activities', ['activity_name'])}
+
+    def __init__(self, dbname=None):
+        super().__init__("ReadModels", dbname)
+        self._changes = Changes(dbname)
+        self._students = Students(dbname)
+        self._classes = Classes(dbname)
+        self._subjects = Subjects(dbname)
+        self._ccas = CCAs(dbname)
+        self._activities = Activities(dbname)
+
+    def _refresh_lock(self):
+        """Returns the lock refreshes of this database take"""
+        dbname = self._dbname
+        with _refresh_locks_lock:
+            return _refresh_locks.setdefault(dbname, threading.Lock())
+
+    def _build(self, kind, entity_id):
+        """Returns (name, document) of a page, or None if its entity is gone"""
+        if kind == 'Student':
+            data = self._students.get_by_id(entity_id)
+            if not data:
+                return None
+            lists = {'Subjects': self._subjects.get_student_by_id(entity_id),
+                     'CCAs': self._ccas.get_student_by_id(entity_id),
+                     'Activities': self._activities.get_student_by_id(entity_id)}
+            return data['student_name'], {'data': data, 'lists': lists}
+        if kind == 'Class':
+            data = self._classes.get_info_by_id(entity_id)
+            if not data:
+                return None
+            lists = {'Class List': self._classes.get_by_id(entity_id)}
+            return data['class_name'], {'data': data, 'lists': lists}
+        if kind == 'CCA':
+            data = self._ccas.get_by_id(entity_id)
+            return (data['cca_name'], {'data': data, 'lists': {}}) if data else None
+        data = self._activities.get_by_id(entity_id)
+        return (data['activity_name'], {'data': data, 'lists': {}}) if data else None
+
+    def _affected(self, change, pages):
+        """Adds the (kind, entity_id) of every page that shows the changed row to pages"""
+        tblname = change['table']
+        rows = [row for row in (change['old'], change['new']) if row is not None]
+
+        def changed(columns):
+            return len(rows) == 1 or any(rows[0][column] != rows[1][column] for column in columns)
+
+        if tblname == 'Students':
+            for row in rows:
+                pages.add(('Student', row['student_id']))
+                # the class roster only shows names
+                if changed(['student_name', 'class_id']):
+                    pages.add(('Class', row['class_id']))
+        elif tblname.startswith('Students-'):
+            for row in rows:
+                pages.add(('Student', row['student_id']))
+        elif tblname in self._SHOWN_ON_STUDENT_PAGES:
+            id_key, junction, columns = self._SHOWN_ON_STUDENT_PAGES[tblname]
+            entity_id = change['key'][id_key]
+            kind = {'Classes': 'Class', 'CCAs': 'CCA', 'Activities': 'Activity'}.get(tblname)
+            if kind is not None:
+                pages.add((kind, entity_id))
+            if changed(columns):
+                query = f"SELECT student_id FROM '{junction}' WHERE {id_key} = ?;"
+                for row in self._return(query, (entity_id,), stream=True):
+                    pages.add(('Student', row['student_id']))
+
+    def _write(self, conn, docs):
+        """Stores [(kind, entity_id, (name, document) or None), ...] in a transaction on conn"""
+        conn.executemany("DELETE FROM 'ReadModels' WHERE kind = ? AND entity_id = ?;",
+                         [(kind, entity_id) for kind, entity_id, built in docs if built is None])
+        conn.executemany("""
+                INSERT OR REPLACE INTO 'ReadModels' (kind, entity_id, name, name_norm, doc)
+                VALUES (?, ?, ?, ?, ?);
+                """,
+                [(kind, entity_id, built[0], normalize(built[0]), json.dumps(built[1]))
+                 for kind, entity_id, built in docs if built is not None])
+
+    def refresh(self):
+        """Rebuilds the documents of the pages changed since the last refresh
+        (or all of them if there are none yet, or the changes they need were
+        compacted away). Returns the number of documents rebuilt
+        """
+        with self._refresh_lock():
+            row = self._return("""
+                    SELECT
+                        (SELECT MAX(version) FROM 'ReadModelsVersion') AS built,
+                        (SELECT seq FROM sqlite_sequence WHERE name = 'Changes') AS latest;
+                    """)
+            built = row['built']
+            if built is None:
+                return self._rebuild()
+            if built >= (row['latest'] or 0):
+                return 0
+
+            pages, version = self.changed_pages(built)
+            if pages is None:
+                return self._rebuild()
+            # built after reading the changes, so they are at least as new as version
+            docs = [(kind, entity_id, self._build(kind, entity_id)) for kind, entity_id in pages]
+            with self._connection() as conn, conn:
+                # another process may have refreshed from the same version
+                # meanwhile; its documents are then kept rather than overwritten
+                moved = conn.execute("UPDATE 'ReadModelsVersion' SET version = ? WHERE version = ?;",
+                                     (version, built)).rowcount
+                if moved == 0:
+                    return 0
+                self._write(conn, docs)
+        return len(docs)
+
+    def changed_pages(self, version):
+        """Returns (pages, version): the (kind, entity_id) of every page that
+        shows a row changed after version, and the version of the last change
+        read. pages is None if those changes have been compacted away, in
+        which case every page has to be rebuilt
+        """
+        pages = set()
+        while True:
+            page = self._changes.since(version, limit=1000)
+            if page['resync']:
+                return None, version
+            for change in page['changes']:
+                self._affected(change, pages)
+            version = page['version']
+            if not page['more']:
+                return pages, version
+
+    def documents(self, pages=None):
+        """Yields (kind, entity_id, name, document) of the pages in pages
+        ((kind, entity_id) pairs), or of every page if pages is None, a kind
+        per query. Pages whose entity is gone are left out
+        """
+        ids = {kind: None for kind in self.KINDS}
+        if pages is not None:
+            ids = {}
+            for kind, entity_id in pages:
+                ids.setdefault(kind, []).append(entity_id)
+        for kind, entity_ids in ids.items():
+            query = "SELECT kind, entity_id, name, doc FROM 'ReadModels' WHERE kind = ?"
+            values = (kind,)
+            if entity_ids is not None:
+                query += " AND entity_id IN (SELECT value FROM json_each(?))"
+                values = (kind, json.dumps(sorted(entity_ids)))
+            for row in self._return(query + " ORDER BY entity_id;", values, stream=True):
+                yield row['kind'], row['entity_id'], row['name'], json.loads(row['doc'])
+
+    def names(self, kind):
+        """Returns [(entity_id, name), ...] of every page of a kind, by name"""
+        query = "SELECT entity_id, name FROM 'ReadModels' WHERE kind = ? ORDER BY name_norm, entity_id;"
+        return [(row['entity_id'], row['name']) for row in self._return(query, (kind,), stream=True)]
+
+    def get(self, kind, name):
+        """Returns the document of the kind ('Student', 'Class', 'CCA' or
+        'Activity') page of name, matched as the getters match names.
+        Returns False if there is none. The partial name match only runs if
+        there is no exact one
+        """
+        row = self._return("""
+                SELECT doc FROM (
+                    SELECT doc FROM 'ReadModels' WHERE kind = :kind AND name_norm = :norm
+                    ORDER BY entity_id LIMIT 1
+                )
+                UNION ALL
+                SELECT doc FROM (
+                    SELECT doc FROM 'ReadModels' WHERE kind = :kind AND name LIKE :like
+                    ORDER BY entity_id LIMIT 1
+                )
+                LIMIT 1;
+                """, {'kind': kind, 'norm': normalize(name), 'like': '%'+name+'%'})
+        if row is None:
+            return False
+        return json.loads(row['doc'])
+
+    def _ids(self, kind):
+        tblname, id_key = self.KINDS[kind]
+        return [row[0] for row in self._return(f"SELECT {id_key} FROM '{tblname}';", stream=True)]
+
+    def rebuild(self):
+        """Rebuilds every document from the tables. Returns the number of documents"""
+        with self._refresh_lock():
+            return self._rebuild()
+
+    def _rebuild(self):
+        version = self._changes.version()
+        docs = [(kind, entity_id, self._build(kind, entity_id))
+                for kind in self.KINDS for entity_id in self._ids(kind)]
+        with self._connection() as conn, conn:
+            conn.execute("DELETE FROM 'ReadModels';")
+            conn.execute("DELETE FROM 'ReadModelsVersion';")
+            conn.execute("INSERT INTO 'ReadModelsVersion' (version) VALUES (?);", (version,))
+            self._write(conn, docs)
+        return len(docs)
+
+    def check(self):
+        """Compares every stored document with one built from the tables.
+        Returns [(kind, entity_id, problem), ...] where problem is 'missing',
+        'stale' or 'orphaned'; no problems means the documents are consistent.
+        Writes made while it runs can show up as stale
+        """
+        self.refresh()
+        stored = {}
+        query = "SELECT kind, entity_id, name, doc FROM 'ReadModels';"
+        for row in self._return(query, stream=True):
+            stored[(row['kind'], row['entity_id'])] = (row['name'], json.loads(row['doc']))
+        problems = []
+        for kind in self.KINDS:
+            for entity_id in self._ids(kind):
+                built = self._build(kind, entity_id)
+                if built is None:
+                    continue
+                doc = stored.pop((kind, entity_id), None)
+                if doc is None:
+                    problems.append((kind, entity_id, 'missing'))
+                elif doc != (built[0], json.loads(json.dumps(built[1]))):
+                    problems.append((kind, entity_id, 'stale'))
+        problems.extend((kind, entity_id, 'orphaned') for kind, entity_id in stored)
+        return problems
@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+import sqlite3
+import pytest
+from benchmark import _dump, _exercise
+from seed import populate
+from storage import Activities, Classes, close_pool, open_backend
+
+BACKENDS = ['sqlite', 'memory']
+# results of the _exercise calls that do not depend on the seeded rows
+EXPECTED = {
+    'Classes.add': None,
+    'Classes.add again': False,
+    'Students.add': None,
+    'Students.add again': False,
+    'Classes.get': [{'student_id': 61, 'student_name': 'BACKEND STUDENT'}],
+    'Subjects.add_student': None,
+    'CCAs.add': None,
+    'CCAs.add_student': None,
+    'CCAs.add_student again': False,
+    'CCAs.get_student': [{'cca_name': 'BACKEND CCA', 'role': 'Chairperson'}],
+    'CCAs.update': None,
+    'Activities.add': None,
+    'Activities.add_many': [False, None],
+    'Activities.get_student': [{'role': 'Participant', 'award': 'Gold', 'hours': 4,
+                                'activity_name': 'BACKEND ACTIVITY'}],
+    'Subjects.delete_student': None,
+    'CCAs.delete_student': None,
+    'Activities.delete_student': None,
+    'Activities.delete': None,
+    'CCAs.delete': None,
+    'Students.delete': None,
+    'Students.get missing': False,
+}
+
+
+@pytest.fixture(scope='module')
+def seeded(tmp_path_factory):
+    dbname = str(tmp_path_factory.mktemp('seed') / 'seed.db')
+    populate(dbname, n_students=60, n_classes=4, n_ccas=6, n_activities=12)
+    close_pool(dbname)
+    return dbname
+
+
+def _copy(seeded, directory, backend):
+    """Opens a copy of the seeded database on backend, returns its path"""
+    dbname = os.path.join(directory, f'{backend}.db')
+    shutil.copyfile(seeded, dbname)
+    open_backend(dbname, backend, **({'snapshot_interval': None} if backend == 'memory' else {}))
+    return dbname
+
+
+@pytest.fixture(params=BACKENDS)
+def database(request, seeded, tmp_path):
+    dbname = _copy(seeded, tmp_path, request.param)
+    yield dbname
+    close_pool(dbname)
+
+
+def test_collections(database):
+    results = dict(_exercise(database))
+    for call, expected in EXPECTED.items():
+        assert results[call] == expected, call
+    assert results['Students.get']['student_name'] == 'BACKEND STUDENT'
+    assert results['CCAs.get']['cca_name'] == 'BACKEND CCA 2'
+
+
+def test_backends_agree(seeded, tmp_path):
+    dbnames = {backend: _copy(seeded, tmp_path, backend) for backend in BACKENDS}
+    try:
+        results = {backend: _exercise(dbname) for backend, dbname in dbnames.items()}
+    finally:
+        for dbname in dbnames.values():
+            close_pool(dbname)
+    assert results['memory'] == results['sqlite']
+    assert _dump(dbnames['memory']) == _dump(dbnames['sqlite'])
+
+
+def test_snapshot_and_replay(seeded, tmp_path):
+    sqlite_db = _copy(seeded, tmp_path, 'sqlite')
+    memory_db = _copy(seeded, tmp_path, 'memory')
+    _exercise(sqlite_db)
+    _exercise(memory_db)
+    close_pool(sqlite_db)
+
+    # a crash before the snapshot: the journal alone has to bring the writes back
+    crashed = str(tmp_path / 'crashed.db')
+    shutil.copyfile(memory_db, crashed)
+    shutil.copyfile(memory_db + '.journal', crashed + '.journal')
+    close_pool(memory_db) # takes the snapshot
+    assert os.path.getsize(memory_db + '.journal') == 0
+    recovered = open_backend(crashed, 'memory', snapshot_interval=None)
+    close_pool(crashed)
+
+    assert recovered.stats['replayed'] > 0
+    assert _dump(memory_db) == _dump(sqlite_db)
+    assert _dump(crashed) == _dump(sqlite_db)
+
+
+def test_journal_skips_trigger_statements(seeded, tmp_path):
+    dbname = _copy(seeded, tmp_path, 'memory')
+    try:
+        Classes(dbname).add({'class_name': 'JOURNAL CLASS', 'level': 'JC1'})
+        with open(dbname + '.journal') as f:
+            entries = [json.loads(line) for line in f]
+    finally:
+        close_pool(dbname)
+    # the Changes trigger runs again on replay, so only the INSERT is journalled
+    assert [len(entry['statements']) for entry in entries] == [1]
+    assert entries[0]['statements'][0]['sql'].lstrip().startswith('INSERT')
+
+
+def test_replay_stops_on_a_failed_transaction(seeded, tmp_path):
+    dbname = _copy(seeded, tmp_path, 'memory')
+    close_pool(dbname)
+    with open(dbname + '.journal', 'a') as f:
+        f.write(json.dumps({'seq': 10**6, 'statements': [
+            {'sql': "UPDATE 'NoSuchTable' SET x = ?;", 'parameters': [1]}]}) + '\n')
+    with pytest.raises(sqlite3.DatabaseError, match='Cannot replay transaction'):
+        open_backend(dbname, 'memory', snapshot_interval=None)
+
+
+def test_add_many_reports_what_was_inserted(database):
+    activity = {'activity_name': 'BATCH ACTIVITY', 'start_date': '2024-01-01',
+                'end_date': '2024-01-02', 'description': ''}
+    again = {**activity, 'activity_name': ' batch activity '}
+    assert Activities(database).add_many([activity, again, activity]) == [None, False, False]
+    assert Activities(database).add_many([again]) == [False]
@@ -0,0 +1,115 @@
+from datetime import datetime
+import pandas as pd
+
+
+def validate_date(start_date: str, end_date=''):
+    """
+    Validate a given dates based on ISO 8601 YYYY-MM-DD format
+    Start date must be before end_date
+    """
+    #strip the dates
+    start_date = start_date.strip()
+    end_date = end_date.strip()
+    
+    #check for start date
+    format = "%Y-%m-%d"
+    try:
+        res1 = datetime.strptime(start_date, format)
+    except ValueError:
+        res1 = False
+    
+    #check for end date if it is not empty
+    if end_date != '':
+        try:
+            res2 = datetime.strptime(end_date, format)
+        except ValueError:
+            res2 = False
+    else:
+        res2 = True
+
+    if res1 and res2:
+        #check if start_date is later than end_date
+        if end_date != '' and (res1 > res2):
+            return False
+        
+        #check for end date if it is not empty
+        if end_date != '':
+            year, month, day = end_date.split('-')
+            if len(year) != 4 or len(month) != 2 or len(day) != 2:
+                return False
+        
+        #check length for start date
+        year, month, day = start_date.split('-')
+        if len(year) == 4 and len(month) == 2 and len(day) == 2:
+            return True
+        
+    return False
+
+
+def has_error(data: dict):
+    '''
+    Returns an error message for the last value that is empty, otherwise returns an empty string
+    Exception for end date, award and hours which are optional
+    '''
+    for key, value in data.items():
+        #end date, award and hours can be empty
+        if value == '' and key not in ['End Date', 'Award', 'Hours']:
+            return f'Please do not leave the {key} empty.'
+    return ''
+
+
+def activity_error(data: dict):
+    '''
+    Returns the error message for an activity as entered in the /add form
+    (keys Name, Start Date, Description, End Date), otherwise returns an empty string
+    '''
+    error = has_error(data)
+    start_date = data['Start Date']
+    end_date = data['End Date']
+    if not validate_date(start_date, end_date):
+        error = 'Please ensure the date is in the correct format (YYYY-MM-DD).'
+        if end_date != '':
+            error += ' Start Date should also be before End Date.'
+    return error
+
+
+def validate_activities(df):
+    '''
+    Validates a DataFrame of activities at once, with the same checks as
+    activity_error applied column by column.
+    Accepts the /add form labels or the Activities column names as headers.
+    Returns the DataFrame with the form labels as columns (values stripped) and
+    an Error column that is empty for valid rows. Rows repeating an earlier
+    Name in the file are errors too.
+    '''
+    df = df.rename(columns={'activity_name': 'Name', 'start_date': 'Start Date',
+                            'description': 'Description', 'end_date': 'End Date'})
+    for key in ['Name', 'Start Date', 'Description', 'End Date']:
+        if key not in df.columns:
+            df[key] = ''
+        df[key] = df[key].fillna('').astype(str).str.strip()
+    df = df[['Name', 'Start Date', 'Description', 'End Date']].copy()
+
+    error = pd.Series('', index=df.index)
+    # has_error reports the first empty field, so fill in from the last one
+    for key in ['Description', 'Start Date', 'Name']:
+        error = error.mask(df[key] == '', f'Please do not leave the {key} empty.')
+
+    pattern = r'^\d{4}-\d{2}-\d{2}$'
+    has_end = df['End Date'] != ''
+    start = pd.to_datetime(df['Start Date'].where(df['Start Date'].str.match(pattern)),
+                           format='%Y-%m-%d', errors='coerce')
+    end = pd.to_datetime(df['End Date'].where(df['End Date'].str.match(pattern)),
+                         format='%Y-%m-%d', errors='coerce')
+    bad_date = start.isna() | (has_end & (end.isna() | (start > end)))
+    error = error.mask(bad_date & ~has_end,
+                       'Please ensure the date is in the correct format (YYYY-MM-DD).')
+    error = error.mask(bad_date & has_end,
+                       'Please ensure the date is in the correct format (YYYY-MM-DD).'
+                       ' Start Date should also be before End Date.')
+
+    names = df['Name'].str.split().str.join(' ').str.casefold()
+    error = error.mask((error == '') & (df['Name'] != '') & names.duplicated(),
+                       'This Name appears more than once in the file.')
+    df['Error'] = error
+    return df